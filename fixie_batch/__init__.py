@@ -1,4 +1,4 @@
-from fixie_batch import environ
-del environ
-
+# Note that fixie_batch.environ is not imported here, so that importing a
+# single submodule stays cheap. Submodules that need the $FIXIE_*_JOBS_DIR
+# variables import fixie_batch.environ themselves.
 __version__ = '0.0.2'
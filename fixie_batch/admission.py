@@ -0,0 +1,210 @@
+"""Admission control for spawning simulations, so that an overloaded server
+tells clients when to retry, rather than running out of processes. Spawn
+requests are refused when either the global or the user's number of queued
+jobs is at its limit ($FIXIE_MAX_QUEUED and $FIXIE_MAX_QUEUED_PER_USER), or
+when the user has spawned jobs faster than the token bucket rate limits allow
+($FIXIE_SPAWN_RATE and $FIXIE_SPAWN_BURST).
+
+Admission is decided by ``spawn()``, once the user has been verified and the
+request has been validated, so that only jobs that are actually spawned take a
+token from their user's bucket.
+
+The numbers of queued jobs are counters maintained from the transitions file,
+which is read incrementally, so that admitting a job never rescans the queued
+directory. They start from the latest snapshot of the journal, see
+``fixie_batch.journal``. Without a snapshot, every jobfile is read, so the
+server builds the counters in a thread, see ``prepare_counter()``.
+"""
+import os
+import time
+import collections
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from fixie import ENV
+
+from fixie_batch.transitions import read_transitions
+from fixie_batch.journal import JobIndex, merge_transitions
+
+
+class QueueCounter(object):
+    """Counts the queued jobs, in total and per user, by following the
+    transitions file.
+    """
+
+    def __init__(self, path=None):
+        self.path = ENV['FIXIE_TRANSITIONS_FILE'] if path is None else path
+        self.rebuild()
+
+    def rebuild(self):
+        """Counts the queued jobs from scratch, from the latest snapshot of
+        the journal and the transitions after it.
+        """
+        index = JobIndex(self.path)
+        self.offset = index.offset
+        self.queued = {}
+        self.users = {}
+        for jobid in index.ids('queued'):
+            self._set(jobid, 'queued', index.jobs[jobid]['user'])
+
+    def _set(self, jobid, status, user):
+        if status == 'queued' and jobid not in self.queued:
+            self.queued[jobid] = user
+            self.users[user] = self.users.get(user, 0) + 1
+        elif status != 'queued' and jobid in self.queued:
+            user = self.queued.pop(jobid)
+            self.users[user] -= 1
+            if not self.users[user]:
+                del self.users[user]
+
+    def update(self):
+        """Applies any new transitions to the counts."""
+        merge_transitions()
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            size = 0
+        if size < self.offset:
+            # file was truncated or replaced, start over
+            self.rebuild()
+            return
+        elif size == self.offset:
+            return
+        transitions, self.offset = read_transitions(self.path, self.offset)
+        for start, end, t in transitions:
+            self._set(t['jobid'], t['status'], t.get('user'))
+
+    def total(self):
+        """Number of queued jobs."""
+        self.update()
+        return len(self.queued)
+
+    def user(self, user):
+        """Number of queued jobs of a user."""
+        self.update()
+        return self.users.get(user, 0)
+
+
+class TokenBucket(object):
+    """A token bucket, which holds up to ``burst`` tokens and is refilled at
+    ``rate`` tokens per second.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = time.monotonic()
+
+    def take(self, now=None):
+        """Takes a token, if one is available. Returns the number of seconds
+        to wait until a token is available, which is zero if one was taken.
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        elif self.rate <= 0.0:
+            return float('inf')
+        return (1.0 - self.tokens) / self.rate
+
+    def full(self, now=None):
+        """Whether the bucket has refilled, i.e. is as good as a new one."""
+        now = time.monotonic() if now is None else now
+        return self.rate > 0.0 and \
+               self.tokens + (now - self.time) * self.rate >= self.burst
+
+
+class Refused(Exception):
+    """Raised when a job is not admitted. The number of seconds after which
+    the client should try again is its ``retry_after`` attribute.
+    """
+
+    def __init__(self, msg, retry_after):
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
+COUNTER = None
+COUNTER_FUTURE = None
+# token buckets of the users, least recently used first
+BUCKETS = collections.OrderedDict()
+
+
+def get_counter():
+    """Returns the queue counter of this server, creating it on first use, or
+    when the transitions file has changed.
+    """
+    global COUNTER
+    if COUNTER is None or COUNTER.path != ENV['FIXIE_TRANSITIONS_FILE']:
+        COUNTER = QueueCounter()
+    return COUNTER
+
+
+@gen.coroutine
+def prepare_counter():
+    """Makes sure that the queue counter of this server has been created,
+    without blocking the IO loop. The counter is created in a thread, which
+    concurrent callers share.
+    """
+    global COUNTER_FUTURE
+    if COUNTER is not None and COUNTER.path == ENV['FIXIE_TRANSITIONS_FILE']:
+        return
+    if COUNTER_FUTURE is None or COUNTER_FUTURE.done():
+        COUNTER_FUTURE = IOLoop.current().run_in_executor(None, get_counter)
+    yield COUNTER_FUTURE
+
+
+def get_bucket(user):
+    """Returns the token bucket of a user, creating it if needed. Buckets that
+    have refilled are dropped, so that only the buckets of users who have
+    spawned jobs recently are kept.
+    """
+    rate, burst = ENV['FIXIE_SPAWN_RATE'], ENV['FIXIE_SPAWN_BURST']
+    bucket = BUCKETS.pop(user, None)
+    if bucket is None or bucket.rate != rate or bucket.burst != burst:
+        bucket = TokenBucket(rate, burst)
+    now = time.monotonic()
+    while BUCKETS and next(iter(BUCKETS.values())).full(now):
+        BUCKETS.popitem(last=False)
+    BUCKETS[user] = bucket
+    return bucket
+
+
+def admit(user):
+    """Decides whether a user may spawn a job now. If so, a token is taken
+    from the user's bucket, so the user must have been verified already.
+
+    Parameters
+    ----------
+    user : str
+        Name of the user.
+
+    Returns
+    -------
+    admitted : bool
+        Whether the job may be spawned.
+    retry_after : float
+        Number of seconds after which the client should try again, zero if
+        the job was admitted.
+    message : str
+        Why the job was not admitted, empty if it was.
+    """
+    counter = get_counter()
+    if counter.total() >= ENV['FIXIE_MAX_QUEUED']:
+        msg = 'The queue is full, with {0} jobs queued, try again later.'
+        return False, ENV['FIXIE_ADMISSION_RETRY_AFTER'], msg.format(len(counter.queued))
+    n = counter.user(user)
+    if n >= ENV['FIXIE_MAX_QUEUED_PER_USER']:
+        msg = 'User {0} already has {1} jobs queued, try again later.'
+        return False, ENV['FIXIE_ADMISSION_RETRY_AFTER'], msg.format(user, n)
+    wait = get_bucket(user).take()
+    if wait == float('inf'):
+        # spawning is switched off for users, so there is no telling when
+        wait = ENV['FIXIE_ADMISSION_RETRY_AFTER']
+    if wait > 0.0:
+        msg = 'User {0} is spawning jobs too quickly, try again later.'
+        return False, wait, msg.format(user)
+    return True, 0.0, ''
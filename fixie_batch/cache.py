@@ -0,0 +1,77 @@
+"""Caches for the lookups on the request hot path. Verifying users and resolving
+job names both read fixie's on-disk stores, which adds up during bulk
+submissions, when the same user and names are looked up over and over.
+
+Successful user verifications are cached by user and a hash of the token,
+so the tokens themselves are never kept in memory. A revoked token thus keeps
+working for up to $FIXIE_CACHE_TTL seconds. Name to jobid resolutions are
+cached as well, and are invalidated whenever this process registers an alias
+that they may resolve to. Both caches hold at most $FIXIE_CACHE_SIZE entries.
+"""
+import hashlib
+
+import fixie
+from fixie import ENV
+from lazyasd import lazyobject
+
+from fixie_batch.tools import TTLCache
+
+
+@lazyobject
+def VERIFIED():
+    """Cache of successful user verifications."""
+    return TTLCache(ENV['FIXIE_CACHE_SIZE'], ENV['FIXIE_CACHE_TTL'])
+
+
+@lazyobject
+def ALIASES():
+    """Cache of job name resolutions."""
+    return TTLCache(ENV['FIXIE_CACHE_SIZE'], ENV['FIXIE_CACHE_TTL'])
+
+
+def verify_user(user, token):
+    """Cached version of ``fixie.verify_user()``. Only successful
+    verifications are cached.
+    """
+    key = (user, hashlib.sha256(token.encode()).hexdigest())
+    found, rtn = VERIFIED.get(key)
+    if found:
+        return rtn
+    rtn = fixie.verify_user(user, token)
+    valid, msg, status = rtn
+    if valid and status:
+        VERIFIED.put(key, rtn)
+    return rtn
+
+
+def jobids_from_alias(user, name='', project=''):
+    """Cached version of ``fixie.jobids_from_alias()``."""
+    key = ('alias', user, name, project)
+    found, jobids = ALIASES.get(key)
+    if not found:
+        jobids = frozenset(fixie.jobids_from_alias(user, name=name, project=project))
+        ALIASES.put(key, jobids)
+    return set(jobids)
+
+
+def jobids_with_name(name):
+    """Cached version of ``fixie.jobids_with_name()``."""
+    key = ('name', name)
+    found, jobids = ALIASES.get(key)
+    if not found:
+        jobids = frozenset(fixie.jobids_with_name(name))
+        ALIASES.put(key, jobids)
+    return set(jobids)
+
+
+def register_job_alias(jobid, user, name='', project=''):
+    """Registers a job alias with ``fixie.register_job_alias()``, and
+    invalidates the cached name resolutions that it may change. Empty names
+    and projects match every job, so those lookups are invalidated as well.
+    """
+    rtn = fixie.register_job_alias(jobid, user, name=name, project=project)
+    for n in {name, ''}:
+        for p in {project, ''}:
+            ALIASES.discard(('alias', user, n, p))
+    ALIASES.discard(('name', name))
+    return rtn
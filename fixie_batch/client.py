@@ -0,0 +1,408 @@
+"""Client for the fixie batch handlers. The client keeps its HTTP connections
+alive and reuses them from a pool, so that a stream of requests does not pay
+for a new connection each time. Its interface is asynchronous, with tornado
+coroutines::
+
+    client = Client('http://localhost:8642', user='inigo', token='42')
+    jobid, status, msg = yield client.spawn(simulation)
+    jobs = yield client.wait_for([jobid])
+
+Lookups of single jobs with ``get()`` that are made at about the same time are
+batched into a single ``/query`` request. Completed, failed, and canceled jobs
+never change status, so their records are cached locally, and are only ever
+fetched once. Note that the storage manager may later remove the output of a
+finished job, which ``query()`` will report, but cached records will not.
+
+``wait_for()`` long-polls the ``/watch`` handler, so that waiting on any number
+of jobs holds a single open request. Watches have a pool of connections of
+their own, so that long polls never hold up other requests. Servers without
+``/watch`` are polled with ``/query`` instead, backing off between polls.
+"""
+import copy
+import json
+import time
+import queue
+import threading
+import http.client
+import urllib.parse
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from fixie_batch.tools import TERMINAL_STATUSES, TTLCache
+
+
+def finished(job):
+    """Whether a job record is final, i.e. the job has reached a terminal
+    status and is not being post-processed anymore.
+    """
+    return (job['status'] in TERMINAL_STATUSES and
+            job.get('post_status') not in ('pending', 'running'))
+
+
+class ConnectionPool(object):
+    """A pool of keep-alive HTTP connections to a server. Requests are made
+    from a thread pool of the same size, so that they never block the IO loop,
+    and at most ``maxsize`` connections are ever open.
+    """
+
+    def __init__(self, url, maxsize=4, timeout=60.0):
+        from concurrent.futures import ThreadPoolExecutor
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.prefix = parts.path.rstrip('/')
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=maxsize)
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        with self.lock:
+            self.created += 1
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def request(self, path, body):
+        """Synchronously POSTs a JSON body to a path of the server. Returns
+        the response code, headers, and body.
+        """
+        try:
+            conn = self.idle.get_nowait()
+            fresh = False
+        except queue.Empty:
+            conn = self._connect()
+            fresh = True
+        try:
+            conn.request('POST', self.prefix + path, body=json.dumps(body),
+                         headers={'Content-Type': 'application/json'})
+            resp = conn.getresponse()
+            data = resp.read()
+        except http.client.RemoteDisconnected:
+            # the server closed the idle connection without reading the
+            # request, so it is safe to send again, even to /spawn
+            conn.close()
+            if fresh:
+                raise
+            return self.request(path, body)
+        except (http.client.HTTPException, ConnectionError):
+            # the request may have been handled, and must not be sent twice
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self.idle.put(conn)
+        return resp.status, dict(resp.getheaders()), data
+
+    def fetch(self, path, body):
+        """Asynchronously POSTs a JSON body to a path of the server. Returns a
+        future of the response code, headers, and body.
+        """
+        return IOLoop.current().run_in_executor(self.executor, self.request,
+                                                path, body)
+
+    def close(self):
+        """Closes every connection."""
+        self.executor.shutdown(wait=True)
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class Client(object):
+    """Asynchronous client for the fixie batch handlers.
+
+    Parameters
+    ----------
+    url : str
+        Base URL of the server.
+    user : str, optional
+        Name of the user, for spawning and canceling jobs.
+    token : str, optional
+        Credential token of the user.
+    maxsize : int, optional
+        Maximum number of connections to the server, not counting watches.
+    max_watches : int, optional
+        Maximum number of watches that may be waiting at once, each of which
+        holds a connection of its own.
+    batch_delay : float, optional
+        Time in seconds to collect lookups of jobs before they are sent to
+        the server together.
+    max_batch : int, optional
+        Maximum number of jobs that are looked up in a single request.
+    cache_size : int, optional
+        Maximum number of finished job records that are cached.
+    max_retries : int, optional
+        Number of times that a spawn that was refused by admission control is
+        retried, after waiting as long as the server asked.
+    timeout : float, optional
+        Timeout of the requests, in seconds.
+    """
+
+    def __init__(self, url, user='', token='', maxsize=4, max_watches=4,
+                 batch_delay=0.01, max_batch=1000, cache_size=10000,
+                 max_retries=3, timeout=120.0):
+        self.user = user
+        self.token = token
+        self.pool = ConnectionPool(url, maxsize=maxsize, timeout=timeout)
+        self.watch_pool = ConnectionPool(url, maxsize=max_watches, timeout=timeout)
+        self.batch_delay = batch_delay
+        self.max_batch = max_batch
+        self.cache = TTLCache(cache_size, float('inf'))
+        self.max_retries = max_retries
+        self.batch = {}
+        self.flush_handle = None
+        self.watch_supported = None
+
+    def close(self):
+        """Closes the connections to the server."""
+        self.pool.close()
+        self.watch_pool.close()
+
+    @gen.coroutine
+    def _post(self, handler, body, pool=None):
+        """POSTs a request to a handler, with a connection from the given
+        pool, by default the client's main pool. Returns the response code,
+        headers, and decoded body.
+        """
+        pool = self.pool if pool is None else pool
+        code, headers, data = yield pool.fetch('/' + handler, body)
+        try:
+            data = json.loads(data.decode())
+        except ValueError:
+            data = {}
+        return code, headers, data
+
+    def _message(self, code, data):
+        return data.get('message') or 'Request failed with HTTP {0}'.format(code)
+
+    def _cache_terminal(self, jobs):
+        for job in jobs:
+            if finished(job):
+                self.cache.put(job['jobid'], job)
+
+    @gen.coroutine
+    def spawn(self, simulation, **kwargs):
+        """Spawns a simulation, as the client's user. Keyword arguments are
+        those of the ``/spawn`` handler. When the server is too busy to admit
+        the job, the spawn is retried after the time it asks for, up to
+        ``max_retries`` times.
+
+        Returns
+        -------
+        jobid : int
+            Unique job id of this run, negative if the spawn failed.
+        status : bool
+            Whether or not the simulation was spawned.
+        message : str
+            Message about the status.
+        """
+        body = {'user': self.user, 'token': self.token}
+        body.update(kwargs)
+        body['simulation'] = simulation
+        for attempt in range(self.max_retries + 1):
+            code, headers, data = yield self._post('spawn', body)
+            if code != 429 or attempt == self.max_retries:
+                break
+            retry_after = data.get('retry_after', headers.get('Retry-After', 1.0))
+            yield gen.sleep(float(retry_after))
+        if code != 200:
+            return -1, False, self._message(code, data)
+        return data['jobid'], data['status'], data['message']
+
+    @gen.coroutine
+    def cancel(self, job, project=''):
+        """Cancels a job, as the client's user.
+
+        Returns
+        -------
+        jobid : int
+            Unique job id of the canceled run, negative if it could not be found.
+        status : bool
+            Whether the job was canceled.
+        message : str
+            Message about the status.
+        """
+        body = {'job': job, 'user': self.user, 'token': self.token}
+        if project:
+            body['project'] = project
+        code, headers, data = yield self._post('cancel', body)
+        if code != 200:
+            return -1, False, self._message(code, data)
+        return data['jobid'], data['status'], data['message']
+
+    @gen.coroutine
+    def query(self, **kwargs):
+        """Queries the jobs, with the keyword arguments of the ``/query``
+        handler. This always asks the server, but finished jobs that are found
+        are cached for ``get()``.
+
+        Returns
+        -------
+        data : list of dicts or None
+            The jobs that were found. None if status is False.
+        status : bool
+            Whether or not the query was successful.
+        message : str
+            Message related to the status of the query.
+        """
+        code, headers, data = yield self._post('query', kwargs)
+        if code != 200:
+            return None, False, self._message(code, data)
+        if data['status']:
+            self._cache_terminal(data['data'])
+        return data['data'], data['status'], data['message']
+
+    def get(self, jobid):
+        """Looks up a job by its jobid. Finished jobs are returned from the
+        cache. Other lookups are collected for ``batch_delay`` seconds and
+        sent to the server together.
+
+        Returns
+        -------
+        job : Future of dict or None
+            The job record, with its 'status'. None if the job was not found.
+        """
+        fut = Future()
+        found, job = self.cache.get(jobid)
+        if found:
+            fut.set_result(copy.deepcopy(job))
+            return fut
+        self.batch.setdefault(jobid, []).append(fut)
+        if len(self.batch) >= self.max_batch:
+            self._flush()
+        elif self.flush_handle is None:
+            self.flush_handle = IOLoop.current().call_later(self.batch_delay,
+                                                            self._flush)
+        return fut
+
+    @gen.coroutine
+    def get_many(self, jobids):
+        """Looks up several jobs at once. Returns a dict mapping the jobids to
+        their records, which are None for jobs that were not found.
+        """
+        jobids = sorted(set(jobids))
+        jobs = yield [self.get(jobid) for jobid in jobids]
+        return dict(zip(jobids, jobs))
+
+    def _flush(self):
+        if self.flush_handle is not None:
+            IOLoop.current().remove_timeout(self.flush_handle)
+            self.flush_handle = None
+        batch, self.batch = self.batch, {}
+        if batch:
+            IOLoop.current().spawn_callback(self._lookup, batch)
+
+    @gen.coroutine
+    def _lookup(self, batch):
+        try:
+            data, status, msg = yield self.query(jobs=sorted(batch))
+            if not status:
+                raise RuntimeError(msg)
+        except Exception as e:
+            for futs in batch.values():
+                for fut in futs:
+                    fut.set_exception(e)
+            return
+        found = {job['jobid']: job for job in data}
+        for jobid, futs in batch.items():
+            for fut in futs:
+                job = found.get(jobid)
+                fut.set_result(None if job is None else copy.deepcopy(job))
+
+    @gen.coroutine
+    def watch(self, **kwargs):
+        """Waits for jobs to change status, with the keyword arguments of the
+        ``/watch`` handler.
+
+        Returns
+        -------
+        data : list of dicts or None
+            The transitions that were found. None if status is False.
+        cursor : int
+            Cursor to pass in as ``since`` to continue watching.
+        status : bool
+            Whether or not the watch was successful.
+        message : str
+            Message related to the status of the watch.
+        """
+        code, headers, data = yield self._post('watch', kwargs, pool=self.watch_pool)
+        self.watch_supported = code != 404
+        if code != 200:
+            return None, kwargs.get('since'), False, self._message(code, data)
+        return data['data'], data['cursor'], data['status'], data['message']
+
+    @gen.coroutine
+    def wait_for(self, jobids, timeout=None, interval=1.0, max_interval=30.0):
+        """Waits until jobs have completed, failed, or been canceled.
+
+        Parameters
+        ----------
+        jobids : iterable of ints
+            The jobs to wait for.
+        timeout : float or None, optional
+            Maximum time in seconds to wait. If None, waits forever.
+        interval : float, optional
+            Time in seconds between the first polls, if the server cannot
+            be watched. This doubles after every poll, up to ``max_interval``.
+        max_interval : float, optional
+            Maximum time in seconds between polls.
+
+        Returns
+        -------
+        jobs : dict
+            Maps the jobids to their final records. Jobs that were not found
+            map to None.
+
+        Raises
+        ------
+        tornado.gen.TimeoutError
+            If the jobs have not all finished before the timeout.
+        """
+        jobids = set(jobids)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        cursor = None
+        if jobids and self.watch_supported is not False:
+            # get a cursor before looking at the jobs, so that no transition
+            # after the lookup is missed
+            _, cursor, status, msg = yield self.watch(jobs=sorted(jobids), timeout=0)
+            if not status:
+                cursor = None
+        done = {}
+        remaining = jobids
+        while True:
+            jobs = yield self.get_many(remaining)
+            for jobid, job in jobs.items():
+                if job is None or finished(job):
+                    done[jobid] = job
+            remaining = remaining - set(done)
+            if not remaining:
+                return done
+            left = None if deadline is None else deadline - time.monotonic()
+            if left is not None and left <= 0.0:
+                raise gen.TimeoutError('Timed out waiting for jobs: ' +
+                                       ', '.join(map(str, sorted(remaining))))
+            if cursor is None:
+                wait = interval if left is None else min(interval, left)
+                yield gen.sleep(wait)
+                interval = min(2.0 * interval, max_interval)
+                continue
+            # wait until at least one of the remaining jobs finishes
+            data = []
+            while not data:
+                body = {'jobs': sorted(remaining), 'since': cursor,
+                        'statuses': sorted(TERMINAL_STATUSES)}
+                if left is not None:
+                    body['timeout'] = max(0.0, deadline - time.monotonic())
+                data, cursor, status, msg = yield self.watch(**body)
+                if not status:
+                    raise RuntimeError(msg)
+                if not data and deadline is not None and time.monotonic() >= deadline:
+                    break
@@ -1,9 +1,12 @@
 """Sets up the environment variables for fixie batch execution."""
 import os
+import socket
 import itertools
 import functools
 
-from xonsh.tools import is_string, ensure_string, always_false
+from xonsh.tools import (is_string, ensure_string, always_false, is_bool,
+    to_bool, bool_to_str, is_int, is_float, is_string_set, csv_to_set,
+    set_to_csv)
 
 from fixie.environ import ENV, ENVVARS, expand_and_make_dir
 
@@ -44,3 +47,112 @@ for status in QUEUE_STATUSES:
         'Path to fixie ' + status + ' jobs directory, must be distinct from '
         'other status directories')
 del status, t
+
+ENVVARS['FIXIE_HELD_JOBS_DIR'] = (
+    functools.partial(fixie_job_status_dir, 'held'), always_false,
+    distinct_status_dirs, ensure_string,
+    'Path to the directory of holds on queued fixie jobs, which keep them from '
+    'running. This must be distinct from the status directories.')
+
+ENVVARS['FIXIE_OUTBOX_DIR'] = (
+    functools.partial(fixie_job_status_dir, 'outbox'), always_false,
+    distinct_status_dirs, ensure_string,
+    'Path to the directory of notifications waiting to be delivered. This must '
+    'be distinct from the status directories.')
+
+ENVVARS['FIXIE_POST_DIR'] = (
+    functools.partial(fixie_job_status_dir, 'post'), always_false,
+    distinct_status_dirs, ensure_string,
+    'Path to the directory of jobs waiting for or running post-processing. '
+    'This must be distinct from the status directories.')
+
+ENVVARS['FIXIE_NODE'] = (socket.gethostname, is_string, str, ensure_string,
+    'Name of this compute node, which is recorded in the jobs that it runs. '
+    'This must be unique among the nodes sharing the status directories.')
+ENVVARS['FIXIE_SHARED_QUEUE'] = (False, is_bool, to_bool, bool_to_str,
+    'Whether spawned jobs are placed on a queue shared by workers on several '
+    'nodes (see fixie_batch.worker), rather than run on the spawning node.')
+ENVVARS['FIXIE_LEASE_TIME'] = (300.0, is_float, float, str,
+    'Time in seconds after which a job running on another node is considered '
+    'dead, if its runner has not touched its jobfile.')
+ENVVARS['FIXIE_REAP_INTERVAL'] = (60.0, is_float, float, str,
+    'Time in seconds between checks for jobs whose runner process has died.')
+ENVVARS['FIXIE_REAP_RETRIES'] = (0, is_int, int, str,
+    'Number of times a job whose runner process died is put back on the '
+    'queue, before it is moved to the failed directory.')
+ENVVARS['FIXIE_TRANSITIONS_FILE'] = (
+    lambda: os.path.join(ENV.get('FIXIE_JOBS_DIR'), 'transitions.jsonl'),
+    is_string, str, ensure_string,
+    'Path to the journal of every transition of a job between statuses. Only '
+    'the server appends to it, by merging the transitions files of the nodes '
+    'in $FIXIE_NODE_TRANSITIONS_DIR.')
+ENVVARS['FIXIE_NODE_TRANSITIONS_DIR'] = (
+    functools.partial(fixie_job_status_dir, 'transitions'), always_false,
+    distinct_status_dirs, ensure_string,
+    'Path to the directory of the transitions files of the nodes. The runners '
+    'and workers on each node only append to the file of their own node, '
+    '{node}.jsonl, since appends over NFS are not atomic. This must be '
+    'distinct from the status directories.')
+ENVVARS['FIXIE_WATCH_TIMEOUT'] = (60.0, is_float, float, str,
+    'Maximum time in seconds that a watch request waits for a job to change '
+    'status before returning.')
+ENVVARS['FIXIE_NOTIFY_INTERVAL'] = (1.0, is_float, float, str,
+    'Time in seconds between deliveries of the notifications in the outbox.')
+ENVVARS['FIXIE_NOTIFY_RETRIES'] = (5, is_int, int, str,
+    'Number of times delivering a notification is retried before it is dropped.')
+ENVVARS['FIXIE_NOTIFY_TIMEOUT'] = (10.0, is_float, float, str,
+    'Time in seconds to wait on a notification target before giving up.')
+ENVVARS['FIXIE_NOTIFY_DIRS'] = (set(), is_string_set, csv_to_set, set_to_csv,
+    'Directories that unix:// socket and file:// directory notification '
+    'targets must be inside of. By default, no such targets are allowed.')
+ENVVARS['FIXIE_NOTIFY_HOSTS'] = (set(), is_string_set, csv_to_set, set_to_csv,
+    'Hosts that http(s) notification targets may be sent to. By default, any '
+    'host is allowed, except for those on loopback, private, and other '
+    'non-public addresses.')
+ENVVARS['FIXIE_POST_NJOBS'] = (2, is_int, int, str,
+    'Maximum number of jobs that may be post-processed at once. These slots '
+    'are separate from the $FIXIE_NJOBS simulation slots.')
+ENVVARS['FIXIE_POST_MODULES'] = (set(), is_string_set, csv_to_set, set_to_csv,
+    'Modules to import for additional post-processing stages, see '
+    'fixie_batch.post.')
+ENVVARS['FIXIE_STORAGE_INTERVAL'] = (600.0, is_float, float, str,
+    'Time in seconds between sweeps of the simulation outputs, see '
+    'fixie_batch.storage.')
+ENVVARS['FIXIE_USER_QUOTA'] = (float('inf'), is_float, float, str,
+    'Maximum number of bytes of simulation output kept per user. The oldest '
+    'outputs of a user over quota are removed.')
+ENVVARS['FIXIE_PROJECT_QUOTA'] = (float('inf'), is_float, float, str,
+    'Maximum number of bytes of simulation output kept per project. The oldest '
+    'outputs of a project over quota are removed.')
+ENVVARS['FIXIE_RECOMPRESS'] = (False, is_bool, to_bool, bool_to_str,
+    'Whether finished simulation outputs are gzipped in the background, with '
+    'low CPU and I/O priority.')
+ENVVARS['FIXIE_RECOMPRESS_LEVEL'] = (9, is_int, int, str,
+    'Compression level used when recompressing simulation outputs.')
+ENVVARS['FIXIE_RECOMPRESS_AGE'] = (3600.0, is_float, float, str,
+    'Time in seconds after a job ends before its output is recompressed.')
+ENVVARS['FIXIE_MAX_QUEUED'] = (10000, is_int, int, str,
+    'Maximum number of queued jobs. Spawn requests are refused while the '
+    'queue is full.')
+ENVVARS['FIXIE_MAX_QUEUED_PER_USER'] = (1000, is_int, int, str,
+    'Maximum number of queued jobs per user. Spawn requests from a user are '
+    'refused while they have this many jobs queued.')
+ENVVARS['FIXIE_SPAWN_RATE'] = (10.0, is_float, float, str,
+    'Number of jobs per second that each user may spawn, on average.')
+ENVVARS['FIXIE_SPAWN_BURST'] = (100.0, is_float, float, str,
+    'Number of jobs that each user may spawn at once, above $FIXIE_SPAWN_RATE.')
+ENVVARS['FIXIE_ADMISSION_RETRY_AFTER'] = (30.0, is_float, float, str,
+    'Time in seconds after which clients are told to retry spawn requests '
+    'that were refused because the queue was full.')
+ENVVARS['FIXIE_CACHE_SIZE'] = (1024, is_int, int, str,
+    'Maximum number of entries in each of the caches of user verifications '
+    'and job name lookups.')
+ENVVARS['FIXIE_CACHE_TTL'] = (60.0, is_float, float, str,
+    'Time in seconds that user verifications and job name lookups are cached.')
+ENVVARS['FIXIE_SNAPSHOT_FILE'] = (
+    lambda: os.path.join(ENV.get('FIXIE_JOBS_DIR'), 'transitions-snapshot.json'),
+    is_string, str, ensure_string,
+    'Path to the snapshot of the status of every job, as of an offset into '
+    '$FIXIE_TRANSITIONS_FILE, from which restarts replay the transitions.')
+ENVVARS['FIXIE_SNAPSHOT_INTERVAL'] = (300.0, is_float, float, str,
+    'Time in seconds between snapshots of the status of every job.')
@@ -1,11 +1,74 @@
 """Tornado handlers for interfacing with fixie batch execution."""
-from fixie import RequestHandler
+import math
+import functools
+
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+from fixie import ENV, RequestHandler
 
 from fixie_batch.environ import QUEUE_STATUSES
 from fixie_batch.simulations import spawn, cancel, query
-
-
-class Spawn(RequestHandler):
+from fixie_batch.reaper import reap
+from fixie_batch.watcher import watch
+from fixie_batch.notify import dispatch_notifications
+from fixie_batch.storage import manage_storage
+from fixie_batch.admission import Refused, prepare_counter
+from fixie_batch.journal import save_snapshot
+
+
+# maintenance tasks, and the environment variables with their intervals
+PERIODIC = [
+    (reap, 'FIXIE_REAP_INTERVAL'),
+    (dispatch_notifications, 'FIXIE_NOTIFY_INTERVAL'),
+    (manage_storage, 'FIXIE_STORAGE_INTERVAL'),
+    (save_snapshot, 'FIXIE_SNAPSHOT_INTERVAL'),
+    ]
+PERIODIC_CALLBACKS = []
+PERIODIC_FUTURES = {}
+PERIODIC_EXECUTOR = None
+
+
+def _run_periodic(func):
+    """Runs a maintenance task in the background, unless it is still running
+    from last time. Tasks such as sweeping the outputs or snapshotting the
+    journal may scan every job, and so must never block the IO loop.
+    """
+    fut = PERIODIC_FUTURES.get(func)
+    if fut is not None and not fut.done():
+        return
+    PERIODIC_FUTURES[func] = IOLoop.current().run_in_executor(PERIODIC_EXECUTOR, func)
+
+
+def start_periodic():
+    """Runs the periodic maintenance tasks once and then schedules them on the
+    current IO loop. The tasks themselves run in a thread pool. This only has
+    an effect the first time it is called, which is when the server creates
+    its first handler.
+    """
+    global PERIODIC_EXECUTOR
+    if PERIODIC_CALLBACKS:
+        return
+    from concurrent.futures import ThreadPoolExecutor
+    PERIODIC_EXECUTOR = ThreadPoolExecutor(max_workers=len(PERIODIC))
+    for func, interval in PERIODIC:
+        _run_periodic(func)
+        pc = PeriodicCallback(functools.partial(_run_periodic, func),
+                              ENV[interval] * 1000)
+        pc.start()
+        PERIODIC_CALLBACKS.append(pc)
+
+
+class BatchHandler(RequestHandler):
+    """Base class of the fixie batch handlers, which starts the periodic
+    maintenance tasks on the server's IO loop along with the first handler.
+    """
+
+    def initialize(self):
+        super().initialize()
+        start_periodic()
+
+
+class Spawn(BatchHandler):
 
     schema = {'simulation': {'anyof_type': ['dict', 'string'], 'required': True},
               'user': {'type': 'string', 'empty': False, 'required': True},
@@ -17,19 +80,66 @@ class Spawn(RequestHandler):
                 {'type': 'string', 'allowed': ['public', 'private']},
                 {'type': 'list', 'schema': {'type': 'string'}},
                 ]},
-              'post': {'type': 'list'},
-              'notify': {'type': 'list'},
+              'post': {'type': 'list', 'schema': {'anyof': [
+                {'type': 'string'},
+                {'type': 'dict', 'allow_unknown': True, 'schema': {
+                  'stage': {'type': 'string', 'required': True},
+                  }},
+                ]}},
+              'notify': {'type': 'list', 'schema': {'anyof': [
+                {'type': 'string'},
+                {'type': 'dict', 'schema': {
+                  'url': {'type': 'string', 'required': True},
+                  'statuses': {'type': 'list', 'schema': {
+                    'type': 'string',
+                    'allowed': ['completed', 'failed', 'canceled']}},
+                  }},
+                ]}},
               'interactive': {'type': 'boolean'},
+              'retry': {'type': 'dict', 'nullable': True, 'schema': {
+                'max_attempts': {'type': 'integer', 'min': 1},
+                'backoff': {'type': 'number', 'min': 0},
+                'factor': {'type': 'number', 'min': 0},
+                'max_backoff': {'type': 'number', 'min': 0},
+                'returncodes': {'type': 'list', 'schema': {'type': 'integer'}},
+                'signals': {'type': 'list',
+                            'schema': {'anyof_type': ['integer', 'string']}},
+                }},
+              'limits': {'type': 'dict', 'nullable': True, 'schema': {
+                'walltime': {'type': 'number', 'min': 0},
+                'cputime': {'type': 'number', 'min': 0},
+                'memory': {'type': 'integer', 'min': 1},
+                }},
+              'after': {'type': 'list', 'schema': {'anyof': [
+                {'type': 'integer'},
+                {'type': 'string'},
+                {'type': 'dict', 'schema': {
+                  'job': {'anyof_type': ['integer', 'string'], 'required': True},
+                  'condition': {'type': 'string', 'allowed': ['success', 'any']},
+                  }},
+                ]}},
               }
     response_keys = ('jobid', 'status', 'message')
 
+    @gen.coroutine
     def post(self):
-        resp = spawn(**self.request.arguments)
+        # the first spawn may have to count the queued jobs from scratch
+        yield prepare_counter()
+        try:
+            resp = spawn(admission=True, **self.request.arguments)
+        except Refused as e:
+            # tell the client when to come back, rather than queueing jobs
+            # until the server runs out of processes
+            self.set_status(429)
+            self.set_header('Retry-After', str(math.ceil(e.retry_after)))
+            self.write({'jobid': -1, 'status': False, 'message': str(e),
+                        'retry_after': e.retry_after})
+            return
         response = dict(zip(self.response_keys, resp))
         self.write(response)
 
 
-class Cancel(RequestHandler):
+class Cancel(BatchHandler):
 
     schema = {'job': {'anyof_type': ['integer', 'string'], 'required': True},
               'user': {'type': 'string', 'empty': False, 'required': True},
@@ -47,7 +157,7 @@ class Cancel(RequestHandler):
 ALLOWED_STATUSES = ['all'] + list(QUEUE_STATUSES)
 
 
-class Query(RequestHandler):
+class Query(BatchHandler):
 
     schema = {'statuses': {'anyof': [
                 {'type': 'string', 'allowed': ALLOWED_STATUSES},
@@ -78,8 +188,43 @@ class Query(RequestHandler):
         self.write(response)
 
 
+class Watch(BatchHandler):
+
+    schema = {'statuses': {'anyof': [
+                {'type': 'string', 'allowed': ALLOWED_STATUSES},
+                {'type': 'list', 'empty': False,
+                 'schema': {'type': 'string', 'allowed': ALLOWED_STATUSES}},
+                ]},
+              'users': {'anyof': [
+                {'type': 'string', 'empty': False},
+                {'type': 'list', 'empty': False,
+                 'schema': {'type': 'string', 'empty': False}},
+                ], 'nullable': True},
+              'jobs': {'anyof': [
+                {'type': 'integer'},
+                {'type': 'string'},
+                {'type': 'list', 'empty': False,
+                 'schema': {'anyof_type': ['integer', 'string']}},
+                ], 'nullable': True},
+              'projects': {'anyof': [
+                {'type': 'string'},
+                {'type': 'list', 'empty': False, 'schema': {'type': 'string'}},
+                ], 'nullable': True},
+              'since': {'type': 'integer', 'min': 0, 'nullable': True},
+              'timeout': {'type': 'number', 'min': 0, 'nullable': True},
+              }
+    response_keys = ('data', 'cursor', 'status', 'message')
+
+    @gen.coroutine
+    def post(self):
+        resp = yield watch(**self.request.arguments)
+        response = dict(zip(self.response_keys, resp))
+        self.write(response)
+
+
 HANDLERS = [
     ('/spawn', Spawn),
     ('/cancel', Cancel),
     ('/query', Query),
+    ('/watch', Watch),
 ]
@@ -0,0 +1,104 @@
+"""Holds keep queued jobs out of the set of runnable jobs, for example while a
+failed job backs off before being retried, or while a job waits for the jobs
+that it runs after. A hold is a small JSON file named after the jobid in
+$FIXIE_HELD_JOBS_DIR. Queued jobs with a hold are skipped when free slots are
+handed out, and so do not block the jobs behind them.
+
+Runners place and resolve the holds of their own jobs, and workers resolve
+those of jobs on the shared queue, so this module is kept free of fixie.
+"""
+import os
+import json
+import time
+
+from fixie_batch.tools import TERMINAL_STATUSES, atomic_write
+
+
+def hold_file(held_dir, jobid):
+    """Returns the path to the hold file for a job."""
+    return os.path.join(held_dir, str(jobid) + '.json')
+
+
+def held_ids(held_dir):
+    """Set of jobids that currently have a hold."""
+    return {int(h.name[:-5]) for h in os.scandir(held_dir)
+            if h.name.endswith('.json')}
+
+
+def add_hold(held_dir, jobid, **kwargs):
+    """Places a hold on a job. Keyword arguments describe when the hold may be
+    released: ``until`` is the time after which the hold expires, and ``after``
+    is a list of dicts with the 'jobid' of a job that must finish first, and
+    the 'condition' ('success' or 'any') that its outcome must meet.
+    """
+    hold = dict(kwargs, jobid=jobid)
+    with atomic_write(hold_file(held_dir, jobid),
+                      tmpdir=os.path.dirname(held_dir)) as f:
+        json.dump(hold, f, sort_keys=True)
+    return hold
+
+
+def load_hold(held_dir, jobid):
+    """Returns the hold for a job, or None if the job is not held."""
+    try:
+        with open(hold_file(held_dir, jobid)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def remove_hold(held_dir, jobid):
+    """Removes the hold on a job, if any. Returns whether a hold was removed."""
+    try:
+        os.remove(hold_file(held_dir, jobid))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def hold_expired(hold, now=None):
+    """Whether a hold may be released now."""
+    now = time.time() if now is None else now
+    return now >= hold.get('until', 0.0)
+
+
+def terminal_status(jobid, status_dirs):
+    """Returns the terminal status of a job, or None if it has not finished.
+    ``status_dirs`` maps the terminal statuses to their directories.
+    """
+    base = str(jobid) + '.json'
+    for status in TERMINAL_STATUSES:
+        if os.path.exists(os.path.join(status_dirs[status], base)):
+            return status
+    return None
+
+
+def resolve_hold(hold, status_dirs, now=None):
+    """Decides what should happen to a held job.
+
+    Parameters
+    ----------
+    hold : dict
+        The hold on the job.
+    status_dirs : dict
+        Maps the terminal statuses to their directories.
+    now : float or None, optional
+        Current time, defaults to time.time().
+
+    Returns
+    -------
+    release : bool
+        Whether the hold may be released.
+    reason : str
+        Why the job should be canceled, since a job that it runs after did
+        not end as required. This is empty if the job should not be canceled.
+    """
+    release = hold_expired(hold, now=now)
+    for dep in hold.get('after', ()):
+        status = terminal_status(dep['jobid'], status_dirs)
+        if status is None:
+            release = False
+        elif dep['condition'] == 'success' and status != 'completed':
+            msg = 'Job canceled since job {0}, which it runs after, was {1}'
+            return False, msg.format(dep['jobid'], status)
+    return release, ''
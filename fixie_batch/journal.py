@@ -0,0 +1,165 @@
+"""Fast restarts from the journal of job transitions. The transitions file
+(see ``fixie_batch.transitions``) is an append-only journal of every change of
+status. The runners, ``spawn()``, ``cancel()``, the workers, and the reaper
+record transitions in the file of their node, and these are merged into the
+journal whenever it is read. The current status of every job is the result of
+replaying it.
+
+To avoid replaying all of history, the server periodically writes a snapshot
+of the replayed state to $FIXIE_SNAPSHOT_FILE, along with the journal offset
+that it covers. On restart, the snapshot is loaded and only the transitions
+after its offset are replayed. Without a snapshot, for example the first time
+that a server starts with existing jobs, the status directories are scanned
+once. External consumers may tail the journal cheaply with
+``read_transitions()``, or build their own index with ``JobIndex``. A snapshot
+may be written by hand with::
+
+    $ python -m fixie_batch.journal
+"""
+import os
+import json
+import time
+
+from fixie import ENV
+
+from fixie_batch.environ import QUEUE_STATUSES
+from fixie_batch.transitions import read_transitions, Merger
+from fixie_batch.tools import atomic_write
+
+
+INDEX_KEYS = ('node', 'project', 'status', 'time', 'user')
+MERGER = None
+
+
+def merge_transitions():
+    """Merges the transitions files of the nodes into the journal, so that
+    readers of the journal see the transitions of every node. Returns the
+    transitions that were merged.
+    """
+    global MERGER
+    if (MERGER is None or MERGER.path != ENV['FIXIE_TRANSITIONS_FILE'] or
+            MERGER.node_dir != ENV['FIXIE_NODE_TRANSITIONS_DIR']):
+        MERGER = Merger(ENV['FIXIE_NODE_TRANSITIONS_DIR'],
+                        ENV['FIXIE_TRANSITIONS_FILE'])
+    return MERGER.merge()
+
+
+class JobIndex(object):
+    """The current status of every job, with its user, project, node, and the
+    time of its last transition, kept up to date by replaying the journal.
+    """
+
+    def __init__(self, path=None, snapshot=None):
+        self.path = ENV['FIXIE_TRANSITIONS_FILE'] if path is None else path
+        self.snapshot = ENV['FIXIE_SNAPSHOT_FILE'] if snapshot is None else snapshot
+        self.load()
+
+    def load(self):
+        """Loads the latest snapshot, or scans the status directories if there
+        is none, and then replays the journal after it.
+        """
+        try:
+            with open(self.snapshot) as f:
+                snap = json.load(f)
+        except (FileNotFoundError, ValueError):
+            snap = None
+        if snap is not None and snap['offset'] <= self._size():
+            self.jobs = {int(k): v for k, v in snap['jobs'].items()}
+            self.offset = snap['offset']
+        else:
+            self.scan()
+        self.update()
+
+    def scan(self):
+        """Rebuilds the index from the status directories, and resets the
+        journal offset, so that the whole journal is replayed on top.
+        """
+        self.jobs = {}
+        self.offset = 0
+        for status in QUEUE_STATUSES:
+            d = ENV['FIXIE_{0}_JOBS_DIR'.format(status.upper())]
+            for e in os.scandir(d):
+                if not e.name.endswith('.json'):
+                    continue
+                try:
+                    with open(e.path) as f:
+                        job = json.load(f)
+                    mtime = e.stat().st_mtime
+                except (FileNotFoundError, ValueError):
+                    continue
+                job.update(status=status, time=mtime)
+                self.apply(job)
+
+    def _size(self):
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def apply(self, transition):
+        """Applies a single transition to the index."""
+        self.jobs[transition['jobid']] = {k: transition.get(k) for k in INDEX_KEYS}
+
+    def update(self):
+        """Replays any new transitions in the journal. Returns them."""
+        merge_transitions()
+        size = self._size()
+        if size < self.offset:
+            # journal was truncated or replaced, start over
+            self.scan()
+        elif size == self.offset:
+            return []
+        transitions, self.offset = read_transitions(self.path, self.offset)
+        transitions = [t for s, e, t in transitions]
+        for t in transitions:
+            self.apply(t)
+        return transitions
+
+    def save(self):
+        """Atomically writes a snapshot of the index."""
+        snap = {'jobs': self.jobs, 'offset': self.offset, 'time': time.time()}
+        with atomic_write(self.snapshot) as f:
+            json.dump(snap, f, sort_keys=True, separators=(',', ':'))
+        return snap
+
+    def ids(self, status):
+        """Set of the jobids with the given status."""
+        return {jobid for jobid, job in self.jobs.items() if job['status'] == status}
+
+
+INDEX = None
+
+
+def get_index():
+    """Returns the job index of this server, loading it on first use, or when
+    the journal or snapshot file has changed.
+    """
+    global INDEX
+    if (INDEX is None or INDEX.path != ENV['FIXIE_TRANSITIONS_FILE'] or
+            INDEX.snapshot != ENV['FIXIE_SNAPSHOT_FILE']):
+        INDEX = JobIndex()
+    return INDEX
+
+
+def save_snapshot():
+    """Brings the server's job index up to date and writes a snapshot of it.
+    This is run periodically by the server.
+    """
+    index = get_index()
+    index.update()
+    return index.save()
+
+
+def main(args=None):
+    """Writes a snapshot of the journal from the command line."""
+    snap = save_snapshot()
+    counts = {}
+    for job in snap['jobs'].values():
+        counts[job['status']] = counts.get(job['status'], 0) + 1
+    print('offset: {0}'.format(snap['offset']))
+    for status in sorted(counts):
+        print('{0}: {1}'.format(status, counts[status]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,361 @@
+"""Load tests for the fixie batch handlers. The handlers are served locally,
+with a stub ``cyclus`` that sleeps for a while and then writes an empty
+output, and are driven with a mixed workload of spawns, cancels, and queries
+at a target request rate, while jobs are changing status. Afterwards, the
+throughput, latencies, and error rates are reported, along with any
+violations of correctness, i.e. jobs that are in two status directories at
+once, jobs that were lost or never finished, and wrong query results.
+
+User verification is stubbed out, so that the load is on fixie batch itself,
+rather than on the credential store. A load test may be run with::
+
+    $ python -m fixie_batch.loadtest --rate 100 --duration 30 --sleep 0.5
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.web import Application
+from fixie import ENV
+
+import fixie_batch.simulations
+from fixie_batch.environ import QUEUE_STATUSES
+from fixie_batch.handlers import HANDLERS
+from fixie_batch.stubs import stub_cyclus
+
+
+DEFAULT_MIX = {'spawn': 0.5, 'query': 0.3, 'cancel': 0.2}
+
+SIMULATION = {'simulation': {'control': {'duration': 1, 'startmonth': 1,
+                                         'startyear': 2000}}}
+
+
+def _always_verify_user(user, token):
+    return True, 'User verified', True
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of a list of values, or None if empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+class Recorder(object):
+    """Records the outcome and latency of every request, and the jobs that
+    were spawned and canceled.
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.outcomes = {}
+        self.spawned = {}
+        self.canceled = set()
+        self.violations = []
+
+    def record(self, op, latency, outcome):
+        self.latencies.setdefault(op, []).append(latency)
+        counts = self.outcomes.setdefault(op, {})
+        counts[outcome] = counts.get(outcome, 0) + 1
+
+
+@gen.coroutine
+def _request(client, base_url, rec, op, body):
+    req = HTTPRequest(base_url + '/' + op, method='POST', body=json.dumps(body),
+                      request_timeout=60.0)
+    t0 = time.monotonic()
+    resp = yield client.fetch(req, raise_error=False)
+    latency = time.monotonic() - t0
+    if resp.code == 429:
+        rec.record(op, latency, 'throttled')
+        return None
+    elif resp.code != 200:
+        rec.record(op, latency, 'error')
+        return None
+    data = json.loads(resp.body.decode())
+    rec.record(op, latency, 'ok' if data['status'] else 'rejected')
+    return data
+
+
+@gen.coroutine
+def _spawn(client, base_url, rec, user):
+    body = {'user': user, 'token': '42', 'simulation': SIMULATION}
+    data = yield _request(client, base_url, rec, 'spawn', body)
+    if data is not None and data['status']:
+        rec.spawned[data['jobid']] = user
+
+
+@gen.coroutine
+def _cancel(client, base_url, rec, user, rng):
+    jobids = [j for j, u in rec.spawned.items() if u == user]
+    if not jobids:
+        return
+    jobid = rng.choice(jobids)
+    body = {'user': user, 'token': '42', 'job': jobid}
+    data = yield _request(client, base_url, rec, 'cancel', body)
+    if data is not None and data['status']:
+        rec.canceled.add(jobid)
+
+
+@gen.coroutine
+def _query(client, base_url, rec, user, rng):
+    jobids = [j for j, u in rec.spawned.items() if u == user]
+    if not jobids:
+        return
+    jobid = rng.choice(jobids)
+    body = {'users': user, 'jobs': [jobid]}
+    data = yield _request(client, base_url, rec, 'query', body)
+    if data is None or not data['status']:
+        return
+    # a spawned job always exists, in exactly one status
+    found = [(job['jobid'], job['user'], job['status']) for job in data['data']]
+    if (len(found) != 1 or found[0][:2] != (jobid, user) or
+            found[0][2] not in QUEUE_STATUSES):
+        rec.violations.append('query for job {0} of {1} returned {2}'.format(
+                              jobid, user, found))
+
+
+@gen.coroutine
+def drive(base_url, rate=50.0, duration=10.0, mix=None, users=10, seed=None,
+          rec=None):
+    """Sends requests to the handlers at a target rate, without waiting for
+    earlier requests to finish, i.e. with an open loop.
+
+    Parameters
+    ----------
+    base_url : str
+        URL of the server.
+    rate : float, optional
+        Target number of requests per second.
+    duration : float, optional
+        Number of seconds to send requests for.
+    mix : dict or None, optional
+        Weights of the 'spawn', 'query', and 'cancel' requests, defaults to
+        ``DEFAULT_MIX``.
+    users : int, optional
+        Number of users that send requests.
+    seed : int or None, optional
+        Seed of the random workload.
+    rec : Recorder or None, optional
+        Recorder of the results, a new one is made if None.
+
+    Returns
+    -------
+    rec : Recorder
+        The recorded results.
+    elapsed : float
+        Number of seconds until every request had been answered.
+    """
+    mix = DEFAULT_MIX if mix is None else mix
+    rec = Recorder() if rec is None else rec
+    rng = random.Random(seed)
+    ops, weights = zip(*sorted(mix.items()))
+    client = AsyncHTTPClient(max_clients=1000)
+    futures = []
+    t0 = time.monotonic()
+    for i in range(int(rate * duration)):
+        delay = t0 + i / rate - time.monotonic()
+        if delay > 0.0:
+            yield gen.sleep(delay)
+        user = 'user{0}'.format(rng.randrange(users))
+        op = rng.choices(ops, weights)[0]
+        if op == 'spawn':
+            futures.append(_spawn(client, base_url, rec, user))
+        elif op == 'cancel':
+            futures.append(_cancel(client, base_url, rec, user, rng))
+        else:
+            futures.append(_query(client, base_url, rec, user, rng))
+    yield futures
+    return rec, time.monotonic() - t0
+
+
+def status_dir_ids():
+    """Returns a dict mapping the jobids in the status directories to the
+    list of statuses that they are in.
+    """
+    found = {}
+    for status in sorted(QUEUE_STATUSES):
+        for jobid in fixie_batch.simulations.status_ids(status):
+            found.setdefault(jobid, []).append(status)
+    return found
+
+
+@gen.coroutine
+def drain(timeout=60.0):
+    """Waits until no jobs are queued or running, or the timeout expires."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not (fixie_batch.simulations.queued_ids() or
+                fixie_batch.simulations.running_ids()):
+            return True
+        yield gen.sleep(0.1)
+    return False
+
+
+def check(rec):
+    """Checks the status directories against the recorded results, and adds
+    any violations of correctness to the recorder.
+    """
+    found = status_dir_ids()
+    for jobid, statuses in sorted(found.items()):
+        if len(statuses) > 1:
+            rec.violations.append('job {0} is in {1}'.format(jobid, ', '.join(statuses)))
+    for jobid in sorted(rec.spawned):
+        statuses = found.get(jobid)
+        if not statuses:
+            rec.violations.append('job {0} was lost'.format(jobid))
+        elif statuses[0] in ('queued', 'running'):
+            rec.violations.append('job {0} is still {1}'.format(jobid, statuses[0]))
+        elif jobid in rec.canceled and statuses != ['canceled']:
+            rec.violations.append('job {0} was canceled, but is {1}'.format(
+                                  jobid, statuses[0]))
+    data, status, msg = fixie_batch.simulations.query()
+    queried = {job['jobid']: job['status'] for job in data}
+    for jobid, statuses in sorted(found.items()):
+        if queried.get(jobid) not in statuses:
+            rec.violations.append('query() says job {0} is {1}, but it is {2}'.format(
+                                  jobid, queried.get(jobid), ', '.join(statuses)))
+
+
+def report(rec, elapsed):
+    """Returns a dict summarizing the recorded results."""
+    ops = {}
+    total = 0
+    for op, latencies in sorted(rec.latencies.items()):
+        outcomes = rec.outcomes[op]
+        n = len(latencies)
+        total += n
+        ops[op] = {
+            'requests': n,
+            'outcomes': dict(outcomes),
+            'error_rate': outcomes.get('error', 0) / n,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies),
+            }
+    return {'elapsed': elapsed,
+            'requests': total,
+            'throughput': total / elapsed if elapsed else 0.0,
+            'jobs': len(rec.spawned),
+            'canceled': len(rec.canceled),
+            'ops': ops,
+            'violations': list(rec.violations)}
+
+
+@gen.coroutine
+def loadtest(rate=50.0, duration=10.0, mix=None, users=10, sleep=0.1,
+             drain_timeout=60.0, seed=None):
+    """Serves the handlers locally, with a stub cyclus, drives a mixed
+    workload at them, and checks the results. This uses the status
+    directories of the current environment, which should be empty.
+
+    Parameters
+    ----------
+    rate, duration, mix, users, seed
+        The workload, see ``drive()``.
+    sleep : float, optional
+        Number of seconds that each stub simulation takes.
+    drain_timeout : float, optional
+        Number of seconds to wait for the jobs to finish after the workload.
+
+    Returns
+    -------
+    report : dict
+        Summary of the results, see ``report()``.
+    """
+    bindir = tempfile.mkdtemp()
+    path = os.environ.get('PATH')
+    verify_user = fixie_batch.simulations.verify_user
+    server = None
+    try:
+        stub_cyclus(bindir, sleep=sleep)
+        os.environ['PATH'] = bindir + os.pathsep + (path or '')
+        fixie_batch.simulations.verify_user = _always_verify_user
+        sock, port = bind_unused_port()
+        server = HTTPServer(Application(HANDLERS))
+        server.add_sockets([sock])
+        base_url = 'http://127.0.0.1:{0}'.format(port)
+        rec, elapsed = yield drive(base_url, rate=rate, duration=duration,
+                                   mix=mix, users=users, seed=seed)
+        yield drain(drain_timeout)
+        check(rec)
+    finally:
+        if server is not None:
+            server.stop()
+        fixie_batch.simulations.verify_user = verify_user
+        if path is None:
+            os.environ.pop('PATH', None)
+        else:
+            os.environ['PATH'] = path
+        shutil.rmtree(bindir)
+    return report(rec, elapsed)
+
+
+def _format(rep):
+    lines = ['{requests} requests in {elapsed:.2f} s, {throughput:.1f} req/s, '
+             '{jobs} jobs spawned, {canceled} canceled'.format(**rep)]
+    for op, r in sorted(rep['ops'].items()):
+        outcomes = ', '.join('{0}={1}'.format(k, v) for k, v in sorted(r['outcomes'].items()))
+        lines.append('{0:>7}: n={1} p50={2:.4f} p95={3:.4f} p99={4:.4f} '
+                     'max={5:.4f} errors={6:.2%} ({7})'.format(op, r['requests'],
+                     r['p50'], r['p95'], r['p99'], r['max'], r['error_rate'], outcomes))
+    lines.append('{0} correctness violations'.format(len(rep['violations'])))
+    lines.extend('  ' + v for v in rep['violations'])
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    """Main entry point for load tests."""
+    p = argparse.ArgumentParser(description='Load tests the fixie batch '
+                                            'handlers with a stub cyclus.')
+    p.add_argument('-r', '--rate', type=float, default=50.0,
+                   help='target requests per second')
+    p.add_argument('-d', '--duration', type=float, default=10.0,
+                   help='seconds to send requests for')
+    p.add_argument('-u', '--users', type=int, default=10,
+                   help='number of users sending requests')
+    p.add_argument('-s', '--sleep', type=float, default=0.1,
+                   help='seconds that each stub simulation takes')
+    p.add_argument('-n', '--njobs', type=int, default=None,
+                   help='simulation slots, defaults to $FIXIE_NJOBS')
+    p.add_argument('--mix', default=None,
+                   help='weights of the requests as JSON, e.g. '
+                        '\'{"spawn": 0.5, "query": 0.3, "cancel": 0.2}\'')
+    p.add_argument('--drain-timeout', type=float, default=60.0,
+                   help='seconds to wait for the jobs to finish')
+    p.add_argument('--seed', type=int, default=None)
+    p.add_argument('--json', action='store_true', default=False,
+                   help='print the report as JSON')
+    ns = p.parse_args(args)
+    from fixie import environ
+    d = tempfile.mkdtemp()
+    swap = {'XDG_DATA_HOME': os.path.join(d, 'share'),
+            'XDG_CONFIG_HOME': os.path.join(d, 'config')}
+    if ns.njobs is not None:
+        swap['FIXIE_NJOBS'] = ns.njobs
+    try:
+        with ENV.swap(**swap), environ.context():
+            rep = IOLoop.current().run_sync(lambda: loadtest(
+                rate=ns.rate, duration=ns.duration, users=ns.users,
+                sleep=ns.sleep, drain_timeout=ns.drain_timeout, seed=ns.seed,
+                mix=None if ns.mix is None else json.loads(ns.mix)))
+    finally:
+        shutil.rmtree(d)
+    print(json.dumps(rep, indent=1, sort_keys=True) if ns.json else _format(rep))
+    return 1 if rep['violations'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,345 @@
+"""Notifications about jobs reaching a terminal status. When a job that asked
+to be notified completes, fails, or is canceled, an entry for each of its
+notification targets is written to $FIXIE_OUTBOX_DIR. The server then
+delivers the entries asynchronously, batched by target, so that a slow
+receiver never holds up the runners. Targets may be:
+
+* ``http://...`` or ``https://...`` : the batch is POSTed as JSON,
+* ``unix:///path/to/socket`` : the batch is sent as JSON lines over a Unix
+  stream socket,
+* ``file:///path/to/dir`` : the batch is dropped into the directory as a
+  JSON file.
+
+Socket and directory targets must be inside one of the directories that the
+server allows, which are listed in $FIXIE_NOTIFY_DIRS, so that users cannot
+have the server write files or connect to sockets anywhere it can reach.
+Likewise, webhooks must be on one of the hosts in $FIXIE_NOTIFY_HOSTS. If
+there are none, any host may be used, as long as every address that it
+resolves to is public, so that users cannot reach services on the server's
+own machine or private network. Redirects are never followed.
+
+Runners queue the notifications of their own jobs, so queuing needs nothing
+but the outbox directory, while delivery is left to the server.
+"""
+import os
+import json
+import time
+import socket
+import ipaddress
+from urllib.parse import urlsplit
+
+from fixie_batch.tools import TERMINAL_STATUSES, atomic_write
+
+
+NOTIFY_SCHEMES = ('http://', 'https://', 'unix://', 'file://')
+LOCAL_SCHEMES = ('unix://', 'file://')
+
+
+def _allowed(path, allowed_dirs):
+    """Whether a path is inside one of the allowed directories, once symbolic
+    links and '..' have been resolved.
+    """
+    path = os.path.realpath(path)
+    for d in allowed_dirs:
+        d = os.path.realpath(d)
+        if os.path.commonpath([path, d]) == d:
+            return True
+    return False
+
+
+def _is_public(address):
+    """Whether an IP address is a public one, rather than a loopback,
+    private, link-local, or otherwise reserved address.
+    """
+    # drop the scope of IPv6 addresses, such as fe80::1%eth0
+    return ipaddress.ip_address(address.split('%', 1)[0]).is_global
+
+
+def _host_error(host, allowed_hosts):
+    """Returns why webhooks may not be sent to a host, or an empty string
+    if they may. Only the host name itself is checked, see
+    ``_create_public_connection()`` for the addresses it resolves to.
+    """
+    if not host:
+        return 'has no host'
+    if allowed_hosts:
+        if host.lower() not in {h.lower() for h in allowed_hosts}:
+            return 'is not on a host that allows notifications'
+        return ''
+    if host.lower() == 'localhost' or host.lower().endswith('.localhost'):
+        return 'is not on a public host'
+    try:
+        public = _is_public(host)
+    except ValueError:
+        # a host name, rather than an address
+        return ''
+    return '' if public else 'is not on a public host'
+
+
+def ensure_notify(notify, allowed_dirs=(), allowed_hosts=()):
+    """Returns a list of notification targets, as dicts with a 'url' and the
+    'statuses' to notify about, AND an error message. Targets may be given as
+    URL strings or as such dicts. Socket and directory targets must be inside
+    one of the ``allowed_dirs``. Webhooks must be on one of the
+    ``allowed_hosts``, or if there are none, must not be on a loopback or
+    private address. On failure, the list will be None.
+    """
+    targets = []
+    for target in notify:
+        if isinstance(target, str):
+            target = {'url': target}
+        elif not isinstance(target, dict) or 'url' not in target:
+            return None, '{0!r} is not a valid notification target'.format(target)
+        url = target['url']
+        if not isinstance(url, str) or not url.startswith(NOTIFY_SCHEMES):
+            return None, '{0!r} is not a supported notification URL'.format(url)
+        if url.startswith(LOCAL_SCHEMES) and \
+                not _allowed(url.split('://', 1)[1], allowed_dirs):
+            msg = '{0!r} is not in a directory that allows notifications'
+            return None, msg.format(url)
+        if not url.startswith(LOCAL_SCHEMES):
+            try:
+                err = _host_error(urlsplit(url).hostname, allowed_hosts)
+            except ValueError:
+                err = 'is not a valid URL'
+            if err:
+                return None, '{0!r} {1}'.format(url, err)
+        statuses = target.get('statuses', sorted(TERMINAL_STATUSES))
+        if isinstance(statuses, str):
+            statuses = [statuses]
+        for status in statuses:
+            if status not in TERMINAL_STATUSES:
+                return None, '{0!r} is not a terminal status'.format(status)
+        targets.append({'url': url, 'statuses': sorted(statuses)})
+    return targets, ''
+
+
+def queue_notifications(outbox_dir, job, status):
+    """Writes an outbox entry for each of the job's targets that want to know
+    about the status. Returns the number of entries written.
+    """
+    notification = {
+        'endtime': job.get('endtime'),
+        'jobid': job['jobid'],
+        'node': job.get('node'),
+        'outfile': job.get('outfile'),
+        'project': job['project'],
+        'returncode': job.get('returncode'),
+        'status': status,
+        'time': time.time(),
+        'user': job['user'],
+        }
+    n = 0
+    for i, target in enumerate(job.get('notify') or ()):
+        if isinstance(target, str):
+            target = {'url': target, 'statuses': TERMINAL_STATUSES}
+        if status not in target['statuses']:
+            continue
+        entry = {'notification': notification, 'target': target['url'],
+                 'tries': 0, 'next_time': 0.0}
+        base = '{0}-{1}-{2}.json'.format(job['jobid'], status, i)
+        with atomic_write(os.path.join(outbox_dir, base),
+                          tmpdir=os.path.dirname(outbox_dir)) as f:
+            json.dump(entry, f, sort_keys=True)
+        n += 1
+    return n
+
+
+def pending(outbox_dir, now=None, exclude=()):
+    """Returns the outbox entries that are due to be delivered, as a dict
+    mapping targets to lists of (filename, entry) tuples.
+    """
+    now = time.time() if now is None else now
+    batches = {}
+    for e in os.scandir(outbox_dir):
+        if not e.name.endswith('.json') or e.name in exclude:
+            continue
+        try:
+            with open(e.path) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+        if entry['next_time'] > now:
+            continue
+        batches.setdefault(entry['target'], []).append((e.name, entry))
+    return batches
+
+
+def _create_public_connection(address, timeout, source_address=None):
+    """Connects to a host, like ``socket.create_connection()``, but refuses
+    to if any of the host's addresses is not public. The connection is made to
+    the address that was checked, so that the host cannot be made to resolve
+    to another address in between.
+    """
+    host, port = address
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    for family, type, proto, canonname, sockaddr in infos:
+        if not _is_public(sockaddr[0]):
+            raise OSError('{0!r} resolves to {1}, which is not a public '
+                          'address'.format(host, sockaddr[0]))
+    return socket.create_connection(infos[0][4][:2], timeout, source_address)
+
+
+def _opener(public_only):
+    """Returns a URL opener that never follows redirects, and that only
+    connects to public addresses if ``public_only`` is True.
+    """
+    from urllib.request import (build_opener, HTTPHandler, HTTPSHandler,
+        HTTPRedirectHandler)
+
+    class NoRedirectHandler(HTTPRedirectHandler):
+        def redirect_request(self, req, fp, code, msg, headers, newurl):
+            return None
+
+    def public(http_class):
+        def connection(host, **kwargs):
+            conn = http_class(host, **kwargs)
+            conn._create_connection = _create_public_connection
+            return conn
+        return connection
+
+    class PublicHTTPHandler(HTTPHandler):
+        def do_open(self, http_class, req, **kwargs):
+            return super().do_open(public(http_class), req, **kwargs)
+
+    class PublicHTTPSHandler(HTTPSHandler):
+        def do_open(self, http_class, req, **kwargs):
+            return super().do_open(public(http_class), req, **kwargs)
+
+    handlers = [NoRedirectHandler]
+    if public_only:
+        handlers += [PublicHTTPHandler, PublicHTTPSHandler]
+    return build_opener(*handlers)
+
+
+def _post_http(url, notifications, timeout, allowed_hosts=()):
+    from urllib.request import Request
+    err = _host_error(urlsplit(url).hostname, allowed_hosts)
+    if err:
+        raise ValueError('{0!r} {1}'.format(url, err))
+    data = json.dumps({'notifications': notifications}).encode()
+    req = Request(url, data=data, method='POST',
+                  headers={'Content-Type': 'application/json'})
+    with _opener(not allowed_hosts).open(req, timeout=timeout) as resp:
+        resp.read()
+
+
+def _send_unix(url, notifications, timeout):
+    lines = ''.join(json.dumps(n, sort_keys=True) + '\n' for n in notifications)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(url[len('unix://'):])
+        sock.sendall(lines.encode())
+
+
+def _drop_file(url, notifications, timeout):
+    d = url[len('file://'):]
+    base = '{0:.6f}-{1}.json'.format(time.time(), os.getpid())
+    with atomic_write(os.path.join(d, base)) as f:
+        json.dump({'notifications': notifications}, f, sort_keys=True)
+
+
+def send(url, notifications, timeout=10.0, allowed_hosts=()):
+    """Sends a batch of notifications to a target, raising an exception on
+    failure. Webhooks are only sent to the ``allowed_hosts``, or, if there are
+    none, to hosts whose addresses are all public.
+    """
+    if url.startswith('unix://'):
+        _send_unix(url, notifications, timeout)
+    elif url.startswith('file://'):
+        _drop_file(url, notifications, timeout)
+    else:
+        _post_http(url, notifications, timeout, allowed_hosts=allowed_hosts)
+
+
+def deliver(outbox_dir, target, entries, retries=5, timeout=10.0,
+            allowed_hosts=()):
+    """Delivers a batch of outbox entries to a target. Delivered entries are
+    removed from the outbox. On failure, entries are retried with exponential
+    backoff, and are dropped after the given number of retries. Returns whether
+    the batch was delivered.
+    """
+    notifications = [entry['notification'] for name, entry in entries]
+    try:
+        send(target, notifications, timeout=timeout,
+             allowed_hosts=allowed_hosts)
+        delivered = True
+    except Exception:
+        delivered = False
+    for name, entry in entries:
+        path = os.path.join(outbox_dir, name)
+        if delivered or entry['tries'] >= retries:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        entry['tries'] += 1
+        entry['next_time'] = time.time() + 2.0**entry['tries']
+        with atomic_write(path, tmpdir=os.path.dirname(outbox_dir)) as f:
+            json.dump(entry, f, sort_keys=True)
+    return delivered
+
+
+def flush(outbox_dir, retries=5, timeout=10.0, allowed_hosts=()):
+    """Synchronously delivers every due outbox entry. Returns the number of
+    batches that were delivered.
+    """
+    n = 0
+    for target, entries in pending(outbox_dir).items():
+        n += deliver(outbox_dir, target, entries, retries=retries,
+                     timeout=timeout, allowed_hosts=allowed_hosts)
+    return n
+
+
+class Dispatcher(object):
+    """Delivers the outbox in the background, from a small thread pool, so
+    that the server's IO loop is never blocked by a slow receiver.
+    """
+
+    def __init__(self, outbox_dir, max_workers=4, retries=5, timeout=10.0,
+                 allowed_hosts=()):
+        from concurrent.futures import ThreadPoolExecutor
+        self.outbox_dir = outbox_dir
+        self.retries = retries
+        self.timeout = timeout
+        self.allowed_hosts = frozenset(allowed_hosts)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.inflight = set()
+
+    def dispatch(self):
+        """Starts delivering every due batch that is not already in flight.
+        Returns the futures of the deliveries.
+        """
+        futures = []
+        for target, entries in pending(self.outbox_dir,
+                                       exclude=self.inflight).items():
+            names = {name for name, entry in entries}
+            self.inflight |= names
+            fut = self.executor.submit(deliver, self.outbox_dir, target,
+                                       entries, retries=self.retries,
+                                       timeout=self.timeout,
+                                       allowed_hosts=self.allowed_hosts)
+            fut.add_done_callback(lambda f, names=names:
+                                  self.inflight.difference_update(names))
+            futures.append(fut)
+        return futures
+
+
+DISPATCHER = None
+
+
+def dispatch_notifications():
+    """Starts delivering the due notifications in $FIXIE_OUTBOX_DIR in the
+    background. This is run periodically by the server.
+    """
+    global DISPATCHER
+    from fixie import ENV
+    hosts = frozenset(ENV['FIXIE_NOTIFY_HOSTS'])
+    if DISPATCHER is None or DISPATCHER.outbox_dir != ENV['FIXIE_OUTBOX_DIR'] \
+            or DISPATCHER.allowed_hosts != hosts:
+        DISPATCHER = Dispatcher(ENV['FIXIE_OUTBOX_DIR'],
+                                retries=ENV['FIXIE_NOTIFY_RETRIES'],
+                                timeout=ENV['FIXIE_NOTIFY_TIMEOUT'],
+                                allowed_hosts=hosts)
+    return DISPATCHER.dispatch()
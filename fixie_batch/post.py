@@ -0,0 +1,204 @@
+"""Post-processing of simulation outputs. Post-processing stages are run, in
+order, after cyclus completes successfully, so that users may fetch compact
+results rather than whole output files. Stages run in their own pool of
+$FIXIE_POST_NJOBS slots, and so never hold up the $FIXIE_NJOBS simulation
+slots. The results of every stage are recorded in the job's 'post_results'.
+
+A stage is a function that takes the job dict, and any keyword arguments
+given when the job was spawned, and returns a JSON-serializable result. Stages
+are registered by name with the ``stage()`` decorator. Extra modules that
+register stages may be listed in $FIXIE_POST_MODULES. The following stages
+are built in:
+
+* ``metrics`` : size of the output file, duration of the simulation, and the
+  number of rows in each output table,
+* ``material_flows`` : total quantity of material moved between prototypes,
+  per commodity, written to a compact JSON table beside the output file,
+* ``compress`` : gzips the output file, which is replaced by the compressed
+  file.
+
+Stages run inside the runner scripts, so the built in stages stick to the
+standard library, apart from reading HDF5 output files, which requires h5py.
+It is installed with the ``hdf5`` extra of fixie-batch.
+"""
+import os
+import json
+import time
+import importlib
+from collections.abc import Mapping
+
+from fixie_batch.tools import atomic_write
+
+
+STAGES = {}
+
+
+def stage(name):
+    """Decorator that registers a post-processing stage under a name."""
+    def dec(f):
+        STAGES[name] = f
+        return f
+    return dec
+
+
+def import_stages(modules):
+    """Imports modules that register additional stages."""
+    for module in sorted(modules):
+        importlib.import_module(module)
+
+
+def ensure_post(post):
+    """Returns a list of post-processing steps, as dicts with the 'stage' name
+    and its keyword arguments, AND an error message. Steps may be given as
+    stage names or as such dicts. On failure, the list will be None.
+    """
+    steps = []
+    for step in post:
+        if isinstance(step, str):
+            step = {'stage': step}
+        elif not isinstance(step, Mapping) or 'stage' not in step:
+            return None, '{0!r} is not a valid post-processing step'.format(step)
+        if step['stage'] not in STAGES:
+            return None, '{0!r} is not a known post-processing stage'.format(step['stage'])
+        steps.append(dict(step))
+    return steps, ''
+
+
+def run_stages(job, steps):
+    """Runs post-processing steps on a job, stopping at the first step that
+    fails. Returns the results of the steps that were run, and whether all of
+    them succeeded.
+    """
+    results = []
+    for step in steps:
+        kwargs = {k: v for k, v in step.items() if k != 'stage'}
+        starttime = time.time()
+        try:
+            result = {'result': STAGES[step['stage']](job, **kwargs),
+                      'status': True}
+        except Exception as e:
+            result = {'message': '{0}: {1}'.format(type(e).__name__, e),
+                      'status': False}
+        result.update(stage=step['stage'], starttime=starttime,
+                      endtime=time.time())
+        results.append(result)
+        if not result['status']:
+            return results, False
+    return results, True
+
+
+def _import_h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('reading HDF5 output files requires h5py, which is '
+                          'installed with fixie-batch[hdf5]') from None
+    return h5py
+
+
+def read_table(outfile, table, columns):
+    """Reads columns of a table in a cyclus output file, which may be either
+    an SQLite or an HDF5 database. Returns a list of tuples.
+    """
+    if outfile.endswith('.sqlite'):
+        import sqlite3
+        conn = sqlite3.connect(outfile)
+        try:
+            return conn.execute('SELECT {0} FROM {1}'.format(', '.join(columns),
+                                                             table)).fetchall()
+        finally:
+            conn.close()
+    h5py = _import_h5py()
+    with h5py.File(outfile, 'r') as f:
+        data = f[table][...]
+    return [tuple(v.decode() if isinstance(v, bytes) else v.item()
+                  for v in (row[c] for c in columns)) for row in data]
+
+
+def table_sizes(outfile):
+    """Returns a dict mapping the names of the tables in a cyclus output file
+    to their number of rows.
+    """
+    if outfile.endswith('.sqlite'):
+        import sqlite3
+        conn = sqlite3.connect(outfile)
+        try:
+            names = [r[0] for r in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table'")]
+            return {n: conn.execute('SELECT COUNT(*) FROM "{0}"'.format(n)).fetchone()[0]
+                    for n in names}
+        finally:
+            conn.close()
+    h5py = _import_h5py()
+    with h5py.File(outfile, 'r') as f:
+        return {n: len(d) for n, d in f.items() if isinstance(d, h5py.Dataset)}
+
+
+def _sidecar(job, suffix):
+    root, _ = os.path.splitext(job['outfile'])
+    return root + suffix
+
+
+@stage('metrics')
+def metrics(job):
+    """Summary metrics of a simulation."""
+    try:
+        tables = table_sizes(job['outfile'])
+    except ImportError:
+        tables = None
+    return {'duration': job['endtime'] - job['starttime'],
+            'size': os.path.getsize(job['outfile']),
+            'tables': tables}
+
+
+@stage('material_flows')
+def material_flows(job, by_time=False):
+    """Totals the quantity of each commodity that was transacted between
+    prototypes, optionally per time step, and writes the table beside the
+    output file.
+    """
+    outfile = job['outfile']
+    protos = dict(read_table(outfile, 'AgentEntry', ['AgentId', 'Prototype']))
+    qtys = dict(read_table(outfile, 'Resources', ['ResourceId', 'Quantity']))
+    totals = {}
+    for sender, receiver, resource, commodity, t in read_table(outfile,
+            'Transactions', ['SenderId', 'ReceiverId', 'ResourceId',
+                             'Commodity', 'Time']):
+        key = (protos.get(sender), protos.get(receiver), commodity)
+        if by_time:
+            key += (t,)
+        totals[key] = totals.get(key, 0.0) + qtys.get(resource, 0.0)
+    columns = ['Sender', 'Receiver', 'Commodity'] + (['Time'] if by_time else [])
+    table = {'columns': columns + ['Quantity'],
+             'data': [list(k) + [v] for k, v in sorted(totals.items(), key=str)]}
+    fname = _sidecar(job, '-flows.json')
+    with open(fname, 'w') as f:
+        json.dump(table, f, separators=(',', ':'))
+    return {'file': fname, 'nrows': len(table['data'])}
+
+
+def gzip_file(path, level=6, keep=False):
+    """Gzips a file, replacing it with the compressed file, unless ``keep`` is
+    True. Returns the path to the compressed file, and the original size.
+    """
+    import gzip
+    import shutil
+    gzfile = path + '.gz'
+    with open(path, 'rb') as fin, atomic_write(gzfile, 'wb') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=level) as fout:
+            shutil.copyfileobj(fin, fout)
+    original_size = os.path.getsize(path)
+    if not keep:
+        os.remove(path)
+    return gzfile, original_size
+
+
+@stage('compress')
+def compress(job, level=6):
+    """Gzips the output file in place. The job's outfile is updated to the
+    compressed file.
+    """
+    gzfile, original_size = gzip_file(job['outfile'], level=level)
+    job['outfile'] = gzfile
+    return {'file': gzfile, 'original_size': original_size,
+            'size': os.path.getsize(gzfile)}
@@ -0,0 +1,221 @@
+"""Reaps jobs whose runner process has died, for example because the host was
+rebooted or the runner was killed. Such jobs would otherwise stay in the
+running directory forever, taking up one of the $FIXIE_NJOBS slots. Dead jobs
+are either put back on the queue, if they have retries left, or moved to the
+failed directory. The reaper may be run by hand with::
+
+    $ python -m fixie_batch.reaper
+"""
+import os
+import sys
+import json
+import time
+
+from fixie import ENV, detached_call
+
+from fixie_batch.tools import process_starttime
+from fixie_batch.simulations import (queued_ids, running_ids, runner_script,
+    _jobfile, _dump_job, _record_transition, _kill_group)
+
+
+def is_alive(pid, starttime=None):
+    """Whether the process with the given pid (and start time, if available)
+    is still alive on this node.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # process exists, but belongs to another user
+        pass
+    if starttime is None:
+        return True
+    st = process_starttime(pid)
+    return st is None or st == starttime
+
+
+def _death_reason(job, jobfile):
+    """Returns why the job's runner is thought to be dead, or an empty string
+    if it seems to be alive. A runner that was launched, but has not recorded
+    its pid within $FIXIE_LEASE_TIME, is thought to have never started.
+    """
+    node = job.get('node', ENV['FIXIE_NODE'])
+    if node is None:
+        # job is waiting on the shared queue for a worker
+        return ''
+    elif job.get('pid') is None:
+        launched = job.get('launch_time', job.get('queue_starttime'))
+        if launched is None:
+            return ''
+        age = time.time() - launched
+        if age <= ENV['FIXIE_LEASE_TIME']:
+            return ''
+        msg = 'Runner launched on node {0} has not started in {1:.0f} seconds'
+        return msg.format(node, age)
+    elif node == ENV['FIXIE_NODE']:
+        if is_alive(job['pid'], job.get('pid_starttime')):
+            return ''
+        return 'Runner process {0} on node {1} died'.format(job['pid'], node)
+    try:
+        age = time.time() - os.stat(jobfile).st_mtime
+    except FileNotFoundError:
+        return ''
+    if age <= ENV['FIXIE_LEASE_TIME']:
+        return ''
+    msg = 'Runner on node {0} has not been heard from in {1:.0f} seconds'
+    return msg.format(node, age)
+
+
+def _load(jobfile):
+    try:
+        with open(jobfile) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        # job moved or is being written, it is not dead
+        return None
+
+
+def _relaunch(jobid, job):
+    """Starts a new local runner for a job that is on the queue. The launch is
+    recorded in the jobfile first, so that the next reap waits for the new
+    runner to start, and so that any older runner that starts late sees that
+    it has been replaced.
+    """
+    jobfile = _jobfile('queued', jobid)
+    job.update({'node': ENV['FIXIE_NODE'], 'pid': None, 'launch_time': time.time()})
+    if not os.path.exists(jobfile):
+        return False
+    _dump_job(job, jobfile)
+    cmd = [sys.executable, '-c', runner_script(jobid, job=job)]
+    detached_call(cmd)
+    return True
+
+
+def reap_post():
+    """Finds jobs whose runner process on this node died while they waited
+    for, or ran, post-processing. Their entries are removed from
+    $FIXIE_POST_DIR, so that they no longer take up post-processing slots,
+    and their post-processing is marked as failed. Returns the jobids.
+    """
+    reaped = []
+    for e in os.scandir(ENV['FIXIE_POST_DIR']):
+        if not e.name.endswith(('.json', '.running')):
+            continue
+        entry = _load(e.path)
+        if entry is None or entry.get('node') != ENV['FIXIE_NODE']:
+            continue
+        elif is_alive(entry['pid'], entry.get('pid_starttime')):
+            continue
+        try:
+            os.remove(e.path)
+        except FileNotFoundError:
+            continue
+        jobid = entry['jobid']
+        jobfile = _jobfile('completed', jobid)
+        job = _load(jobfile)
+        if job is None:
+            continue
+        msg = 'Runner process {0} on node {1} died during post-processing'
+        job.update({'post_status': 'failed',
+                    'post_err': msg.format(entry['pid'], entry['node'])})
+        _dump_job(job, jobfile)
+        _record_transition(job, 'completed', reason='reaped')
+        reaped.append(jobid)
+    return reaped
+
+
+def reap(retries=None):
+    """Finds jobs whose runner process has died. Queued jobs on this node get
+    a new runner. Running jobs are put back on the queue if they have been
+    reaped fewer than ``retries`` times, and are moved to the failed
+    directory otherwise. Jobs whose runner died during post-processing are
+    reaped as well, see ``reap_post()``.
+
+    Parameters
+    ----------
+    retries : int or None, optional
+        Number of times a job may be requeued, defaults to $FIXIE_REAP_RETRIES.
+
+    Returns
+    -------
+    failed : list of int
+        Jobids that were moved to the failed directory.
+    requeued : list of int
+        Jobids that were put back on the queue, or given a new runner.
+    """
+    retries = ENV['FIXIE_REAP_RETRIES'] if retries is None else retries
+    shared = ENV['FIXIE_SHARED_QUEUE']
+    failed, requeued = [], []
+    # queued jobs only have runners when they were spawned on this node
+    for jobid in sorted(queued_ids()):
+        jobfile = _jobfile('queued', jobid)
+        job = _load(jobfile)
+        if job is None or job.get('node') != ENV['FIXIE_NODE']:
+            continue
+        if not _death_reason(job, jobfile):
+            continue
+        if _relaunch(jobid, job):
+            requeued.append(jobid)
+    for jobid in sorted(running_ids()):
+        jobfile = _jobfile('running', jobid)
+        job = _load(jobfile)
+        if job is None:
+            continue
+        reason = _death_reason(job, jobfile)
+        if not reason:
+            continue
+        if job.get('node') == ENV['FIXIE_NODE']:
+            # the simulation may have outlived its runner
+            _kill_group(job.get('pgid'), job.get('pgid_starttime'))
+        now = time.time()
+        attempts = job.setdefault('attempts', [])
+        attempts.append({'node': job.get('node'),
+                         'pid': job.get('pid'),
+                         'starttime': job.get('queue_endtime'),
+                         'endtime': now,
+                         'returncode': None,
+                         'err': reason})
+        # attempts that ended with a returncode count against the job's own
+        # retry policy instead
+        reaped = [a for a in attempts if a['returncode'] is None]
+        if len(reaped) <= retries:
+            for key in ('pid_starttime', 'pgid', 'pgid_starttime', 'queue_endtime'):
+                job.pop(key, None)
+            job['node'] = None if shared else ENV['FIXIE_NODE']
+            job['pid'] = None
+            _dump_job(job, jobfile)
+            try:
+                os.rename(jobfile, _jobfile('queued', jobid))
+            except FileNotFoundError:
+                continue
+            _record_transition(job, 'queued', reason='reaped')
+            if not shared:
+                _relaunch(jobid, job)
+            requeued.append(jobid)
+        else:
+            job.update({'returncode': 1,
+                        'endtime': now,
+                        'out': None,
+                        'err': reason})
+            dest = _jobfile('failed', jobid)
+            try:
+                os.rename(jobfile, dest)
+            except FileNotFoundError:
+                continue
+            _dump_job(job, dest)
+            _record_transition(job, 'failed', reason='reaped')
+            failed.append(jobid)
+    reap_post()
+    return failed, requeued
+
+
+def main(args=None):
+    """Reaps dead jobs once, from the command line."""
+    failed, requeued = reap()
+    print('failed: ' + ', '.join(map(str, failed)))
+    print('requeued: ' + ', '.join(map(str, requeued)))
+
+
+if __name__ == '__main__':
+    main()
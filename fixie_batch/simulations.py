@@ -4,106 +4,432 @@ is stored on the file system. These tools should be robust to the server or othe
 managing process going down.
 """
 import os
+import sys
 import json
+import math
 import time
 import signal
 from collections.abc import Mapping, Set
 
-from pprintpp import pformat
 from lazyasd import lazyobject
-from fixie import (ENV, verify_user, next_jobid, detached_call,
-    register_job_alias, jobids_from_alias, jobids_with_name, default_path)
+from fixie import ENV, next_jobid, detached_call, default_path
 
 from fixie_batch.environ import QUEUE_STATUSES
+from fixie_batch.holds import add_hold, remove_hold
+from fixie_batch.transitions import record_transition, node_transitions_file
+from fixie_batch.cache import (verify_user, register_job_alias,
+    jobids_from_alias, jobids_with_name)
+from fixie_batch.notify import ensure_notify, queue_notifications
+from fixie_batch.post import ensure_post, import_stages
+from fixie_batch.tools import TERMINAL_STATUSES, process_starttime, atomic_write
 
 
-SPAWN_XSH = """#!/usr/bin/env xonsh
+SPAWN_PY = """#!/usr/bin/env python
 import os
+import sys
 import json
 import time
+import signal
+import tempfile
+import subprocess
 
+from fixie_batch.holds import (held_ids, add_hold, load_hold, remove_hold,
+    resolve_hold)
+from fixie_batch.transitions import record_transition
+from fixie_batch.notify import queue_notifications
+from fixie_batch.tools import (TERMINAL_STATUSES, process_starttime,
+    pending_path_file, atomic_write)
 
-def queued_ids():
-    # sorted jobids that are in the queue
-    qids = [int(j.name[:-5]) for j in os.scandir('{{FIXIE_QUEUED_JOBS_DIR}}')]
-    qids.sort()
-    return qids
+HELD_DIR = '{{FIXIE_HELD_JOBS_DIR}}'
+PATHS_DIR = '{{FIXIE_PATHS_DIR}}'
+OUTBOX_DIR = '{{FIXIE_OUTBOX_DIR}}'
+TRANSITIONS = '{{FIXIE_NODE_TRANSITIONS_FILE}}'
+QUEUED = '{{FIXIE_QUEUED_JOBS_DIR}}/{{jobid}}.json'
+RUNNING = '{{FIXIE_RUNNING_JOBS_DIR}}/{{jobid}}.json'
+CANCELED = '{{FIXIE_CANCELED_JOBS_DIR}}/{{jobid}}.json'
+POST_DIR = '{{FIXIE_POST_DIR}}'
+POST_PENDING = POST_DIR + '/{{jobid}}.json'
+TERMINAL_DIRS = {
+    'completed': '{{FIXIE_COMPLETED_JOBS_DIR}}',
+    'failed': '{{FIXIE_FAILED_JOBS_DIR}}',
+    'canceled': '{{FIXIE_CANCELED_JOBS_DIR}}',
+    }
 
 
-# variables from calling process
-simulation = {{simulation}}
-
-# derived variables
-out = '{{FIXIE_SIMS_DIR}}/{{jobid}}.h5'
-inp = json.dumps(simulation, sort_keys=True)
-
-# make a jobs file and add it to the queue
-job = {
-    'interactive': {{interactive}},
-    'jobid': {{jobid}},
-    'notify': {{notify}},
-    'outfile': out,
-    'path': '{{path}}',
-    'pid': os.getpid(),
-    'permissions': {{permissions}},
-    'post': {{post}},
-    'project': '{{project}}',
-    'queue_starttime': time.time(),
-    'simulation': simulation,
-    'user': '{{user}}',
-    }
-with open('{{FIXIE_QUEUED_JOBS_DIR}}/{{jobid}}.json', 'w') as f:
-    json.dump(job, f, sort_keys=True, indent=1)
-
-# wait for the queue to be free, and then move the jobs file
-qids = queued_ids()
-while {{jobid}} not in qids[:{{FIXIE_NJOBS}}]:
-    if {{jobid}} not in qids:
-        # job cancels itself if it isn't in the queue at all!
-        err = 'Job canceled itself after jobfile was removed from queue'
+def status_ids(d):
+    # sorted jobids that are in a status directory
+    ids = [int(j.name[:-5]) for j in os.scandir(d) if j.name.endswith('.json')]
+    ids.sort()
+    return ids
+
+
+def dump_job(job, jobfile):
+    # atomically write the job file, so that readers never see partial jobs.
+    # The temporary file lives beside the status directory, not inside of it.
+    with atomic_write(jobfile, tmpdir=os.path.dirname(os.path.dirname(jobfile))) as f:
+        json.dump(job, f, sort_keys=True, indent=1)
+
+
+def transition(job, status, **kwargs):
+    # record that the job has moved to a new status, and leave notifications
+    # in the outbox for the server to deliver.
+    record_transition(TRANSITIONS, {{jobid}}, status, user=job['user'],
+                      project=job['project'], node=job.get('node'), **kwargs)
+    if status in TERMINAL_STATUSES and job.get('notify'):
+        queue_notifications(OUTBOX_DIR, job, status)
+
+
+def cancel_self(job):
+    # job cancels itself if it isn't in the queue at all! If it was canceled
+    # externally, the canceled jobfile has already been written.
+    err = 'Job canceled itself after jobfile was removed from queue'
+    remove_hold(HELD_DIR, {{jobid}})
+    if not os.path.exists(CANCELED):
         job.update({'returncode': 1,
                     'out': None,
                     'err': err,
                     'queue_endtime': time.time()})
-        with open('{{FIXIE_CANCELED_JOBS_DIR}}/{{jobid}}.json', 'w') as f:
-            json.dump(job, f, sort_keys=True, indent=1)
-        import sys
-        sys.exit(err)
-    time.sleep(0.1)
-    qids = queued_ids()
-job['queue_endtime'] = time.time()
-os.remove('{{FIXIE_QUEUED_JOBS_DIR}}/{{jobid}}.json')
-with open('{{FIXIE_RUNNING_JOBS_DIR}}/{{jobid}}.json', 'w') as f:
-    json.dump(job, f, sort_keys=True, indent=1)
-
-# make a pending path file, to signal that a path is available.
-pending_path = {
-    'file': out,
-    'holding': {{FIXIE_HOLDING_TIME}},
-    'jobid': {{jobid}},
-    'path': '{{path}}',
-    'project': '{{project}}',
-    'user': '{{user}}',
-    }
-with open('{{FIXIE_PATHS_DIR}}/{{user}}-{{jobid}}-pending-path.json', 'w') as f:
-    json.dump(pending_path, f, sort_keys=True, indent=1)
+        dump_job(job, CANCELED)
+        transition(job, 'canceled')
+    sys.exit(err)
+
+
+def cancel_dependent(job, err):
+    # job cancels itself when a job that it runs after did not end as needed.
+    # This in turn cancels the jobs that run after this one.
+    try:
+        os.rename(QUEUED, CANCELED)
+    except FileNotFoundError:
+        sys.exit('Job was canceled externally')
+    remove_hold(HELD_DIR, {{jobid}})
+    job.update({'returncode': 1,
+                'out': None,
+                'err': err,
+                'queue_endtime': time.time()})
+    dump_job(job, CANCELED)
+    transition(job, 'canceled')
+    sys.exit(err)
+
+
+def wait_for_hold(job):
+    # wait until our own hold, if any, may be released
+    while True:
+        hold = load_hold(HELD_DIR, {{jobid}})
+        if hold is None:
+            return
+        if not os.path.exists(QUEUED):
+            cancel_self(job)
+        release, reason = resolve_hold(hold, TERMINAL_DIRS)
+        if reason:
+            cancel_dependent(job, reason)
+        elif release:
+            remove_hold(HELD_DIR, {{jobid}})
+            return
+        time.sleep(0.5 if hold.get('after') else 0.1)
+
+
+def wait_for_slot(job):
+    # wait for a free slot on this node, and then claim the job. The queue must
+    # be listed before the running jobs, so that a job which is claimed in
+    # between the two listings is counted as running, rather than not at all.
+    # Held jobs are not runnable, so they do not take up a place in line.
+    while True:
+        qids = status_ids('{{FIXIE_QUEUED_JOBS_DIR}}')
+        held = held_ids(HELD_DIR)
+        nrunning = len(status_ids('{{FIXIE_RUNNING_JOBS_DIR}}'))
+        if {{jobid}} not in qids:
+            cancel_self(job)
+        runnable = [q for q in qids if q not in held]
+        if {{jobid}} in runnable[:max(0, {{FIXIE_NJOBS}} - nrunning)]:
+            try:
+                os.rename(QUEUED, RUNNING)
+            except FileNotFoundError:
+                cancel_self(job)
+            return
+        time.sleep(0.1)
+
+
+CHILD = None
+# what allocation failures look like on stderr, under a memory limit
+MEMORY_ERRORS = ('bad_alloc', 'MemoryError', 'Cannot allocate memory',
+                 'out of memory')
+
+
+def kill_group(proc, grace=5.0):
+    # kill the whole process group of the simulation, not only its leader,
+    # so that nothing that cyclus started is left holding the slot.
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=grace)
+    except ProcessLookupError:
+        pass
+    except subprocess.TimeoutExpired:
+        pass
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+
+def terminate(signum, frame):
+    # the runner was asked to stop, e.g. by cancel(), take the simulation down too
+    if CHILD is not None:
+        kill_group(CHILD)
+    sys.exit('Runner was terminated by signal {0}'.format(signum))
+
+
+signal.signal(signal.SIGTERM, terminate)
+
+
+def set_limits(limits):
+    # returns a function that applies the resource limits in the simulation
+    # process, before cyclus starts
+    def preexec():
+        import resource
+        if limits.get('memory'):
+            resource.setrlimit(resource.RLIMIT_AS, (limits['memory'], limits['memory']))
+        if limits.get('cputime'):
+            soft = int(limits['cputime']) + 1
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, soft + 5))
+    return preexec
+
+
+def run(job):
+    # run cyclus itself, in its own process group and with its resource limits.
+    # While cyclus runs, we watch for the jobfile leaving the running directory,
+    # since jobs on other nodes are canceled this way, and for the wall-clock
+    # time limit to expire. We also touch the jobfile periodically, so other
+    # nodes can tell we are alive.
+    global CHILD
+    limits = job.get('limits') or {}
+    job.pop('limit_exceeded', None)
+    inp = json.dumps(job['simulation'], sort_keys=True)
+    with tempfile.TemporaryFile('w+') as fout, tempfile.TemporaryFile('w+') as ferr:
+        try:
+            proc = subprocess.Popen(['cyclus', '-f', 'json', '-o', job['outfile'], inp],
+                                    stdout=fout, stderr=ferr, universal_newlines=True,
+                                    start_new_session=True,
+                                    preexec_fn=set_limits(limits))
+        except OSError as e:
+            return 127, None, str(e)
+        CHILD = proc
+        job['pgid'] = proc.pid
+        job['pgid_starttime'] = process_starttime(proc.pid)
+        if os.path.exists(RUNNING):
+            dump_job(job, RUNNING)
+        starttime = heartbeat = time.time()
+        walltime = limits.get('walltime')
+        while proc.poll() is None:
+            if not os.path.exists(RUNNING):
+                kill_group(proc)
+                sys.exit('Job was canceled externally')
+            if walltime is not None and time.time() - starttime > walltime:
+                job['limit_exceeded'] = 'walltime'
+                kill_group(proc)
+                break
+            if time.time() - heartbeat > {{FIXIE_LEASE_TIME}} / 4:
+                heartbeat = time.time()
+                try:
+                    os.utime(RUNNING)
+                except FileNotFoundError:
+                    pass
+            time.sleep(0.1)
+        CHILD = None
+        fout.seek(0)
+        ferr.seek(0)
+        out, err = fout.read(), ferr.read()
+        if (limits.get('cputime') and not job.get('limit_exceeded') and
+                proc.returncode in (-signal.SIGXCPU, -signal.SIGKILL)):
+            # cyclus gets SIGXCPU at the soft limit, and is killed at the hard
+            # limit if it ignores that
+            job['limit_exceeded'] = 'cputime'
+        elif (limits.get('memory') and proc.returncode != 0 and
+                not job.get('limit_exceeded') and
+                any(e in err for e in MEMORY_ERRORS)):
+            # cyclus has no way of telling that it ran out of memory, other
+            # than dying with an allocation error
+            job['limit_exceeded'] = 'memory'
+        if job.get('limit_exceeded'):
+            msg = 'Job exceeded its {0} limit of {1}'.format(job['limit_exceeded'],
+                                                             limits[job['limit_exceeded']])
+            err = msg + '\\n' + err if err else msg
+        return proc.returncode, out, err
+
+
+def retry_delay(job, returncode):
+    # seconds to wait before retrying the job, or None if it should not be
+    retry = job.get('retry')
+    if not retry or returncode == 0 or job.get('limit_exceeded'):
+        # jobs that exceeded their limits would only do so again
+        return None
+    # attempts that the reaper recorded, with no returncode, count against
+    # $FIXIE_REAP_RETRIES instead
+    n = len([a for a in job['attempts'] if a['returncode'] is not None])
+    if n >= retry['max_attempts']:
+        return None
+    elif returncode < 0 and -returncode not in retry['signals']:
+        return None
+    elif returncode > 0 and returncode not in retry['returncodes']:
+        return None
+    return min(retry['backoff'] * retry['factor']**(n - 1), retry['max_backoff'])
+
+
+def wait_for_post_slot():
+    # wait for a free slot in the post-processing pool. Jobs wait in line as
+    # pending entries, and the first ones in line claim a slot by linking their
+    # entry to the slot's file, which fails if the slot is taken. Returns the
+    # path to the slot, which must be removed to free it.
+    while True:
+        pending = sorted(int(e.name[:-5]) for e in os.scandir(POST_DIR)
+                         if e.name.endswith('.json'))
+        if {{jobid}} in pending[:{{FIXIE_POST_NJOBS}}]:
+            for i in range({{FIXIE_POST_NJOBS}}):
+                slot = POST_DIR + '/slot-{0}.running'.format(i)
+                try:
+                    os.link(POST_PENDING, slot)
+                except FileExistsError:
+                    continue
+                os.remove(POST_PENDING)
+                return slot
+        time.sleep(0.1)
 
-# run cyclus itself
-with ${...}.swap(RAISE_SUBPROC_ERROR=False):
-    proc = !(cyclus -f json -o @(out) @(inp))
+
+def postprocess(job, jobfile):
+    # run the post-processing stages of a completed job. The job has already
+    # left the running directory, so waiting here holds up no simulations.
+    from fixie_batch.post import import_stages, run_stages
+    import_stages({{FIXIE_POST_MODULES}})
+    dump_job({'jobid': {{jobid}}, 'node': job['node'], 'pid': job['pid'],
+              'pid_starttime': job['pid_starttime']}, POST_PENDING)
+    slot = wait_for_post_slot()
+    job['post_status'] = 'running'
+    dump_job(job, jobfile)
+    outfile = job['outfile']
+    job['post_results'], ok = run_stages(job, job['post'])
+    job['post_status'] = 'completed' if ok else 'failed'
+    dump_job(job, jobfile)
+    os.remove(slot)
+    ppf = pending_path_file(PATHS_DIR, job['user'], {{jobid}})
+    if job['outfile'] != outfile and os.path.exists(ppf):
+        # a stage replaced the output file, so point the path at the new one
+        with open(ppf) as f:
+            pending_path = json.load(f)
+        pending_path['file'] = job['outfile']
+        dump_job(pending_path, ppf)
+
+{% if claimed %}
+# the job was already claimed from the shared queue by a worker on this node,
+# but may have been canceled before this script started
+try:
+    with open(RUNNING) as f:
+        job = json.load(f)
+except FileNotFoundError:
+    sys.exit('Job was canceled externally')
+{% else %}
+# variables from calling process
+job = {{job}}
+job['pid'] = os.getpid()
+job['pid_starttime'] = process_starttime(job['pid'])
+
+# the calling process already added the jobs file to the queue, record our pid
+try:
+    with open(QUEUED) as f:
+        queued = json.load(f)
+except FileNotFoundError:
+    cancel_self(job)
+if queued.get('launch_time') != job.get('launch_time'):
+    # the reaper gave up on us starting, and launched another runner
+    sys.exit('Job was relaunched by another runner')
+dump_job(job, QUEUED)
+{% endif %}
+while True:
+{%- if not claimed %}
+    wait_for_hold(job)
+    wait_for_slot(job)
+{%- endif %}
+    job.update({
+        'node': '{{FIXIE_NODE}}',
+        'pid': os.getpid(),
+        'pid_starttime': process_starttime(os.getpid()),
+        'queue_endtime': time.time(),
+        })
+    dump_job(job, RUNNING)
+    transition(job, 'running')
+
+    # make a pending path file, to signal that a path is available.
+    pending_path = {
+        'file': job['outfile'],
+        'holding': {{FIXIE_HOLDING_TIME}},
+        'jobid': {{jobid}},
+        'path': job['path'],
+        'project': job['project'],
+        'user': job['user'],
+        }
+    dump_job(pending_path, pending_path_file(PATHS_DIR, job['user'], {{jobid}}))
+
+    # run the simulation, and record the attempt
+    starttime = time.time()
+    returncode, pout, perr = run(job)
+    endtime = time.time()
+    job.setdefault('attempts', []).append({
+        'node': job['node'],
+        'pid': job['pid'],
+        'starttime': starttime,
+        'endtime': endtime,
+        'returncode': returncode,
+        'err': perr[-1000:] if perr else perr,
+        })
+    delay = retry_delay(job, returncode)
+    if delay is None:
+        break
+
+    # put the job back on the queue, with a hold that keeps it from running
+    # until it has backed off. This frees up the slot in the meantime.
+    add_hold(HELD_DIR, {{jobid}}, until=endtime + delay, reason='retry')
+{%- if claimed %}
+    job.update({'node': None, 'pid': None, 'retry_time': endtime + delay})
+{%- else %}
+    job['retry_time'] = endtime + delay
+{%- endif %}
+    dump_job(job, RUNNING)
+    try:
+        os.rename(RUNNING, QUEUED)
+    except FileNotFoundError:
+        remove_hold(HELD_DIR, {{jobid}})
+        sys.exit('Job was canceled externally')
+    transition(job, 'queued', reason='retry')
+{%- if claimed %}
+    # a worker will pick the job up again once the hold has expired
+    sys.exit(0)
+{%- endif %}
 
 # update and swap job file
 job.update({
-    'returncode': proc.returncode,
-    'starttime': proc.starttime,
-    'endtime': proc.endtime,
-    'out': proc.out,
-    'err': proc.err,
+    'returncode': returncode,
+    'starttime': starttime,
+    'endtime': endtime,
+    'out': pout,
+    'err': perr,
     })
-jobdir = '{{FIXIE_COMPLETED_JOBS_DIR}}' if proc else '{{FIXIE_FAILED_JOBS_DIR}}'
-os.remove('{{FIXIE_RUNNING_JOBS_DIR}}/{{jobid}}.json')
-with open(jobdir + '/{{jobid}}.json', 'w') as f:
-    json.dump(job, f, sort_keys=True, indent=1)
+status = 'completed' if returncode == 0 else 'failed'
+post = status == 'completed' and job.get('post')
+if post:
+    job['post_status'] = 'pending'
+jobdir = '{{FIXIE_COMPLETED_JOBS_DIR}}' if returncode == 0 else '{{FIXIE_FAILED_JOBS_DIR}}'
+jobfile = jobdir + '/{{jobid}}.json'
+# the job must never be seen in its new status without its post_status
+if os.path.exists(RUNNING):
+    dump_job(job, RUNNING)
+try:
+    os.rename(RUNNING, jobfile)
+except FileNotFoundError:
+    sys.exit('Job was canceled externally')
+if post:
+    # the transition waits for post-processing, so that watchers and
+    # notifications see the results
+    postprocess(job, jobfile)
+transition(job, status)
 """
 
 
@@ -111,12 +437,188 @@ with open(jobdir + '/{{jobid}}.json', 'w') as f:
 def SPAWN_TEMPLATE():
     """A jinja template for spawning simulations."""
     from jinja2 import Template
-    return Template(SPAWN_XSH)
+    return Template(SPAWN_PY)
+
+
+def _jobfile(status, jobid):
+    """Returns the path to a jobfile in a status directory."""
+    d = ENV['FIXIE_{0}_JOBS_DIR'.format(status.upper())]
+    return os.path.join(d, str(jobid) + '.json')
+
+
+def _dump_job(job, jobfile):
+    """Atomically writes a job to a jobfile, so that readers on any node never
+    see a partially written job. The temporary file is written beside the
+    status directory, so that it is never listed as a job itself.
+    """
+    with atomic_write(jobfile, tmpdir=os.path.dirname(os.path.dirname(jobfile))) as f:
+        json.dump(job, f, sort_keys=True, indent=1)
+
+
+def _node_transitions_file():
+    """Returns the path to the transitions file of this node."""
+    return node_transitions_file(ENV['FIXIE_NODE_TRANSITIONS_DIR'],
+                                 ENV['FIXIE_NODE'])
+
+
+def _record_transition(job, status, **kwargs):
+    """Records that a job has moved to a new status, and queues any
+    notifications about it. The server merges the transition into the journal.
+    """
+    record_transition(_node_transitions_file(), job['jobid'], status,
+                      user=job['user'], project=job['project'],
+                      node=job.get('node'), **kwargs)
+    if status in TERMINAL_STATUSES and job.get('notify'):
+        queue_notifications(ENV['FIXIE_OUTBOX_DIR'], job, status)
+
+
+def runner_script(jobid, job=None):
+    """Renders the script that runs a job. If a job dict is given, the job
+    must already be in the queue, and the script waits for a free slot on this
+    node. Otherwise, the job must already have been claimed (see ``claim()``)
+    and the script runs it right away.
+    """
+    from pprintpp import pformat
+    holding = "'inf'" if ENV['FIXIE_HOLDING_TIME'] == float('inf') \
+                      else ENV['FIXIE_HOLDING_TIME']
+    ctx = dict(
+            FIXIE_CANCELED_JOBS_DIR=ENV['FIXIE_CANCELED_JOBS_DIR'],
+            FIXIE_COMPLETED_JOBS_DIR=ENV['FIXIE_COMPLETED_JOBS_DIR'],
+            FIXIE_FAILED_JOBS_DIR=ENV['FIXIE_FAILED_JOBS_DIR'],
+            FIXIE_HELD_JOBS_DIR=ENV['FIXIE_HELD_JOBS_DIR'],
+            FIXIE_HOLDING_TIME=holding,
+            FIXIE_LEASE_TIME=ENV['FIXIE_LEASE_TIME'],
+            FIXIE_NJOBS=ENV['FIXIE_NJOBS'],
+            FIXIE_NODE=ENV['FIXIE_NODE'],
+            FIXIE_OUTBOX_DIR=ENV['FIXIE_OUTBOX_DIR'],
+            FIXIE_PATHS_DIR=ENV['FIXIE_PATHS_DIR'],
+            FIXIE_POST_DIR=ENV['FIXIE_POST_DIR'],
+            FIXIE_POST_MODULES=repr(sorted(ENV['FIXIE_POST_MODULES'])),
+            FIXIE_POST_NJOBS=ENV['FIXIE_POST_NJOBS'],
+            FIXIE_QUEUED_JOBS_DIR=ENV['FIXIE_QUEUED_JOBS_DIR'],
+            FIXIE_RUNNING_JOBS_DIR=ENV['FIXIE_RUNNING_JOBS_DIR'],
+            FIXIE_NODE_TRANSITIONS_FILE=_node_transitions_file(),
+            claimed=job is None,
+            job=pformat(job),
+            jobid=jobid,
+            )
+    return SPAWN_TEMPLATE.render(ctx)
+
+
+def claim(jobid):
+    """Claims a queued job for this node by atomically moving its jobfile
+    from the queued to the running directory. Returns whether the claim
+    succeeded. Only one node may successfully claim any job, even when the
+    status directories are shared over NFS.
+    """
+    try:
+        os.rename(_jobfile('queued', jobid), _jobfile('running', jobid))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+DEFAULT_RETRY = {
+    'max_attempts': 3,
+    'backoff': 60.0,
+    'factor': 2.0,
+    'max_backoff': 3600.0,
+    'returncodes': [],
+    'signals': ['SIGKILL'],
+    }
+
+
+def _ensure_retry(retry):
+    """Returns a retry policy with defaults filled in and signals converted to
+    numbers, AND an error message. On failure, the policy will be None.
+    """
+    if retry is None:
+        return None, ''
+    elif not isinstance(retry, Mapping):
+        return None, 'retry policy must be a dict, got ' + repr(retry)
+    unknown = set(retry) - set(DEFAULT_RETRY)
+    if unknown:
+        return None, 'unknown retry policy keys: ' + ', '.join(sorted(unknown))
+    policy = dict(DEFAULT_RETRY)
+    policy.update(retry)
+    if not isinstance(policy['max_attempts'], int) or policy['max_attempts'] < 1:
+        return None, 'max_attempts must be a positive integer'
+    for key in ('backoff', 'factor', 'max_backoff'):
+        if not isinstance(policy[key], (int, float)) or policy[key] < 0:
+            return None, key + ' must be a non-negative number'
+    for rc in policy['returncodes']:
+        if not isinstance(rc, int) or rc <= 0:
+            return None, 'retryable return codes must be positive integers'
+    signals = []
+    for sig in policy['signals']:
+        try:
+            signals.append(int(signal.Signals[sig] if isinstance(sig, str)
+                               else signal.Signals(sig)))
+        except (KeyError, ValueError):
+            return None, '{0!r} is not a valid signal'.format(sig)
+    policy['signals'] = signals
+    return policy, ''
+
+
+LIMITS = frozenset(['walltime', 'cputime', 'memory'])
+
+
+def _ensure_limits(limits):
+    """Returns a dict of resource limits, AND an error message. On failure,
+    the limits will be None.
+    """
+    if limits is None:
+        return None, ''
+    elif not isinstance(limits, Mapping):
+        return None, 'limits must be a dict, got ' + repr(limits)
+    unknown = set(limits) - LIMITS
+    if unknown:
+        return None, 'unknown limits: ' + ', '.join(sorted(unknown))
+    for key, value in limits.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+                value <= 0 or not math.isfinite(value):
+            return None, key + ' limit must be a positive, finite number'
+    if 'memory' in limits and not isinstance(limits['memory'], int):
+        return None, 'memory limit must be an integer number of bytes'
+    return dict(limits), ''
+
+
+AFTER_CONDITIONS = frozenset(['success', 'any'])
+
+
+def _ensure_after(after, user, project=''):
+    """Returns a list of dicts with the 'jobid' and 'condition' of each job
+    that a job runs after, AND an error message. On failure, the list will
+    be None. Job names are resolved to the most recent job of the user with
+    that name.
+    """
+    deps = []
+    for dep in after:
+        if isinstance(dep, Mapping):
+            job = dep.get('job')
+            condition = dep.get('condition', 'success')
+        else:
+            job, condition = dep, 'success'
+        if condition not in AFTER_CONDITIONS:
+            return None, '{0!r} is not a valid condition'.format(condition)
+        if isinstance(job, str):
+            jobids = jobids_from_alias(user, job, project=project)
+            if not jobids:
+                return None, 'No job found with the name {0!r}'.format(job)
+            jobid = max(jobids)
+        elif isinstance(job, int):
+            jobid = job
+        else:
+            return None, 'type of job not reconized: {0} {1}'.format(job, type(job))
+        if _load_job(jobid, 'queued')[0] is None:
+            return None, 'Job {0} could not be found'.format(jobid)
+        deps.append({'jobid': jobid, 'condition': condition})
+    return deps, ''
 
 
 def spawn(simulation, user, token, name='', project='', path='',
           permissions='public', post=(), notify=(), interactive=False,
-          return_pid=False):
+          retry=None, after=(), limits=None, admission=False, return_pid=False):
     """Spawning simulations let’s the batch execution service know to run a
     simulation as soon as possible.
 
@@ -140,11 +642,58 @@ def spawn(simulation, user, token, name='', project='', path='',
         "public" (default), "private", or a list of users. Currently only
         public permissions are supported.
     post : list, optional
-        Any post processing activities, not currently supported
+        Post-processing steps to run, in order, after the simulation completes
+        successfully. Each is a stage name or a dict with a 'stage' key and
+        the stage's keyword arguments, see ``fixie_batch.post``. Steps run in
+        their own pool of $FIXIE_POST_NJOBS slots, and their results are
+        recorded in the job's 'post_results'.
     notify : list, optional
-        Any notifications to register, not currently supported
+        Targets to notify when the job completes, fails, or is canceled. Each
+        is a URL string or a dict with a 'url' and the 'statuses' to notify
+        about. URLs may be http(s) webhooks, 'unix://' socket paths, or
+        'file://' directories, see ``fixie_batch.notify``. Sockets and
+        directories must be inside one of the $FIXIE_NOTIFY_DIRS. Webhooks
+        must be on one of the $FIXIE_NOTIFY_HOSTS, or, if there are none, on
+        a public address.
     interactive : bool, optional
         True or False (default), not currently supported.
+    retry : dict or None, optional
+        Policy for retrying the simulation when cyclus fails for transient
+        reasons. None (default) never retries. Otherwise, this may have the
+        following keys, see ``DEFAULT_RETRY`` for their defaults:
+
+        * ``max_attempts`` : total number of attempts to run the simulation,
+        * ``backoff`` : seconds to wait before the first retry,
+        * ``factor`` : multiplier of the wait time for each further retry,
+        * ``max_backoff`` : maximum number of seconds to wait,
+        * ``returncodes`` : cyclus return codes that may be retried,
+        * ``signals`` : names or numbers of the signals that killed cyclus
+          that may be retried, e.g. 'SIGKILL' from the out-of-memory killer.
+
+        Every attempt is recorded in the job's 'attempts' list. Attempts
+        whose runner died are recorded by the reaper, with a 'returncode' of
+        None, and count against $FIXIE_REAP_RETRIES rather than this policy.
+    after : list, optional
+        Jobs that must finish before this simulation may run. Each element is
+        a jobid, a job name (the user's most recent job with that name in this
+        project), or a dict with a 'job' key (a jobid or name) and a
+        'condition' key. The condition is either 'success' (default), in which
+        case this job is canceled if the other job fails or is canceled, or
+        'any', in which case this job runs however the other job ended.
+    limits : dict or None, optional
+        Resource limits of the simulation, which may have the following keys:
+
+        * ``walltime`` : seconds that the simulation may run for,
+        * ``cputime`` : seconds of CPU time that the simulation may use,
+        * ``memory`` : bytes of memory that the simulation may allocate.
+
+        Simulations that exceed their limits are killed, along with every
+        process that they started, and are moved to the failed directory with
+        the 'limit_exceeded'. They are not retried.
+    admission : bool, optional
+        Whether the job must be admitted by admission control before it is
+        spawned, see ``fixie_batch.admission``. Default False, the server's
+        handler sets this.
     return_pid : bool, optional
         Whether or not to return the PID of the detached child process.
         Default False, this is mostly for testing.
@@ -158,52 +707,80 @@ def spawn(simulation, user, token, name='', project='', path='',
         Whether run was spawned successfully,
     message : str
         Message about status
-    pid : int, if return_pid is True
-        Child process id.
+    pid : int or None, if return_pid is True
+        Child process id. This is None if $FIXIE_SHARED_QUEUE is True,
+        since the job is then run by a worker, possibly on another node.
+
+    Raises
+    ------
+    fixie_batch.admission.Refused
+        If admission is True and the job was not admitted.
     """
     # validate all inputs
     if not isinstance(simulation, Mapping):
         return -1, False, 'Simulation must be dict (i.e. mapping object) currently.'
     if permissions != 'public':
         return -1, False, 'Non-public permissions are not supported yet.'
-    if post:
-        return -1, False, 'Post-processing activities are not supported yet.'
-    if notify:
-        return -1, False, 'Notifications are not supported yet.'
     if interactive:
         return -1, False, 'Interactive simulation spawning is not supported yet.'
+    import_stages(ENV['FIXIE_POST_MODULES'])
+    post, msg = ensure_post(post)
+    if msg:
+        return -1, False, msg
+    notify, msg = ensure_notify(notify, allowed_dirs=ENV['FIXIE_NOTIFY_DIRS'],
+                                allowed_hosts=ENV['FIXIE_NOTIFY_HOSTS'])
+    if msg:
+        return -1, False, msg
+    retry, msg = _ensure_retry(retry)
+    if msg:
+        return -1, False, msg
+    limits, msg = _ensure_limits(limits)
+    if msg:
+        return -1, False, msg
+    after, msg = _ensure_after(after, user, project=project)
+    if msg:
+        return -1, False, msg
     valid, msg, status = verify_user(user, token)
     if not status or not valid:
         return -1, False, msg
+    if admission:
+        from fixie_batch.admission import Refused, admit
+        admitted, retry_after, msg = admit(user)
+        if not admitted:
+            raise Refused(msg, retry_after)
     # now we can actually spawn the simulation
     jobid = next_jobid()
     path = default_path(path, name=name, project=project, jobid=jobid)
-    holding = "'inf'" if ENV['FIXIE_HOLDING_TIME'] == float('inf') \
-                      else ENV['FIXIE_HOLDING_TIME']
-    ctx = dict(
-            FIXIE_CANCELED_JOBS_DIR=ENV['FIXIE_CANCELED_JOBS_DIR'],
-            FIXIE_COMPLETED_JOBS_DIR=ENV['FIXIE_COMPLETED_JOBS_DIR'],
-            FIXIE_FAILED_JOBS_DIR=ENV['FIXIE_FAILED_JOBS_DIR'],
-            FIXIE_HOLDING_TIME=holding,
-            FIXIE_NJOBS=ENV['FIXIE_NJOBS'],
-            FIXIE_PATHS_DIR=ENV['FIXIE_PATHS_DIR'],
-            FIXIE_QUEUED_JOBS_DIR=ENV['FIXIE_QUEUED_JOBS_DIR'],
-            FIXIE_RUNNING_JOBS_DIR=ENV['FIXIE_RUNNING_JOBS_DIR'],
-            FIXIE_SIMS_DIR=ENV['FIXIE_SIMS_DIR'],
-            interactive=interactive,
-            jobid=jobid,
-            name=name,
-            notify=repr(notify),
-            path=path,
-            permissions=repr(permissions),
-            post=repr(post),
-            project=project,
-            simulation=pformat(simulation),
-            user=user,
-            )
-    script = SPAWN_TEMPLATE.render(ctx)
-    cmd = ['xonsh', '-c', script]
-    pid = detached_call(cmd)
+    shared = ENV['FIXIE_SHARED_QUEUE']
+    job = {
+        'after': after,
+        'interactive': interactive,
+        'jobid': jobid,
+        'limits': limits,
+        'node': None if shared else ENV['FIXIE_NODE'],
+        'notify': notify,
+        'outfile': '{0}/{1}.h5'.format(ENV['FIXIE_SIMS_DIR'], jobid),
+        'path': path,
+        'pid': None,
+        'permissions': permissions,
+        'post': post,
+        'project': project,
+        'queue_starttime': time.time(),
+        'retry': retry,
+        'simulation': simulation,
+        'user': user,
+        }
+    if after:
+        # the hold must be in place before the job reaches the queue
+        add_hold(ENV['FIXIE_HELD_JOBS_DIR'], jobid, after=after, reason='after')
+    _dump_job(job, _jobfile('queued', jobid))
+    _record_transition(job, 'queued')
+    if shared:
+        # workers on any node may claim the job from the shared queue
+        pid = None
+    else:
+        cmd = [sys.executable, '-c', runner_script(jobid, job=job)]
+        pid = detached_call(cmd)
     if name or project:
         register_job_alias(jobid, user, name=name, project=project)
     rtn = (jobid, True, 'Simulation spawned')
@@ -212,21 +789,85 @@ def spawn(simulation, user, token, name='', project='', path='',
     return rtn
 
 
-STATUS_IDS = {}
+def _kill_group(pgid, starttime=None):
+    """Kills the process group of a simulation, if any. The group is left
+    alone if its leader is alive but does not have the given start time,
+    since the id has then been reused. A group whose leader has exited is
+    still killed, since its id is not reused while the group exists.
+    """
+    if pgid is None:
+        return
+    st = process_starttime(pgid)
+    if st is not None and st != starttime:
+        return
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _cancel_queued(jobid, reason):
+    """Cancels a queued job that has no runner of its own, i.e. one on the
+    shared queue. Returns whether the job was canceled.
+    """
+    canceled = _jobfile('canceled', jobid)
+    try:
+        os.rename(_jobfile('queued', jobid), canceled)
+    except FileNotFoundError:
+        return False
+    remove_hold(ENV['FIXIE_HELD_JOBS_DIR'], jobid)
+    with open(canceled) as f:
+        job = json.load(f)
+    job.update({'returncode': 1,
+                'out': None,
+                'err': reason,
+                'queue_endtime': time.time()})
+    _dump_job(job, canceled)
+    _record_transition(job, 'canceled')
+    return True
+
 
-t = """
-def {status}_ids():
-    "Set of {status} jobids."
-    ids = {{int(j.name[:-5]) for j in os.scandir(ENV['FIXIE_{STATUS}_JOBS_DIR'])}}
+def status_ids(status):
+    """Set of jobids with the given status."""
+    d = ENV['FIXIE_{0}_JOBS_DIR'.format(status.upper())]
+    ids = {int(j.name[:-5]) for j in os.scandir(d) if j.name.endswith('.json')}
     return ids
 
 
-STATUS_IDS['{status}'] = {status}_ids
-"""
-g = globals()
-for status in QUEUE_STATUSES:
-    exec(t.format(status=status, STATUS=status.upper()), g)
-del g, t, status
+def completed_ids():
+    "Set of completed jobids."
+    return status_ids('completed')
+
+
+def failed_ids():
+    "Set of failed jobids."
+    return status_ids('failed')
+
+
+def canceled_ids():
+    "Set of canceled jobids."
+    return status_ids('canceled')
+
+
+def running_ids():
+    "Set of running jobids."
+    return status_ids('running')
+
+
+def queued_ids():
+    "Set of queued jobids."
+    return status_ids('queued')
+
+
+STATUS_IDS = {
+    'completed': completed_ids,
+    'failed': failed_ids,
+    'canceled': canceled_ids,
+    'running': running_ids,
+    'queued': queued_ids,
+    }
+# the order in which jobs move through the statuses
+STATUS_ORDER = ('queued', 'running', 'completed', 'failed', 'canceled')
 
 
 def cancel(job, user, token, project=''):
@@ -278,12 +919,10 @@ def cancel(job, user, token, project=''):
     elif len(current) == 0:
         return -1, False, 'No running or queued job found'
     else:
-        jobid = jobids.pop()
+        jobid = current.pop()
     # get the job data, if we can find it
-    base = str(jobid) + '.json'
-    status_dirs = [ENV['FIXIE_QUEUED_JOBS_DIR'], ENV['FIXIE_RUNNING_JOBS_DIR']]
-    for d in status_dirs:
-        jobfile = os.path.join(d, base)
+    for status in ('queued', 'running'):
+        jobfile = _jobfile(status, jobid)
         if os.path.exists(jobfile):
             # can't just do a normal read here, since we may be trying to cancel
             # a job that hasn't been fully written yet.
@@ -295,11 +934,26 @@ def cancel(job, user, token, project=''):
             break
     else:
         return -1, False, 'Job file could not be cound in queue or running.'
-    # kill the job and transfer job to canceled dir
+    # kill the job and transfer job to canceled dir. Only jobs on this node
+    # can be killed directly, jobs running on other nodes notice that their
+    # jobfile has left the running directory and stop themselves.
     if user != data['user']:
         return jobid, False, 'User did not start job, cannot cancel it!'
-    os.kill(data['pid'], signal.SIGTERM)
-    os.remove(jobfile)
+    node = data.get('node', ENV['FIXIE_NODE'])
+    if data.get('pid') is not None and node == ENV['FIXIE_NODE']:
+        # the runner kills the simulation's process group when terminated,
+        # but the group is killed here too, in case the runner is stuck.
+        try:
+            os.kill(data['pid'], signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        _kill_group(data.get('pgid'), data.get('pgid_starttime'))
+    canceled = _jobfile('canceled', jobid)
+    try:
+        os.rename(jobfile, canceled)
+    except FileNotFoundError:
+        return jobid, False, 'Job changed status while being canceled, try again.'
+    remove_hold(ENV['FIXIE_HELD_JOBS_DIR'], jobid)
     if 'queued_endtime' not in data:
         data['queued_endtime'] = time.time()
     if 'starttime' not in data:
@@ -310,9 +964,8 @@ def cancel(job, user, token, project=''):
         'out': None,
         'err': 'Job was canceled externally',
         })
-    jobfile = os.path.join(ENV['FIXIE_CANCELED_JOBS_DIR'], base)
-    with open(jobfile, 'w') as f:
-        json.dump(data, f, sort_keys=True, indent=1)
+    _dump_job(data, canceled)
+    _record_transition(data, 'canceled')
     return jobid, True, 'Job canceled'
 
 
@@ -364,19 +1017,16 @@ def _load_job(jobid, hint):
     """
     t = 'FIXIE_{0}_JOBS_DIR'
     base = str(jobid) + '.json'
-    # first try the hint
-    jobfile = os.path.join(ENV[t.format(hint.upper())], base)
-    if os.path.exists(jobfile):
-        with open(jobfile) as f:
-            job = json.load(f)
-        return job, hint
-    # couldn't find in the hint, search other statuses.
-    for status in QUEUE_STATUSES:
+    # first try the hint, and then search the other statuses, in the order
+    # that jobs move through them. The job may move while we look for it.
+    for status in (hint,) + STATUS_ORDER:
         jobfile = os.path.join(ENV[t.format(status.upper())], base)
-        if os.path.exists(jobfile):
+        try:
             with open(jobfile) as f:
                 job = json.load(f)
-            return job, status
+        except FileNotFoundError:
+            continue
+        return job, status
     else:
         return None, None
 
@@ -419,7 +1069,9 @@ def query(statuses='all', users=None, jobs=None, projects=None):
         return None, False, msg
     sids = set()  # all ids joined together
     ids_to_status = {}  # ids mapped to the status found
-    for status in statuses:
+    # list the statuses in the order that jobs move through them, so that a
+    # job that moves while we list is found in its new status.
+    for status in sorted(statuses, key=STATUS_ORDER.index):
         s = STATUS_IDS[status]()
         sids |= s
         ids_to_status.update({i: status for i in s})
@@ -0,0 +1,304 @@
+"""Manages the simulation outputs in $FIXIE_SIMS_DIR, so that they do not fill
+up the volume. The storage manager removes outputs whose holding time has
+expired, and the oldest outputs of users and projects that exceed their
+quotas. Job records are updated to match, so that ``query()`` reports the
+output as removed, rather than pointing to a missing file. Optionally,
+finished outputs are recompressed in a background process with low CPU and
+I/O priority. The storage manager may be run by hand with::
+
+    $ python -m fixie_batch.storage sweep
+    $ python -m fixie_batch.storage recompress
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import argparse
+import subprocess
+import contextlib
+
+from fixie import ENV, detached_call
+
+from fixie_batch import tools
+from fixie_batch.tools import TERMINAL_STATUSES
+from fixie_batch.simulations import _dump_job
+from fixie_batch.reaper import is_alive
+from fixie_batch.post import gzip_file
+
+
+def pending_path_file(job):
+    """Returns the path to the pending-path file of a job."""
+    return tools.pending_path_file(ENV['FIXIE_PATHS_DIR'], job['user'], job['jobid'])
+
+
+def holding_time(job):
+    """Returns the holding time of a job's output, in seconds, as recorded in
+    its pending-path file, defaulting to $FIXIE_HOLDING_TIME.
+    """
+    try:
+        with open(pending_path_file(job)) as f:
+            return float(json.load(f)['holding'])
+    except (FileNotFoundError, ValueError, KeyError):
+        return float(ENV['FIXIE_HOLDING_TIME'])
+
+
+def outputs():
+    """Returns a list of (jobfile, job, size) tuples for every finished job
+    whose output is still on disk, oldest first. Jobs that are being
+    post-processed are skipped, since their outputs are still in use.
+    """
+    rtn = []
+    for status in TERMINAL_STATUSES:
+        d = ENV['FIXIE_{0}_JOBS_DIR'.format(status.upper())]
+        for e in os.scandir(d):
+            if not e.name.endswith('.json'):
+                continue
+            try:
+                with open(e.path) as f:
+                    job = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            if not job.get('outfile') or job.get('post_status') in ('pending', 'running'):
+                continue
+            try:
+                size = os.path.getsize(job['outfile'])
+            except FileNotFoundError:
+                continue
+            rtn.append((e.path, job, size))
+    rtn.sort(key=lambda x: (_endtime(x[1]), x[1]['jobid']))
+    return rtn
+
+
+def _endtime(job):
+    return job.get('endtime') or job.get('queue_endtime') or job.get('queue_starttime', 0.0)
+
+
+@contextlib.contextmanager
+def _records_lock():
+    """Context manager that holds the lock on rewriting the outfiles of job
+    records, which is shared by the sweeps and the recompress process.
+    """
+    lockfile = os.path.join(ENV['FIXIE_JOBS_DIR'], 'storage.lock')
+    with open(lockfile, 'a') as f:
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(f, fcntl.LOCK_UN)
+
+
+def _reload(jobfile):
+    try:
+        with open(jobfile) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def remove_output(jobfile, job, reason):
+    """Removes a job's output file, and records this in its job record, so that
+    the record stays consistent with the disk. The record is reloaded first,
+    since it may have been pointed at a recompressed output in the meantime.
+    Returns whether the job record was updated.
+    """
+    with _records_lock():
+        job = _reload(jobfile)
+        if job is None or not job.get('outfile'):
+            # the job record moved, or its output is gone already
+            return False
+        outfile = job['outfile']
+        try:
+            os.remove(outfile)
+        except FileNotFoundError:
+            pass
+        try:
+            os.remove(pending_path_file(job))
+        except FileNotFoundError:
+            pass
+        job.update({'outfile': None,
+                    'removed': {'file': outfile, 'reason': reason, 'time': time.time()}})
+        _dump_job(job, jobfile)
+    return True
+
+
+def _over_quota(entries, key, quota):
+    """Yields the entries that must be removed so that the total size of each
+    group of entries (grouped by the job key) fits in the quota, oldest first.
+    """
+    totals = {}
+    for jobfile, job, size in entries:
+        totals[job.get(key)] = totals.get(job.get(key), 0) + size
+    for jobfile, job, size in entries:
+        group = job.get(key)
+        if key == 'project' and not group:
+            # jobs without a project only count against their user's quota
+            continue
+        if totals[group] > quota:
+            totals[group] -= size
+            yield jobfile, job, size
+
+
+def sweep(now=None, user_quota=None, project_quota=None):
+    """Removes outputs whose holding time has expired, and then the oldest
+    outputs of each user and project that is over its quota.
+
+    Parameters
+    ----------
+    now : float or None, optional
+        Current time, defaults to time.time().
+    user_quota : float or None, optional
+        Maximum number of bytes of output per user, defaults to
+        $FIXIE_USER_QUOTA.
+    project_quota : float or None, optional
+        Maximum number of bytes of output per project, defaults to
+        $FIXIE_PROJECT_QUOTA.
+
+    Returns
+    -------
+    removed : dict
+        Maps the jobids whose outputs were removed to the reasons why.
+    """
+    now = time.time() if now is None else now
+    user_quota = ENV['FIXIE_USER_QUOTA'] if user_quota is None else user_quota
+    project_quota = ENV['FIXIE_PROJECT_QUOTA'] if project_quota is None else project_quota
+    removed = {}
+    entries = []
+    for jobfile, job, size in outputs():
+        if now >= _endtime(job) + holding_time(job):
+            if remove_output(jobfile, job, 'holding time expired'):
+                removed[job['jobid']] = 'holding time expired'
+        else:
+            entries.append((jobfile, job, size))
+    for key, quota in (('user', user_quota), ('project', project_quota)):
+        for jobfile, job, size in list(_over_quota(entries, key, quota)):
+            reason = '{0} quota exceeded'.format(key)
+            if remove_output(jobfile, job, reason):
+                removed[job['jobid']] = reason
+            entries.remove((jobfile, job, size))
+    return removed
+
+
+def _lower_priority():
+    """Lowers the CPU and, where ionice is available, the I/O priority of this
+    process to idle.
+    """
+    os.nice(19)
+    ionice = shutil.which('ionice')
+    if ionice is not None:
+        subprocess.call([ionice, '-c', '3', '-p', str(os.getpid())],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def recompress(level=None, min_age=None, now=None):
+    """Gzips the finished outputs that are not compressed yet, and updates
+    their job records to point to the compressed files.
+
+    Parameters
+    ----------
+    level : int or None, optional
+        Compression level, defaults to $FIXIE_RECOMPRESS_LEVEL.
+    min_age : float or None, optional
+        Only outputs of jobs that ended at least this many seconds ago are
+        recompressed, defaults to $FIXIE_RECOMPRESS_AGE.
+    now : float or None, optional
+        Current time, defaults to time.time().
+
+    Returns
+    -------
+    jobids : list of int
+        The jobids whose outputs were recompressed.
+    """
+    level = ENV['FIXIE_RECOMPRESS_LEVEL'] if level is None else level
+    min_age = ENV['FIXIE_RECOMPRESS_AGE'] if min_age is None else min_age
+    now = time.time() if now is None else now
+    jobids = []
+    for jobfile, job, size in outputs():
+        outfile = job['outfile']
+        if outfile.endswith('.gz') or now - _endtime(job) < min_age:
+            continue
+        # the original is kept until the job record points at the compressed
+        # file, so that the output survives whatever happens in between
+        try:
+            gzfile, _ = gzip_file(outfile, level=level, keep=True)
+        except FileNotFoundError:
+            # removed by a sweep in the meantime
+            continue
+        with _records_lock():
+            # reload the job, in case it changed while we were compressing
+            job = _reload(jobfile)
+            if job is None or job.get('outfile') != outfile:
+                os.remove(gzfile)
+                continue
+            job['outfile'] = gzfile
+            job['recompressed'] = {'original_size': size, 'time': time.time()}
+            _dump_job(job, jobfile)
+            try:
+                os.remove(outfile)
+            except FileNotFoundError:
+                pass
+            ppf = pending_path_file(job)
+            if os.path.exists(ppf):
+                with open(ppf) as f:
+                    pending_path = json.load(f)
+                pending_path['file'] = gzfile
+                _dump_job(pending_path, ppf)
+        jobids.append(job['jobid'])
+    return jobids
+
+
+def _recompress_pidfile():
+    return os.path.join(ENV['FIXIE_JOBS_DIR'], 'recompress.json')
+
+
+def start_recompress():
+    """Starts recompressing outputs in a detached background process, unless
+    one is already running. Returns the pid of the process, or None if none
+    was started. The start time of the process is recorded along with its
+    pid, so that an unrelated process that reused the pid is not mistaken
+    for it.
+    """
+    pidfile = _recompress_pidfile()
+    try:
+        with open(pidfile) as f:
+            proc = json.load(f)
+    except (FileNotFoundError, ValueError):
+        proc = None
+    if proc is not None and is_alive(proc['pid'], proc['starttime']):
+        return None
+    cmd = [sys.executable, '-m', 'fixie_batch.storage', 'recompress']
+    pid = detached_call(cmd)
+    with tools.atomic_write(pidfile) as f:
+        json.dump({'pid': pid, 'starttime': tools.process_starttime(pid)}, f,
+                  sort_keys=True)
+    return pid
+
+
+def manage_storage():
+    """Sweeps the outputs, and starts recompressing them in the background if
+    $FIXIE_RECOMPRESS is True. This is run periodically by the server.
+    """
+    sweep()
+    if ENV['FIXIE_RECOMPRESS']:
+        start_recompress()
+
+
+def main(args=None):
+    """Main entry point for the storage manager."""
+    p = argparse.ArgumentParser(description='Manages the fixie batch '
+                                            'simulation outputs.')
+    p.add_argument('action', choices=['sweep', 'recompress'])
+    ns = p.parse_args(args)
+    if ns.action == 'sweep':
+        removed = sweep()
+        for jobid, reason in sorted(removed.items()):
+            print('{0}: {1}'.format(jobid, reason))
+    else:
+        _lower_priority()
+        jobids = recompress()
+        print('recompressed: ' + ', '.join(map(str, jobids)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""Stand-ins for the programs that fixie batch runs, so that the tests and
+the load tests do not need a real cyclus. These are shell scripts, which are
+put first on $PATH.
+"""
+import os
+
+
+STUB_CYCLUS = """#!/bin/sh
+sleep {sleep}
+out=""
+prev=""
+for a; do
+  if [ "$prev" = "-o" ]; then out="$a"; fi
+  prev="$a"
+done
+if [ -n "$out" ]; then : > "$out"; fi
+echo "stub cyclus"
+"""
+
+
+def stub_cyclus(bindir, sleep=0.1):
+    """Writes a stub cyclus executable, which sleeps for the given number of
+    seconds, into a directory. Returns its path.
+    """
+    path = os.path.join(bindir, 'cyclus')
+    with open(path, 'w') as f:
+        f.write(STUB_CYCLUS.format(sleep=sleep))
+    os.chmod(path, 0o755)
+    return path
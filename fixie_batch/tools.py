@@ -0,0 +1,103 @@
+"""Small helpers that are shared by the server, the clients, and the runner
+scripts, which import them before fixie is available, so nothing here may
+depend on anything but the standard library.
+"""
+import os
+import time
+import threading
+import contextlib
+import collections
+
+
+TERMINAL_STATUSES = frozenset(['completed', 'failed', 'canceled'])
+
+
+def process_starttime(pid):
+    """Returns the start time of a process, in clock ticks since boot, or None
+    if this could not be determined. This is used to guard against a pid
+    being reused by an unrelated process.
+    """
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # the command name may contain spaces, so split after it
+    return int(stat.rsplit(')', 1)[1].split()[19])
+
+
+def pending_path_file(paths_dir, user, jobid):
+    """Returns the path to the file that signals that the path to a job's
+    output is available.
+    """
+    return os.path.join(paths_dir, '{0}-{1}-pending-path.json'.format(user, jobid))
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w', tmpdir=None):
+    """Context manager that opens a temporary file for writing, and replaces
+    ``path`` with it once the block exits without error, so that readers
+    never see a partially written file. The temporary file is put in
+    ``tmpdir``, which must be on the same file system as ``path``, and
+    defaults to the directory of ``path``. Readers that scan that directory
+    should skip names starting with a '.'.
+    """
+    d, base = os.path.split(path)
+    tmp = os.path.join(d if tmpdir is None else tmpdir, '.{0}-{1}-{2}.tmp'
+                       .format(os.getpid(), threading.get_ident(), base))
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+class TTLCache(object):
+    """A bounded, least-recently-used cache whose entries expire after a
+    time to live, in seconds. Hits and misses are counted.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns whether the key was found, and its value."""
+        item = self.data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self.data[key]
+            self.misses += 1
+            return False, None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return True, item[1]
+
+    def put(self, key, value):
+        """Adds an entry, evicting the least recently used one if full."""
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def discard(self, key):
+        """Removes an entry, if it is present."""
+        self.data.pop(key, None)
+
+    def clear(self):
+        """Removes every entry."""
+        self.data.clear()
+
+    def stats(self):
+        """Returns a dict with the hits, misses, hit rate, and size."""
+        n = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / n if n else 0.0, 'size': len(self.data)}
@@ -0,0 +1,172 @@
+"""Records the transitions of jobs between statuses. Every time a job changes
+status, a single JSON line is appended to the transitions file of the node
+that it changed on, $FIXIE_NODE_TRANSITIONS_DIR/{node}.jsonl. The server
+merges these into the journal, $FIXIE_TRANSITIONS_FILE, which it alone
+appends to, so that watchers may follow changes on every node by tailing one
+file, rather than rescanning every status directory. Byte offsets into the
+journal serve as cursors.
+
+Appends over NFS are not atomic when several nodes write to the same file,
+since their lines may be interleaved. Having a single writer per file avoids
+this. Lines that cannot be decoded are skipped by readers, and those
+transitions are lost to watchers.
+
+Runners record their own transitions, without a fixie environment, so the
+paths to the transitions files are always passed in explicitly.
+"""
+import os
+import json
+import time
+import fcntl
+import threading
+
+from fixie_batch.tools import atomic_write
+
+
+def record_transition(path, jobid, status, **kwargs):
+    """Appends a transition of a job to a new status to the transitions file.
+    Keyword arguments are stored along with the transition. Returns the
+    transition.
+    """
+    transition = dict(kwargs, jobid=jobid, status=status, time=time.time())
+    line = json.dumps(transition, sort_keys=True) + '\n'
+    # a single write to a file opened for appending is not interleaved with
+    # the writes of other processes.
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+    return transition
+
+
+def read_transitions(path, offset=0, stop=None):
+    """Reads the transitions from a byte offset in the transitions file.
+    Only complete lines are read, so a partially written line is picked up
+    on the next read. Lines that are not valid transitions are skipped.
+
+    Parameters
+    ----------
+    path : str
+        Path to the transitions file.
+    offset : int, optional
+        Byte offset to start reading from.
+    stop : int or None, optional
+        Byte offset to stop reading at, defaults to the end of the file.
+
+    Returns
+    -------
+    transitions : list of (int, int, dict) tuples
+        The start offset, end offset, and transition of every line read.
+    offset : int
+        The offset to continue reading from.
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return [], offset
+    with f:
+        f.seek(offset)
+        data = f.read() if stop is None else f.read(max(0, stop - offset))
+    transitions = []
+    start = offset
+    for line in data.splitlines(keepends=True):
+        if not line.endswith(b'\n'):
+            break
+        end = start + len(line)
+        try:
+            t = json.loads(line.decode())
+        except ValueError:
+            t = None
+        if isinstance(t, dict) and 'jobid' in t and 'status' in t:
+            transitions.append((start, end, t))
+        start = end
+    return transitions, start
+
+
+def node_transitions_file(node_dir, node):
+    """Returns the path to the transitions file of a node."""
+    return os.path.join(node_dir, node + '.jsonl')
+
+
+# POSIX file locks do not exclude the threads of the same process
+MERGE_LOCK = threading.Lock()
+
+
+class Merger(object):
+    """Merges the transitions files of the nodes into the journal. How far
+    each node's file has been merged is kept beside the journal, in
+    ``{path}.offsets``, so that any process may merge, one at a time.
+    Transitions are appended to the journal before the offsets are saved, so
+    none are lost if the merge is interrupted, though they may be merged twice.
+    """
+
+    def __init__(self, node_dir, path):
+        self.node_dir = node_dir
+        self.path = path
+        self.offsets_file = path + '.offsets'
+        self.lockfile = path + '.lock'
+        self.offsets = self._load_offsets()
+        # sizes of the files when they were last merged
+        self.sizes = {}
+
+    def _load_offsets(self):
+        try:
+            with open(self.offsets_file) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _sizes(self):
+        try:
+            entries = list(os.scandir(self.node_dir))
+        except FileNotFoundError:
+            return {}
+        sizes = {}
+        for e in entries:
+            if not e.name.endswith('.jsonl'):
+                continue
+            try:
+                sizes[e.name] = e.stat().st_size
+            except FileNotFoundError:
+                continue
+        return sizes
+
+    def merge(self):
+        """Appends the new transitions of every node to the journal. Returns
+        the transitions that were merged, in the order of their times.
+        """
+        sizes = self._sizes()
+        if sizes == self.sizes:
+            return []
+        with MERGE_LOCK, open(self.lockfile, 'a') as lf:
+            fcntl.lockf(lf, fcntl.LOCK_EX)
+            try:
+                # another process may have merged since
+                self.offsets = self._load_offsets()
+                merged = []
+                for name, size in sorted(sizes.items()):
+                    offset = self.offsets.get(name, 0)
+                    if size < offset:
+                        # file was truncated or replaced, start over
+                        offset = 0
+                    transitions, offset = read_transitions(
+                        os.path.join(self.node_dir, name), offset)
+                    merged.extend(t for s, e, t in transitions)
+                    self.offsets[name] = offset
+                merged.sort(key=lambda t: t['time'])
+                if merged:
+                    data = ''.join(json.dumps(t, sort_keys=True) + '\n'
+                                   for t in merged)
+                    flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+                    fd = os.open(self.path, flags, 0o644)
+                    try:
+                        os.write(fd, data.encode())
+                    finally:
+                        os.close(fd)
+                with atomic_write(self.offsets_file) as f:
+                    json.dump(self.offsets, f, sort_keys=True)
+                self.sizes = sizes
+            finally:
+                fcntl.lockf(lf, fcntl.LOCK_UN)
+        return merged
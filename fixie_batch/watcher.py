@@ -0,0 +1,171 @@
+"""Watches jobs for changes in their status. A single watcher per server tails
+the transitions file and wakes up every request that is waiting on it, so
+that waiting on any number of jobs costs one open request, rather than
+repeated queries that rescan the status directories.
+"""
+import os
+import collections
+
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Condition
+from fixie import ENV
+
+from fixie_batch.transitions import read_transitions
+from fixie_batch.journal import merge_transitions
+from fixie_batch.cache import jobids_with_name
+from fixie_batch.simulations import (_ensure_set_of_str_or_none,
+    _convert_to_statuses_set)
+
+
+class Watcher(object):
+    """Tails the transitions file, keeping the most recent transitions in
+    memory, and notifies waiters when new transitions arrive.
+    """
+
+    def __init__(self, path=None, interval=0.1, maxlen=10000):
+        self.path = ENV['FIXIE_TRANSITIONS_FILE'] if path is None else path
+        try:
+            self.offset = os.path.getsize(self.path)
+        except FileNotFoundError:
+            self.offset = 0
+        self.recent = collections.deque(maxlen=maxlen)
+        self.io_loop = IOLoop.current()
+        self.condition = Condition()
+        self.callback = PeriodicCallback(self.poll, interval * 1000)
+        self.callback.start()
+
+    def poll(self):
+        """Reads any new transitions and notifies the waiters."""
+        merge_transitions()
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            size = 0
+        if size < self.offset:
+            # file was truncated or replaced, start over
+            self.offset = 0
+            self.recent.clear()
+        if size == self.offset:
+            return
+        transitions, self.offset = read_transitions(self.path, self.offset)
+        if transitions:
+            self.recent.extend(transitions)
+            self.condition.notify_all()
+
+    def since(self, cursor):
+        """Returns the transitions after a cursor, and the new cursor."""
+        if cursor >= self.offset:
+            return [], self.offset
+        elif self.recent and cursor >= self.recent[0][0]:
+            transitions = [t for s, e, t in self.recent if s >= cursor]
+        else:
+            transitions, _ = read_transitions(self.path, cursor, stop=self.offset)
+            transitions = [t for s, e, t in transitions]
+        return transitions, self.offset
+
+    @gen.coroutine
+    def wait(self, cursor, match, timeout):
+        """Waits until there are transitions after the cursor that match, or
+        until the timeout (in seconds) has expired. Returns the matching
+        transitions and the new cursor.
+        """
+        deadline = IOLoop.current().time() + timeout
+        while True:
+            transitions, cursor = self.since(cursor)
+            matched = [t for t in transitions if match(t)]
+            if matched:
+                return matched, cursor
+            notified = yield self.condition.wait(timeout=deadline)
+            if not notified:
+                return [], cursor
+
+
+WATCHER = None
+
+
+def get_watcher():
+    """Returns the watcher of this server, starting it on first use, or when
+    the IO loop or the transitions file has changed.
+    """
+    global WATCHER
+    if (WATCHER is None or WATCHER.io_loop is not IOLoop.current() or
+            WATCHER.path != ENV['FIXIE_TRANSITIONS_FILE']):
+        if WATCHER is not None:
+            WATCHER.callback.stop()
+        WATCHER = Watcher()
+    return WATCHER
+
+
+@gen.coroutine
+def watch(jobs=None, users=None, projects=None, statuses='all', since=None,
+          timeout=None):
+    """Waits for jobs to change status.
+
+    Parameters
+    ----------
+    jobs : int, str, set of ints & strs, or None, optional
+        The jobids and job names to watch. If None, all jobs are watched.
+    users : str, set of str, or None, optional
+        User name(s) to filter on. If None, all user names are used.
+    projects : str, set of str, or None, optional
+        Project names to filer on, if not None.
+    statuses : str or set of str, optional
+        The statuses to watch for jobs moving into. If 'all', every status
+        is watched.
+    since : int or None, optional
+        Cursor returned by a previous watch. Transitions after this cursor are
+        returned right away. If None, only transitions from now on are watched.
+    timeout : float or None, optional
+        Maximum time in seconds to wait, defaults to and is capped by
+        $FIXIE_WATCH_TIMEOUT.
+
+    Returns
+    -------
+    data : list of dicts or None
+        The transitions that were found, with the 'jobid', new 'status',
+        'time', 'user', 'project', and 'node'. This is empty if the timeout
+        expired. None if status is False.
+    cursor : int
+        Cursor to pass in as ``since`` to continue watching.
+    status : bool
+        Whether or not the watch was successful.
+    message : str
+        Message related to the status of the watch
+    """
+    watcher = get_watcher()
+    users, msg = _ensure_set_of_str_or_none(users)
+    if msg:
+        return None, since, False, msg
+    projects, msg = _ensure_set_of_str_or_none(projects)
+    if msg:
+        return None, since, False, msg
+    statuses, msg = _convert_to_statuses_set(statuses)
+    if statuses is None:
+        return None, since, False, msg
+    if jobs is None:
+        jids = None
+    else:
+        if isinstance(jobs, (int, str)):
+            jobs = [jobs]
+        jids = set()
+        for job in jobs:
+            if isinstance(job, int):
+                jids.add(job)
+            elif isinstance(job, str):
+                jids |= jobids_with_name(job)
+            else:
+                msg = 'type of job not reconized: {0} {1}'
+                return None, since, False, msg.format(job, type(job))
+
+    def match(t):
+        return ((jids is None or t['jobid'] in jids) and
+                (users is None or t['user'] in users) and
+                (projects is None or t['project'] in projects) and
+                t['status'] in statuses)
+
+    maxtime = ENV['FIXIE_WATCH_TIMEOUT']
+    timeout = maxtime if timeout is None else min(timeout, maxtime)
+    cursor = watcher.offset if since is None else since
+    data, cursor = yield watcher.wait(cursor, match, timeout)
+    return data, cursor, True, 'Jobs watched'
@@ -0,0 +1,99 @@
+"""Workers run jobs from a queue that is shared by several compute nodes.
+When $FIXIE_SHARED_QUEUE is True, spawning a simulation only adds it to the
+queue. A worker on each node then claims queued jobs (by atomically moving
+their jobfiles into the running directory) whenever one of the node's
+$FIXIE_NJOBS slots is free, and runs them. Workers may be started with::
+
+    $ python -m fixie_batch.worker
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+from fixie import ENV
+
+from fixie_batch.simulations import (queued_ids, claim, runner_script,
+    _jobfile, _cancel_queued)
+from fixie_batch.tools import TERMINAL_STATUSES
+from fixie_batch.holds import held_ids, load_hold, remove_hold, resolve_hold
+
+
+def work(njobs=None, interval=1.0, once=False):
+    """Claims and runs jobs from the shared queue on this node.
+
+    Parameters
+    ----------
+    njobs : int or None, optional
+        Maximum number of jobs to run at once on this node,
+        defaults to $FIXIE_NJOBS.
+    interval : float, optional
+        Time in seconds to wait between checks of the queue.
+    once : bool, optional
+        Whether to only check the queue a single time, rather than forever.
+        This is mostly for testing.
+
+    Returns
+    -------
+    jobids : list of int
+        The jobids that were claimed by this worker.
+    """
+    njobs = ENV['FIXIE_NJOBS'] if njobs is None else njobs
+    status_dirs = {s: ENV['FIXIE_{0}_JOBS_DIR'.format(s.upper())]
+                   for s in TERMINAL_STATUSES}
+    claimed = []
+    procs = {}
+    while True:
+        procs = {j: p for j, p in procs.items() if p.poll() is None}
+        # runners that are post-processing have moved their jobs out of the
+        # running directory, and no longer take up a slot
+        free = njobs - sum(os.path.exists(_jobfile('running', j)) for j in procs)
+        held = held_ids(ENV['FIXIE_HELD_JOBS_DIR'])
+        for jobid in sorted(queued_ids()):
+            if jobid in held:
+                # jobs on the shared queue have no runner to resolve their
+                # holds, so workers do this for them, even when no slot is
+                # free, so that dependents of failed jobs are canceled promptly.
+                hold = load_hold(ENV['FIXIE_HELD_JOBS_DIR'], jobid)
+                if hold is not None:
+                    release, reason = resolve_hold(hold, status_dirs)
+                    if reason:
+                        _cancel_queued(jobid, reason)
+                    if not release:
+                        continue
+                remove_hold(ENV['FIXIE_HELD_JOBS_DIR'], jobid)
+            if free <= 0:
+                continue
+            if not claim(jobid):
+                # another node got to this job first
+                continue
+            cmd = [sys.executable, '-c', runner_script(jobid)]
+            procs[jobid] = subprocess.Popen(cmd)
+            claimed.append(jobid)
+            free -= 1
+        if once:
+            break
+        time.sleep(interval)
+    return claimed
+
+
+def main(args=None):
+    """Main entry point for fixie batch workers."""
+    p = argparse.ArgumentParser(description='Runs jobs from the shared fixie '
+                                            'batch queue on this node.')
+    p.add_argument('-n', '--njobs', type=int, default=None,
+                   help='maximum number of jobs to run at once, defaults to '
+                        '$FIXIE_NJOBS')
+    p.add_argument('-i', '--interval', type=float, default=1.0,
+                   help='time in seconds between checks of the queue')
+    p.add_argument('--node', default=None,
+                   help='name of this node, defaults to $FIXIE_NODE')
+    ns = p.parse_args(args)
+    if ns.node is not None:
+        ENV['FIXIE_NODE'] = ns.node
+    work(njobs=ns.njobs, interval=ns.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -29,6 +29,7 @@ setup_kwargs = {
 
 if HAVE_SETUPTOOLS:
     setup_kwargs['install_requires'] = ['fixie', 'pprintpp', 'jinja2']
+    setup_kwargs['extras_require'] = {'hdf5': ['h5py']}
 
 
 if __name__ == '__main__':
@@ -10,6 +10,8 @@ from fixie import environ
 from fixie.environ import ENV
 
 import fixie_batch.simulations
+import fixie_batch.cache
+from fixie_batch.stubs import stub_cyclus
 
 
 @pytest.fixture
@@ -40,12 +42,54 @@ def xdg(request):
     d = tempfile.mkdtemp()
     data = os.path.join(d, 'share')
     conf = os.path.join(d, 'config')
+    # cached lookups refer to the stores of the previous base directory
+    fixie_batch.cache.ALIASES.clear()
+    fixie_batch.cache.VERIFIED.clear()
     with ENV.swap(XDG_DATA_HOME=data, XDG_CONFIG_HOME=conf):
         with environ.context():
             yield d
     shutil.rmtree(d)
 
 
+@pytest.fixture
+def simulation():
+    """A fixture that returns a small cyclus simulation."""
+    return {
+     'simulation': {
+      'archetypes': {
+       'spec': [
+        {'lib': 'agents', 'name': 'Sink'},
+        {'lib': 'agents', 'name': 'NullRegion'},
+        {'lib': 'agents', 'name': 'NullInst'},
+       ],
+      },
+      'control': {
+       'duration': 2,
+       'startmonth': 1,
+       'startyear': 2000,
+      },
+      'facility': {
+       'config': {'Sink': {'capacity': '1.00', 'in_commods': {'val': 'commodity'}}},
+       'name': 'Sink',
+      },
+      'recipe': {
+       'basis': 'mass',
+       'name': 'commod_recipe',
+       'nuclide': {'comp': '1', 'id': 'H1'},
+      },
+      'region': {
+       'config': {'NullRegion': None},
+       'institution': {
+        'config': {'NullInst': None},
+        'initialfacilitylist': {'entry': {'number': '1', 'prototype': 'Sink'}},
+        'name': 'SingleInstitution',
+       },
+       'name': 'SingleRegion',
+      },
+     },
+    }
+
+
 def always_verify_user(user, token):
     """Always verifys the user/token pair"""
     return True, 'User verified', True
@@ -56,3 +100,15 @@ def verify_user(monkeypatch):
     monkeypatch.setattr(fixie, 'verify_user', always_verify_user)
     monkeypatch.setattr(fixie.tools, 'verify_user', always_verify_user)
     monkeypatch.setattr(fixie_batch.simulations, 'verify_user', always_verify_user)
+
+
+@pytest.fixture
+def slow_cyclus(monkeypatch):
+    """A fixture that puts a stub cyclus, which runs for 30 seconds, first on
+    $PATH, for tests that need simulations that are still running.
+    """
+    d = tempfile.mkdtemp()
+    stub_cyclus(d, sleep=30)
+    monkeypatch.setenv('PATH', d + os.pathsep + os.environ.get('PATH', ''))
+    yield d
+    shutil.rmtree(d)
@@ -0,0 +1,101 @@
+"""Tests admission control for spawning jobs"""
+import time
+
+import pytest
+from fixie import ENV
+
+from fixie_batch.transitions import record_transition
+from fixie_batch.simulations import spawn
+import fixie_batch.admission
+from fixie_batch.admission import (QueueCounter, TokenBucket, Refused, BUCKETS,
+    admit, prepare_counter)
+
+
+def _record(jobid, status, user='me'):
+    record_transition(ENV['FIXIE_TRANSITIONS_FILE'], jobid, status, user=user,
+                      project='', node='node0')
+
+
+def test_queue_counter(xdg):
+    _record(0, 'queued')
+    counter = QueueCounter()
+    assert 1 == counter.total()
+    _record(1, 'queued')
+    _record(2, 'queued', user='you')
+    _record(3, 'queued')
+    _record(1, 'running')
+    # transitions are idempotent
+    _record(3, 'queued')
+    assert 3 == counter.total()
+    assert 2 == counter.user('me')
+    assert 1 == counter.user('you')
+    _record(2, 'canceled', user='you')
+    assert 0 == counter.user('you')
+
+
+@pytest.mark.gen_test
+def test_prepare_counter(xdg):
+    fixie_batch.admission.COUNTER = None
+    _record(0, 'queued')
+    yield prepare_counter()
+    counter = fixie_batch.admission.COUNTER
+    assert 1 == counter.total()
+    # the counter is only created once
+    yield prepare_counter()
+    assert counter is fixie_batch.admission.COUNTER
+
+
+def test_token_bucket():
+    bucket = TokenBucket(2.0, 2.0)
+    assert 0.0 == bucket.take(now=bucket.time)
+    assert 0.0 == bucket.take(now=bucket.time)
+    assert 0.5 == bucket.take(now=bucket.time)
+    assert 0.0 == bucket.take(now=bucket.time + 0.5)
+
+
+def test_admit_queue_limits(xdg):
+    with ENV.swap(FIXIE_MAX_QUEUED_PER_USER=2, FIXIE_MAX_QUEUED=3):
+        assert admit('me')[0]
+        _record(0, 'queued')
+        _record(1, 'queued')
+        admitted, retry_after, msg = admit('me')
+        assert not admitted
+        assert ENV['FIXIE_ADMISSION_RETRY_AFTER'] == retry_after
+        _record(2, 'queued', user='you')
+        admitted, retry_after, msg = admit('you')
+        assert not admitted
+        assert 'queue is full' in msg
+        _record(0, 'completed')
+        assert admit('me')[0]
+
+
+def test_admit_rate(xdg):
+    with ENV.swap(FIXIE_SPAWN_RATE=0.5, FIXIE_SPAWN_BURST=1.0):
+        assert admit('fast')[0]
+        admitted, retry_after, msg = admit('fast')
+        assert not admitted
+        assert 0.0 < retry_after <= 2.0
+        # other users have their own buckets
+        assert admit('slow')[0]
+
+
+def test_admit_drops_full_buckets(xdg):
+    BUCKETS.clear()
+    with ENV.swap(FIXIE_SPAWN_RATE=1e6, FIXIE_SPAWN_BURST=1.0):
+        for user in ('a', 'b', 'c'):
+            assert admit(user)[0]
+        time.sleep(0.01)
+        assert admit('d')[0]
+        assert ['d'] == list(BUCKETS)
+
+
+def test_spawn_admission(xdg, verify_user):
+    BUCKETS.clear()
+    with ENV.swap(FIXIE_SPAWN_RATE=0.0, FIXIE_SPAWN_BURST=1.0, FIXIE_NJOBS=0):
+        # invalid requests do not take a token
+        jobid, status, msg = spawn({}, 'me', '42', after=[42], admission=True)
+        assert not status
+        jobid, status, msg = spawn({}, 'me', '42', admission=True)
+        assert status
+        with pytest.raises(Refused):
+            spawn({}, 'me', '42', admission=True)
@@ -0,0 +1,55 @@
+"""Tests caching lookups on the request hot path"""
+import time
+
+import fixie
+
+from fixie_batch.tools import TTLCache
+from fixie_batch.cache import (VERIFIED, ALIASES, verify_user,
+    jobids_from_alias, jobids_with_name, register_job_alias)
+
+
+def test_ttl_cache():
+    cache = TTLCache(maxsize=2, ttl=0.1)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert (True, 1) == cache.get('a')
+    # b is the least recently used, and so is evicted
+    cache.put('c', 3)
+    assert (False, None) == cache.get('b')
+    time.sleep(0.15)
+    assert (False, None) == cache.get('a')
+    assert {'hits': 1, 'misses': 2, 'hit_rate': 1 / 3, 'size': 1} == cache.stats()
+
+
+def test_verify_user(xdg, monkeypatch):
+    calls = []
+
+    def verify(user, token):
+        calls.append(user)
+        return user == 'me', 'User verified', True
+
+    monkeypatch.setattr(fixie, 'verify_user', verify)
+    for i in range(3):
+        assert verify_user('me', '42')[0]
+        assert not verify_user('you', '42')[0]
+    # only successful verifications are cached
+    assert ['me', 'you', 'you', 'you'] == calls
+    assert all(token != '42' for user, token in VERIFIED.data)
+
+
+def test_alias_invalidation(xdg):
+    assert set() == jobids_from_alias('me', 'sim')
+    register_job_alias(0, 'me', name='sim')
+    assert {0} == jobids_from_alias('me', 'sim')
+    assert {0} == jobids_with_name('sim')
+    hits = ALIASES.hits
+    assert {0} == jobids_with_name('sim')
+    assert hits + 1 == ALIASES.hits
+    register_job_alias(1, 'you', name='sim')
+    assert {0, 1} == jobids_with_name('sim')
+    # lookups that the new alias cannot change stay cached
+    jobids_from_alias('me', 'other')
+    hits = ALIASES.hits
+    register_job_alias(2, 'me', name='sim')
+    assert set() == jobids_from_alias('me', 'other')
+    assert hits + 1 == ALIASES.hits
@@ -0,0 +1,160 @@
+"""Tests the client for the handlers."""
+import time
+import http.client
+
+import pytest
+import tornado.web
+from tornado import gen
+from fixie import ENV
+
+from fixie_batch.handlers import HANDLERS
+from fixie_batch.client import Client, ConnectionPool
+
+
+APP = tornado.web.Application(HANDLERS)
+
+
+@pytest.fixture
+def app():
+    return APP
+
+
+@pytest.fixture
+def client(http_server, base_url):
+    c = Client(base_url, user='inigo', token='42', batch_delay=0.05)
+    calls = []
+
+    def counted(request):
+        def f(path, body):
+            calls.append(path)
+            return request(path, body)
+        return f
+
+    c.pool.request = counted(c.pool.request)
+    c.watch_pool.request = counted(c.watch_pool.request)
+    c.calls = calls
+    yield c
+    c.close()
+
+
+@pytest.mark.gen_test(timeout=60)
+def test_spawn_wait_for(xdg, verify_user, client, simulation):
+    jobids = []
+    for i in range(2):
+        jobid, status, msg = yield client.spawn(simulation)
+        assert status, msg
+        jobids.append(jobid)
+    jobs = yield client.wait_for(jobids, timeout=50.0)
+    assert '/watch' in client.calls
+    assert set(jobids) == set(jobs)
+    for jobid in jobids:
+        assert 'completed' == jobs[jobid]['status']
+    # finished jobs are cached
+    n = len(client.calls)
+    job = yield client.get(jobids[0])
+    assert jobs[jobids[0]] == job
+    assert n == len(client.calls)
+
+
+@pytest.mark.gen_test
+def test_get_batched(xdg, client):
+    jobs = yield [client.get(jobid) for jobid in range(5)]
+    assert [None] * 5 == jobs
+    assert ['/query'] == client.calls
+
+
+@pytest.mark.gen_test
+def test_connections_reused(xdg, client):
+    for i in range(3):
+        data, status, msg = yield client.query()
+        assert status, msg
+    assert 3 == len(client.calls)
+    assert 1 == client.pool.created
+
+
+@pytest.mark.gen_test(timeout=30)
+def test_watches_do_not_block(xdg, client):
+    # long polls hold connections of their own
+    watches = [client.watch(timeout=2.0) for i in range(client.watch_pool.maxsize)]
+    t0 = time.time()
+    data, status, msg = yield client.query()
+    assert status, msg
+    assert time.time() - t0 < 1.5
+    yield watches
+
+
+@pytest.mark.gen_test
+def test_spawn_retry_after(xdg, verify_user, client, simulation):
+    client.max_retries = 1
+    with ENV.swap(FIXIE_SPAWN_RATE=0.0, FIXIE_SPAWN_BURST=0.0,
+                  FIXIE_ADMISSION_RETRY_AFTER=0.01):
+        jobid, status, msg = yield client.spawn(simulation)
+    assert -1 == jobid
+    assert not status
+    assert ['/spawn', '/spawn'] == client.calls
+
+
+@pytest.mark.gen_test(timeout=30)
+def test_wait_for_timeout(xdg, verify_user, client, simulation):
+    ENV['FIXIE_NJOBS'] = 0
+    jobid, status, msg = yield client.spawn(simulation)
+    assert status, msg
+    with pytest.raises(gen.TimeoutError):
+        yield client.wait_for([jobid], timeout=0.5)
+    jobid, status, msg = yield client.cancel(jobid)
+    assert status, msg
+
+
+@pytest.mark.gen_test(timeout=60)
+def test_wait_for_polls(xdg, verify_user, client, simulation):
+    # servers without /watch are polled instead
+    client.watch_supported = False
+    jobid, status, msg = yield client.spawn(simulation)
+    assert status, msg
+    jobs = yield client.wait_for([jobid], timeout=50.0, interval=0.1)
+    assert 'completed' == jobs[jobid]['status']
+    assert '/watch' not in client.calls
+
+
+class _Response(object):
+    status = 200
+    will_close = True
+
+    def read(self):
+        return b'{}'
+
+    def getheaders(self):
+        return []
+
+
+class _Connection(object):
+    def __init__(self, error=None):
+        self.error = error
+        self.sent = 0
+
+    def request(self, *args, **kwargs):
+        self.sent += 1
+
+    def getresponse(self):
+        if self.error is not None:
+            raise self.error
+        return _Response()
+
+    def close(self):
+        pass
+
+
+def test_pool_retries_unsent_requests():
+    pool = ConnectionPool('http://localhost:8642')
+    fresh = _Connection()
+    pool._connect = lambda: fresh
+    # the server closed an idle connection without reading the request
+    pool.idle.put(_Connection(http.client.RemoteDisconnected()))
+    assert 200 == pool.request('/spawn', {})[0]
+    assert 1 == fresh.sent
+    # a request that may have been handled is never sent again
+    pool.idle.put(_Connection(ConnectionResetError()))
+    with pytest.raises(ConnectionResetError):
+        pool.request('/spawn', {})
+    assert 1 == fresh.sent
+    pool.close()
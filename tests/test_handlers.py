@@ -62,6 +62,49 @@ def test_spawn_valid(xdg, verify_user, http_client, base_url):
     assert exp == obs
 
 
+@pytest.mark.gen_test
+def test_spawn_retry_after(xdg, verify_user, http_client, base_url):
+    with ENV.swap(FIXIE_SPAWN_RATE=0.0, FIXIE_SPAWN_BURST=0.0):
+        body = {'user': 'inigo', 'token': '42', 'simulation': SIMULATION}
+        resp = yield http_client.fetch(base_url + '/spawn', method='POST',
+                                       body=json.dumps(body), raise_error=False)
+    assert 429 == resp.code
+    assert str(int(ENV['FIXIE_ADMISSION_RETRY_AFTER'])) == resp.headers['Retry-After']
+    obs = json.loads(resp.body.decode())
+    assert -1 == obs['jobid']
+    assert not obs['status']
+
+
+@pytest.mark.gen_test
+def test_start_periodic(xdg, monkeypatch, http_client, base_url):
+    """Tests that the first request starts the maintenance tasks, which run
+    without blocking the IO loop.
+    """
+    import fixie_batch.handlers as handlers
+    ran = []
+
+    def slow():
+        time.sleep(0.5)
+        ran.append(True)
+
+    monkeypatch.setattr(handlers, 'PERIODIC', [(slow, 'FIXIE_REAP_INTERVAL')])
+    monkeypatch.setattr(handlers, 'PERIODIC_CALLBACKS', [])
+    monkeypatch.setattr(handlers, 'PERIODIC_FUTURES', {})
+    t0 = time.time()
+    obs = yield fetch(base_url + '/query', {})
+    assert obs['status']
+    assert time.time() - t0 < 0.5
+    try:
+        yield handlers.PERIODIC_FUTURES[slow]
+        # later requests do not start the tasks again
+        yield fetch(base_url + '/query', {})
+        assert 1 == len(handlers.PERIODIC_CALLBACKS)
+    finally:
+        for pc in handlers.PERIODIC_CALLBACKS:
+            pc.stop()
+    assert [True] == ran
+
+
 @pytest.mark.gen_test
 def test_cancel_valid(xdg, verify_user, http_client, base_url):
     # spawn a job, but don't allow it to run
@@ -113,3 +156,17 @@ def test_query_valid(xdg, http_client, base_url):
     assert exp == obs
 
 
+@pytest.mark.gen_test
+def test_watch_valid(xdg, verify_user, http_client, base_url):
+    # spawn a job and watch for it to finish
+    url = base_url + '/spawn'
+    body = {"user": "inigo", "token": "42", 'simulation': SIMULATION}
+    _ = yield fetch(url, body)
+    url = base_url + '/watch'
+    body = {'jobs': [0], 'statuses': ['completed', 'failed'], 'since': 0,
+            'timeout': 10.0}
+    obs = yield fetch(url, body)
+    assert obs['status']
+    assert 'Jobs watched' == obs['message']
+    assert [0] == [t['jobid'] for t in obs['data']]
+    assert obs['cursor'] > 0
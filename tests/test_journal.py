@@ -0,0 +1,85 @@
+"""Tests replaying the journal of job transitions"""
+import os
+import json
+
+from fixie import ENV
+
+from fixie_batch.transitions import (record_transition, read_transitions,
+    node_transitions_file)
+from fixie_batch.journal import JobIndex, save_snapshot, merge_transitions
+
+
+def _record(jobid, status, user='me'):
+    record_transition(ENV['FIXIE_TRANSITIONS_FILE'], jobid, status, user=user,
+                      project='', node='node0')
+
+
+def _write_job(status, jobid, user='me'):
+    jobfile = os.path.join(ENV['FIXIE_{0}_JOBS_DIR'.format(status.upper())],
+                           '{0}.json'.format(jobid))
+    with open(jobfile, 'w') as f:
+        json.dump({'jobid': jobid, 'user': user, 'project': ''}, f)
+    return jobfile
+
+
+def test_scan_and_replay(xdg):
+    # jobs from before the journal existed are found by scanning
+    _write_job('completed', 0)
+    _write_job('queued', 1)
+    _record(1, 'running')
+    _record(2, 'queued', user='you')
+    index = JobIndex()
+    assert {0} == index.ids('completed')
+    assert {1} == index.ids('running')
+    assert {2} == index.ids('queued')
+    assert 'you' == index.jobs[2]['user']
+    _record(2, 'canceled', user='you')
+    assert [2] == [t['jobid'] for t in index.update()]
+    assert {2} == index.ids('canceled')
+
+
+def test_snapshot(xdg):
+    jobfile = _write_job('completed', 0)
+    _record(1, 'queued')
+    snap = save_snapshot()
+    assert os.path.getsize(ENV['FIXIE_TRANSITIONS_FILE']) == snap['offset']
+    # restarts do not rescan the status directories, only the journal after
+    # the snapshot is replayed
+    os.remove(jobfile)
+    _record(1, 'running')
+    index = JobIndex()
+    assert {0} == index.ids('completed')
+    assert {1} == index.ids('running')
+    assert os.path.getsize(ENV['FIXIE_TRANSITIONS_FILE']) == index.offset
+
+
+def test_truncated_journal(xdg):
+    _record(0, 'queued')
+    _record(0, 'running')
+    save_snapshot()
+    with open(ENV['FIXIE_TRANSITIONS_FILE'], 'w'):
+        pass
+    _write_job('failed', 0)
+    index = JobIndex()
+    assert {0} == index.ids('failed')
+
+
+def test_merge_transitions(xdg):
+    # each node records its transitions in its own file
+    for node in ['node0', 'node1']:
+        path = node_transitions_file(ENV['FIXIE_NODE_TRANSITIONS_DIR'], node)
+        record_transition(path, int(node[-1]), 'running', user='me',
+                          project='', node=node)
+    index = JobIndex()
+    assert {0, 1} == index.ids('running')
+    assert 'node1' == index.jobs[1]['node']
+    obs, _ = read_transitions(ENV['FIXIE_TRANSITIONS_FILE'])
+    assert [0, 1] == sorted(t['jobid'] for s, e, t in obs)
+    # transitions are merged once, even by a restarted server
+    import fixie_batch.journal
+    fixie_batch.journal.MERGER = None
+    assert [] == merge_transitions()
+    record_transition(path, 1, 'completed', user='me', project='', node='node1')
+    assert [1] == [t['jobid'] for t in merge_transitions()]
+    assert [1] == [t['jobid'] for t in index.update()]
+    assert {1} == index.ids('completed')
@@ -0,0 +1,22 @@
+"""Tests the load test harness"""
+import pytest
+
+from fixie_batch.loadtest import loadtest, percentile
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert 3 == percentile([5, 1, 3, 2, 4], 50)
+    assert 5 == percentile([5, 1, 3, 2, 4], 99)
+
+
+@pytest.mark.gen_test(timeout=120)
+def test_loadtest(xdg):
+    rep = yield loadtest(rate=40.0, duration=1.0, users=3, sleep=0.05,
+                         drain_timeout=60.0, seed=42)
+    # cancels and queries are skipped until the user has spawned a job
+    assert 0 < rep['requests'] <= 40
+    assert rep['jobs'] > 0
+    assert [] == rep['violations']
+    for op, r in rep['ops'].items():
+        assert 0.0 == r['error_rate'], op
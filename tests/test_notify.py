@@ -0,0 +1,193 @@
+"""Tests notifications about jobs"""
+import os
+import json
+import socket
+import tempfile
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from fixie import ENV
+
+import fixie_batch.notify
+from fixie_batch.notify import (ensure_notify, queue_notifications, pending,
+    flush, send, Dispatcher)
+
+
+JOB = {'jobid': 7, 'user': 'me', 'project': 'proj', 'outfile': 'out.h5',
+       'returncode': 0, 'endtime': 1.0}
+
+
+ALLOWED_DIRS = [tempfile.gettempdir()]
+ALLOWED_HOSTS = ['127.0.0.1']
+
+
+def _job(*targets):
+    job = dict(JOB)
+    job['notify'], msg = ensure_notify(targets, allowed_dirs=ALLOWED_DIRS,
+                                       allowed_hosts=ALLOWED_HOSTS)
+    assert not msg
+    return job
+
+
+def _http_server(received):
+    """Starts a webhook receiver on the loopback address, which redirects
+    POSTs to /redirect to /hook.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            n = int(self.headers['Content-Length'])
+            received.append(json.loads(self.rfile.read(n).decode()))
+            if self.path == '/redirect':
+                self.send_response(307)
+                self.send_header('Location', '/hook')
+            else:
+                self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_ensure_notify():
+    d = tempfile.gettempdir()
+    obs, msg = ensure_notify(['http://example.com/hook',
+                              {'url': 'file://' + d, 'statuses': 'failed'}],
+                             allowed_dirs=ALLOWED_DIRS)
+    assert not msg
+    assert [{'url': 'http://example.com/hook',
+             'statuses': ['canceled', 'completed', 'failed']},
+            {'url': 'file://' + d, 'statuses': ['failed']}] == obs
+    for bad in (['ftp://localhost'], [{'statuses': ['failed']}],
+                [{'url': 'file://' + d, 'statuses': ['running']}]):
+        obs, msg = ensure_notify(bad, allowed_dirs=ALLOWED_DIRS)
+        assert obs is None
+        assert msg
+
+
+def test_ensure_notify_allowed_dirs():
+    d = tempfile.mkdtemp()
+    for url in ('file:///etc', 'unix:///run/notify.sock',
+                'file://' + os.path.join(d, '..')):
+        obs, msg = ensure_notify([url], allowed_dirs=[d])
+        assert obs is None
+        assert msg
+    # nothing local is allowed by default
+    obs, msg = ensure_notify(['file://' + d])
+    assert obs is None
+    obs, msg = ensure_notify(['unix://' + os.path.join(d, 'sock')], allowed_dirs=[d])
+    assert not msg
+
+
+def test_ensure_notify_allowed_hosts():
+    private = ['http://localhost/hook', 'http://127.0.0.1:8080/hook',
+               'https://10.0.0.1/hook', 'http://169.254.169.254/latest',
+               'http://[::1]/hook', 'http:///hook']
+    for url in private:
+        obs, msg = ensure_notify([url])
+        assert obs is None
+        assert msg
+    # the allowed hosts may be private, but nothing else is allowed
+    obs, msg = ensure_notify(['http://127.0.0.1:8080/hook'],
+                             allowed_hosts=ALLOWED_HOSTS)
+    assert not msg
+    obs, msg = ensure_notify(['https://example.com/hook'],
+                             allowed_hosts=ALLOWED_HOSTS)
+    assert obs is None
+
+
+def test_http_public_only(monkeypatch):
+    received = []
+    server = _http_server(received)
+    url = 'http://127.0.0.1:{0}/hook'.format(server.server_port)
+    with pytest.raises(ValueError):
+        send(url, [{'jobid': 7}])
+    # names that resolve to private addresses are refused when connecting
+    getaddrinfo = socket.getaddrinfo
+
+    def loopback(host, *args, **kwargs):
+        return getaddrinfo('127.0.0.1', *args, **kwargs)
+
+    monkeypatch.setattr(fixie_batch.notify.socket, 'getaddrinfo', loopback)
+    with pytest.raises(OSError):
+        send(url.replace('127.0.0.1', 'hooks.example.com'), [{'jobid': 7}])
+    assert [] == received
+    # redirects are not followed
+    with pytest.raises(OSError):
+        send(url.replace('hook', 'redirect'), [{'jobid': 7}],
+             allowed_hosts=ALLOWED_HOSTS)
+    server.shutdown()
+    assert 1 == len(received)
+
+
+def test_file_drop(xdg):
+    d = tempfile.mkdtemp()
+    job = _job('file://' + d, {'url': 'file://' + d, 'statuses': ['failed']})
+    outbox = ENV['FIXIE_OUTBOX_DIR']
+    assert 1 == queue_notifications(outbox, job, 'completed')
+    assert 1 == flush(outbox)
+    assert [] == os.listdir(outbox)
+    drops = os.listdir(d)
+    assert 1 == len(drops)
+    with open(os.path.join(d, drops[0])) as f:
+        obs = json.load(f)
+    assert [(7, 'completed')] == [(n['jobid'], n['status'])
+                                  for n in obs['notifications']]
+
+
+def test_http_batched(xdg):
+    received = []
+    server = _http_server(received)
+    url = 'http://127.0.0.1:{0}/hook'.format(server.server_port)
+    outbox = ENV['FIXIE_OUTBOX_DIR']
+    for jobid in range(3):
+        job = _job(url)
+        job['jobid'] = jobid
+        queue_notifications(outbox, job, 'failed')
+    futures = Dispatcher(outbox, allowed_hosts=ALLOWED_HOSTS).dispatch()
+    assert 1 == len(futures)
+    assert futures[0].result(timeout=10.0)
+    server.shutdown()
+    assert 1 == len(received)
+    assert [0, 1, 2] == sorted(n['jobid'] for n in received[0]['notifications'])
+    assert [] == os.listdir(outbox)
+
+
+def test_unix_socket(xdg):
+    path = os.path.join(tempfile.mkdtemp(), 'notify.sock')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+    outbox = ENV['FIXIE_OUTBOX_DIR']
+    queue_notifications(outbox, _job('unix://' + path), 'canceled')
+    assert 1 == flush(outbox)
+    conn, _ = sock.accept()
+    with conn:
+        data = conn.makefile().read()
+    sock.close()
+    assert [(7, 'canceled')] == [(n['jobid'], n['status'])
+                                 for n in map(json.loads, data.splitlines())]
+
+
+def test_retries_are_bounded(xdg):
+    outbox = ENV['FIXIE_OUTBOX_DIR']
+    missing = os.path.join(tempfile.mkdtemp(), 'missing')
+    queue_notifications(outbox, _job('file://' + missing), 'failed')
+    assert 0 == flush(outbox, retries=1)
+    name, = os.listdir(outbox)
+    with open(os.path.join(outbox, name)) as f:
+        entry = json.load(f)
+    assert 1 == entry['tries']
+    # backed off, so not due yet
+    assert {} == pending(outbox)
+    assert 1 == len(pending(outbox, now=entry['next_time'])[entry['target']])
+    entry['next_time'] = 0.0
+    with open(os.path.join(outbox, name), 'w') as f:
+        json.dump(entry, f)
+    assert 0 == flush(outbox, retries=1)
+    assert [] == os.listdir(outbox)
@@ -0,0 +1,89 @@
+"""Tests post-processing of simulation outputs"""
+import os
+import gzip
+import json
+import sqlite3
+import tempfile
+
+from fixie_batch.post import STAGES, stage, ensure_post, run_stages
+
+
+def _sqlite_job():
+    d = tempfile.mkdtemp()
+    outfile = os.path.join(d, '0.sqlite')
+    conn = sqlite3.connect(outfile)
+    conn.executescript("""
+        CREATE TABLE AgentEntry (AgentId INTEGER, Prototype TEXT);
+        CREATE TABLE Resources (ResourceId INTEGER, Quantity REAL);
+        CREATE TABLE Transactions (SenderId INTEGER, ReceiverId INTEGER,
+            ResourceId INTEGER, Commodity TEXT, Time INTEGER);
+        INSERT INTO AgentEntry VALUES (1, 'Mine'), (2, 'Reactor');
+        INSERT INTO Resources VALUES (10, 1.5), (11, 2.5), (12, 3.0);
+        INSERT INTO Transactions VALUES (1, 2, 10, 'uox', 0), (1, 2, 11, 'uox', 1),
+            (2, 1, 12, 'spent', 1);
+        """)
+    conn.commit()
+    conn.close()
+    return {'jobid': 0, 'outfile': outfile, 'starttime': 1.0, 'endtime': 3.0}
+
+
+def test_ensure_post():
+    obs, msg = ensure_post(['metrics', {'stage': 'compress', 'level': 1}])
+    assert not msg
+    assert [{'stage': 'metrics'}, {'stage': 'compress', 'level': 1}] == obs
+    for bad in (['nope'], [{'level': 1}], [42]):
+        obs, msg = ensure_post(bad)
+        assert obs is None
+        assert msg
+
+
+def test_metrics_and_flows():
+    job = _sqlite_job()
+    results, ok = run_stages(job, [{'stage': 'metrics'},
+                                   {'stage': 'material_flows'}])
+    assert ok
+    metrics, flows = [r['result'] for r in results]
+    assert 2.0 == metrics['duration']
+    assert {'AgentEntry': 2, 'Resources': 3, 'Transactions': 3} == metrics['tables']
+    assert 2 == flows['nrows']
+    with open(flows['file']) as f:
+        table = json.load(f)
+    assert ['Sender', 'Receiver', 'Commodity', 'Quantity'] == table['columns']
+    assert [['Mine', 'Reactor', 'uox', 4.0],
+            ['Reactor', 'Mine', 'spent', 3.0]] == table['data']
+
+
+def test_compress():
+    job = _sqlite_job()
+    outfile = job['outfile']
+    results, ok = run_stages(job, [{'stage': 'compress'}])
+    assert ok
+    assert outfile + '.gz' == job['outfile']
+    assert not os.path.exists(outfile)
+    with gzip.open(job['outfile']) as f:
+        assert results[0]['result']['original_size'] == len(f.read())
+
+
+def test_failed_stage_stops_pipeline():
+    @stage('explode')
+    def explode(job):
+        raise ValueError('boom')
+    try:
+        job = _sqlite_job()
+        results, ok = run_stages(job, [{'stage': 'explode'}, {'stage': 'compress'}])
+    finally:
+        del STAGES['explode']
+    assert not ok
+    assert 1 == len(results)
+    assert 'ValueError: boom' == results[0]['message']
+    assert os.path.exists(job['outfile'])
+
+
+def test_hdf5_without_h5py(monkeypatch):
+    import sys
+    monkeypatch.setitem(sys.modules, 'h5py', None)
+    job = _sqlite_job()
+    job['outfile'] = job['outfile'][:-7] + '.h5'
+    results, ok = run_stages(job, [{'stage': 'material_flows'}])
+    assert not ok
+    assert 'requires h5py' in results[0]['message']
@@ -0,0 +1,165 @@
+"""Tests reaping jobs whose runner died"""
+import os
+import json
+import time
+import subprocess
+
+from fixie import ENV
+
+from fixie_batch.reaper import reap, is_alive, process_starttime
+
+
+def _jobfile(status, jobid):
+    d = ENV['FIXIE_{0}_JOBS_DIR'.format(status.upper())]
+    jobfile = os.path.join(d, str(jobid) + '.json')
+    return jobfile
+
+
+def _dead_pid():
+    p = subprocess.Popen(['true'])
+    p.wait()
+    return p.pid
+
+
+def _write_running(jobid, **kwargs):
+    job = {'jobid': jobid, 'user': 'me', 'project': '',
+           'node': ENV['FIXIE_NODE'], 'pid': _dead_pid()}
+    job.update(kwargs)
+    with open(_jobfile('running', jobid), 'w') as f:
+        json.dump(job, f)
+
+
+def test_is_alive():
+    pid = os.getpid()
+    assert is_alive(pid)
+    assert is_alive(pid, process_starttime(pid))
+    assert not is_alive(_dead_pid())
+
+
+def test_reap_dead(xdg):
+    _write_running(0)
+    failed, requeued = reap()
+    assert [0] == failed
+    assert [] == requeued
+    assert not os.path.exists(_jobfile('running', 0))
+    with open(_jobfile('failed', 0)) as f:
+        job = json.load(f)
+    assert 1 == job['returncode']
+    assert 'died' in job['err']
+    assert 1 == len(job['attempts'])
+
+
+def test_reap_alive(xdg):
+    pid = os.getpid()
+    _write_running(0, pid=pid, pid_starttime=process_starttime(pid))
+    failed, requeued = reap()
+    assert [] == failed
+    assert [] == requeued
+    assert os.path.exists(_jobfile('running', 0))
+
+
+def test_reap_reused_pid(xdg):
+    # our pid is alive, but was not started when the job was
+    pid = os.getpid()
+    _write_running(0, pid=pid, pid_starttime=process_starttime(pid) - 1)
+    failed, requeued = reap()
+    assert [0] == failed
+
+
+def test_reap_reused_pgid(xdg):
+    # the simulation's process group id now belongs to an unrelated group
+    p = subprocess.Popen(['sleep', '30'], start_new_session=True)
+    try:
+        _write_running(0, pgid=p.pid, pgid_starttime=process_starttime(p.pid) - 1)
+        failed, requeued = reap()
+        assert [0] == failed
+        assert p.poll() is None
+    finally:
+        p.kill()
+        p.wait()
+
+
+def test_reap_remote(xdg):
+    ENV['FIXIE_LEASE_TIME'] = 10.0
+    _write_running(0, node='elsewhere', pid=os.getpid())
+    _write_running(1, node='elsewhere', pid=os.getpid())
+    old = time.time() - 20.0
+    os.utime(_jobfile('running', 0), (old, old))
+    failed, requeued = reap()
+    assert [0] == failed
+    assert os.path.exists(_jobfile('running', 1))
+
+
+def test_reap_requeue(xdg):
+    ENV['FIXIE_SHARED_QUEUE'] = True
+    _write_running(0)
+    failed, requeued = reap(retries=1)
+    assert [] == failed
+    assert [0] == requeued
+    with open(_jobfile('queued', 0)) as f:
+        job = json.load(f)
+    assert job['node'] is None
+    assert job['pid'] is None
+    assert 1 == len(job['attempts'])
+    # after the retry budget has been spent, the job fails
+    os.rename(_jobfile('queued', 0), _jobfile('running', 0))
+    with open(_jobfile('running', 0), 'w') as f:
+        job.update(node=ENV['FIXIE_NODE'], pid=_dead_pid())
+        json.dump(job, f)
+    failed, requeued = reap(retries=1)
+    assert [0] == failed
+
+
+def test_reap_post(xdg):
+    job = {'jobid': 0, 'user': 'me', 'project': '', 'node': ENV['FIXIE_NODE'],
+           'post_status': 'running'}
+    with open(_jobfile('completed', 0), 'w') as f:
+        json.dump(job, f)
+    entry = os.path.join(ENV['FIXIE_POST_DIR'], '0.running')
+    with open(entry, 'w') as f:
+        json.dump({'jobid': 0, 'node': ENV['FIXIE_NODE'], 'pid': _dead_pid(),
+                   'pid_starttime': None}, f)
+    reap()
+    assert not os.path.exists(entry)
+    with open(_jobfile('completed', 0)) as f:
+        job = json.load(f)
+    assert 'failed' == job['post_status']
+    assert 'died' in job['post_err']
+
+
+def test_reap_ignores_retry_attempts(xdg):
+    # attempts under the job's retry policy do not use up the reaper's retries
+    ENV['FIXIE_SHARED_QUEUE'] = True
+    attempts = [{'node': ENV['FIXIE_NODE'], 'pid': 1, 'starttime': 1.0,
+                 'endtime': 2.0, 'returncode': 1, 'err': 'boom'}] * 2
+    _write_running(0, attempts=attempts)
+    failed, requeued = reap(retries=1)
+    assert [0] == requeued
+    with open(_jobfile('queued', 0)) as f:
+        job = json.load(f)
+    assert [1, 1, None] == [a['returncode'] for a in job['attempts']]
+
+
+def test_reap_relaunch(xdg, monkeypatch):
+    import fixie_batch.reaper
+    launched = []
+    monkeypatch.setattr(fixie_batch.reaper, 'runner_script', lambda jobid, job: '')
+    monkeypatch.setattr(fixie_batch.reaper, 'detached_call', launched.append)
+    ENV['FIXIE_LEASE_TIME'] = 10.0
+    job = {'jobid': 0, 'user': 'me', 'project': '', 'node': ENV['FIXIE_NODE'],
+           'pid': None, 'queue_starttime': time.time()}
+    with open(_jobfile('queued', 0), 'w') as f:
+        json.dump(job, f)
+    # a runner that has not started yet is given time to do so
+    assert ([], []) == reap()
+    job['queue_starttime'] -= 20.0
+    with open(_jobfile('queued', 0), 'w') as f:
+        json.dump(job, f)
+    assert ([], [0]) == reap()
+    assert 1 == len(launched)
+    # the launch is recorded, so the new runner is not relaunched right away
+    with open(_jobfile('queued', 0)) as f:
+        job = json.load(f)
+    assert time.time() - job['launch_time'] < 10.0
+    assert ([], []) == reap()
+    assert 1 == len(launched)
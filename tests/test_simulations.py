@@ -2,6 +2,7 @@
 import os
 import json
 import time
+import tempfile
 
 from fixie import ENV, waitpid
 
@@ -61,6 +62,7 @@ def test_spawn(xdg, verify_user):
     assert 'me' == job['user']
     assert pid == job['pid']
     assert jobid == job['jobid']
+    assert ENV['FIXIE_NODE'] == job['node']
     assert 'out' in job
     assert 'err' in job
     assert  0 == job['returncode']
@@ -69,6 +71,201 @@ def test_spawn(xdg, verify_user):
     assert os.path.exists(pp)
 
 
+def test_spawn_retry(xdg, verify_user):
+    """Tests that a failing simulation is retried according to its policy."""
+    retry = {'max_attempts': 2, 'backoff': 0.1, 'returncodes': [1]}
+    jobid, status, msg, pid = spawn({'not': 'cyclus'}, 'me', '42', retry=retry,
+                                    return_pid=True)
+    assert jobid == 0
+    assert status
+    waitpid(pid, timeout=10.0)
+    jobfile = ENV['FIXIE_FAILED_JOBS_DIR'] + '/0.json'
+    assert os.path.exists(jobfile)
+    with open(jobfile) as f:
+        job = json.load(f)
+    assert 1 == job['returncode']
+    assert 2 == len(job['attempts'])
+    assert [1, 1] == [a['returncode'] for a in job['attempts']]
+    assert [9] == job['retry']['signals']
+    assert not os.listdir(ENV['FIXIE_HELD_JOBS_DIR'])
+
+
+def test_spawn_notify(xdg, verify_user):
+    """Tests that finished jobs leave notifications in the outbox."""
+    d = tempfile.mkdtemp()
+    notify = ['file://' + d, {'url': 'file://' + d, 'statuses': ['failed']}]
+    jobid, status, msg = spawn(SIMULATION, 'me', '42', notify=notify)
+    assert jobid == -1
+    assert not status
+    ENV['FIXIE_NOTIFY_DIRS'] = {d}
+    jobid, status, msg, pid = spawn(SIMULATION, 'me', '42', notify=notify,
+                                    return_pid=True)
+    assert status
+    waitpid(pid, timeout=10.0)
+    assert ['0-completed-0.json'] == os.listdir(ENV['FIXIE_OUTBOX_DIR'])
+    jobid, status, msg = spawn(SIMULATION, 'me', '42', notify=['ftp://nope'])
+    assert jobid == -1
+    assert not status
+
+
+def test_spawn_post(xdg, verify_user):
+    """Tests that post-processing runs after the simulation completes."""
+    jobid, status, msg, pid = spawn(SIMULATION, 'me', '42', return_pid=True,
+                                    post=[{'stage': 'compress', 'level': 1}])
+    assert status
+    waitpid(pid, timeout=10.0)
+    data, status, msg = query(statuses='completed', jobs=jobid)
+    job, = data
+    assert 'completed' == job['post_status']
+    assert ['compress'] == [r['stage'] for r in job['post_results']]
+    assert job['outfile'].endswith('.h5.gz')
+    assert os.path.exists(job['outfile'])
+    assert [] == os.listdir(ENV['FIXIE_POST_DIR'])
+    jobid, status, msg = spawn(SIMULATION, 'me', '42', post=['nope'])
+    assert jobid == -1
+    assert not status
+
+
+def _group_alive(pgid):
+    # zombies do not count, they are only waiting to be reaped
+    try:
+        with open('/proc/{0}/stat'.format(pgid)) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def _wait_for_pgid(jobid, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with open(_jobfile('running', jobid)) as f:
+                job = json.load(f)
+        except (FileNotFoundError, ValueError):
+            job = {}
+        if job.get('pgid'):
+            return job['pgid']
+        time.sleep(0.01)
+    raise RuntimeError('job never started running')
+
+
+def test_spawn_walltime(xdg, verify_user, slow_cyclus):
+    """Tests that simulations are killed when they run out of time."""
+    jobid, status, msg, pid = spawn(SIMULATION, 'me', '42', return_pid=True,
+                                    limits={'walltime': 0.2},
+                                    retry={'signals': ['SIGTERM', 'SIGKILL']})
+    assert status
+    pgid = _wait_for_pgid(jobid)
+    job = _wait_and_load('failed', jobid, pid)
+    assert 'walltime' == job['limit_exceeded']
+    assert job['err'].startswith('Job exceeded its walltime limit')
+    # the limit is not retried, and the whole process group is gone
+    assert 1 == len(job['attempts'])
+    assert not _group_alive(pgid)
+
+
+def test_cancel_kills_group(xdg, verify_user, slow_cyclus):
+    jobid, status, msg, pid = spawn(SIMULATION, 'me', '42', return_pid=True)
+    pgid = _wait_for_pgid(jobid)
+    jobid, status, msg = cancel(jobid, 'me', '42')
+    assert status
+    waitpid(pid, timeout=10.0)
+    deadline = time.time() + 10.0
+    while _group_alive(pgid) and time.time() < deadline:
+        time.sleep(0.01)
+    assert not _group_alive(pgid)
+
+
+BAD_ALLOC_CYCLUS = """#!/bin/sh
+echo "terminate called after throwing an instance of 'std::bad_alloc'" >&2
+exit 134
+"""
+
+
+def test_spawn_memory(xdg, verify_user, monkeypatch):
+    """Tests that simulations that run out of memory record the limit."""
+    d = os.path.join(xdg, 'bin')
+    os.makedirs(d)
+    cyclus = os.path.join(d, 'cyclus')
+    with open(cyclus, 'w') as f:
+        f.write(BAD_ALLOC_CYCLUS)
+    os.chmod(cyclus, 0o755)
+    monkeypatch.setenv('PATH', d + os.pathsep + os.environ['PATH'])
+    jobid, status, msg, pid = spawn(SIMULATION, 'me', '42', return_pid=True,
+                                    limits={'memory': 2**30},
+                                    retry={'returncodes': [134]})
+    assert status
+    job = _wait_and_load('failed', jobid, pid)
+    assert 'memory' == job['limit_exceeded']
+    assert job['err'].startswith('Job exceeded its memory limit')
+    assert 1 == len(job['attempts'])
+
+
+def test_spawn_invalid_limits(xdg, verify_user):
+    for limits in ({'walltime': -1}, {'memory': 1.5}, {'disk': 10}, 'fast',
+                   {'cputime': float('inf')}, {'walltime': float('nan')}):
+        jobid, status, msg = spawn(SIMULATION, 'me', '42', limits=limits)
+        assert jobid == -1
+        assert not status
+
+
+def test_spawn_invalid_retry(xdg, verify_user):
+    jobid, status, msg = spawn(SIMULATION, 'me', '42', retry={'max_attempts': 0})
+    assert jobid == -1
+    assert not status
+    jobid, status, msg = spawn(SIMULATION, 'me', '42', retry={'signals': ['SIGNOPE']})
+    assert jobid == -1
+    assert not status
+
+
+def _wait_and_load(status, jobid, pid):
+    waitpid(pid, timeout=10.0)
+    with open(_jobfile(status, jobid)) as f:
+        return json.load(f)
+
+
+def test_spawn_after(xdg, verify_user):
+    """Tests that jobs run after the jobs they depend on."""
+    a, _, _, apid = spawn(SIMULATION, 'me', '42', name='warmup', return_pid=True)
+    b, status, msg, bpid = spawn(SIMULATION, 'me', '42', after=['warmup'],
+                                 return_pid=True)
+    assert status
+    c, status, msg, cpid = spawn(SIMULATION, 'me', '42', return_pid=True,
+                                 after=[{'job': b, 'condition': 'success'}])
+    assert status
+    ajob = _wait_and_load('completed', a, apid)
+    bjob = _wait_and_load('completed', b, bpid)
+    cjob = _wait_and_load('completed', c, cpid)
+    assert [{'jobid': a, 'condition': 'success'}] == bjob['after']
+    assert ajob['endtime'] <= bjob['starttime']
+    assert bjob['endtime'] <= cjob['starttime']
+    assert not os.listdir(ENV['FIXIE_HELD_JOBS_DIR'])
+
+
+def test_spawn_after_cascade(xdg, verify_user):
+    """Tests that failed jobs cancel the jobs that depend on them."""
+    a, _, _, apid = spawn({'not': 'cyclus'}, 'me', '42', return_pid=True)
+    b, _, _, bpid = spawn(SIMULATION, 'me', '42', after=[a], return_pid=True)
+    c, _, _, cpid = spawn(SIMULATION, 'me', '42', after=[b], return_pid=True)
+    d, _, _, dpid = spawn(SIMULATION, 'me', '42', return_pid=True,
+                          after=[{'job': a, 'condition': 'any'}])
+    _wait_and_load('failed', a, apid)
+    bjob = _wait_and_load('canceled', b, bpid)
+    cjob = _wait_and_load('canceled', c, cpid)
+    _wait_and_load('completed', d, dpid)
+    assert 'failed' in bjob['err']
+    assert 'canceled' in cjob['err']
+
+
+def test_spawn_invalid_after(xdg, verify_user):
+    jobid, status, msg = spawn(SIMULATION, 'me', '42', after=[42])
+    assert jobid == -1
+    assert not status
+    jobid, status, msg = spawn(SIMULATION, 'me', '42', after=['nope'])
+    assert jobid == -1
+    assert not status
+
+
 def test_self_canceling_queue(xdg, verify_user):
     """Tests that a job will cancel itself if its jobfile in the queue is
     externally removed.
@@ -127,6 +324,26 @@ def test_cancel(xdg, verify_user):
     assert 'err' in job
 
 
+def test_cancel_remote(xdg, verify_user):
+    """Tests that a job running on another node is canceled without
+    signaling any local process.
+    """
+    # the pid is our own, so this test would be killed if it were signaled
+    job = {'jobid': 0, 'user': 'me', 'project': '', 'node': 'elsewhere',
+           'pid': os.getpid()}
+    with open(_jobfile('running', 0), 'w') as f:
+        json.dump(job, f)
+    cid, status, msg = cancel(0, 'me', '42')
+    assert cid == 0
+    assert status
+    assert msg == 'Job canceled'
+    assert not os.path.exists(_jobfile('running', 0))
+    with open(_jobfile('canceled', 0)) as f:
+        job = json.load(f)
+    assert 'elsewhere' == job['node']
+    assert 1 == job['returncode']
+
+
 def _jobfile(status, jobid):
     d = ENV['FIXIE_{0}_JOBS_DIR'.format(status.upper())]
     jobfile = os.path.join(d, str(jobid) + '.json')
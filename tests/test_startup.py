@@ -0,0 +1,64 @@
+"""Tests the import time budget of fixie batch."""
+import sys
+import json
+import subprocess
+
+
+# Import time budget, in seconds, for read-only tools that only need query().
+QUERY_IMPORT_BUDGET = 1.0
+
+IMPORT_QUERY = """
+import sys
+import json
+import time
+t0 = time.perf_counter()
+from fixie_batch.simulations import query
+t1 = time.perf_counter()
+print(json.dumps({'time': t1 - t0, 'modules': sorted(sys.modules)}))
+"""
+
+
+def _import_query():
+    out = subprocess.check_output([sys.executable, '-c', IMPORT_QUERY],
+                                  universal_newlines=True)
+    return json.loads(out.splitlines()[-1])
+
+
+def test_query_import_skips_heavy_modules():
+    obs = _import_query()
+    modules = set(obs['modules'])
+    assert 'jinja2' not in modules
+    assert 'pprintpp' not in modules
+
+
+def test_query_import_budget():
+    # take the best of a few runs, to be robust to a noisy machine
+    best = min(_import_query()['time'] for i in range(3))
+    assert best < QUERY_IMPORT_BUDGET
+
+
+RUNNER_IMPORTS = """
+import sys
+import json
+{imports}
+print(json.dumps(sorted(sys.modules)))
+"""
+
+
+def test_runner_imports_skip_fixie():
+    # the runner scripts only import stdlib-only modules, so that every
+    # spawned job starts quickly
+    import ast
+    from fixie_batch.simulations import SPAWN_PY
+    header = SPAWN_PY[:SPAWN_PY.index('{{')].rsplit('\n', 1)[0]
+    tree = ast.parse(header)
+    imports = '\n'.join(ast.get_source_segment(header, node) for node in tree.body
+                        if isinstance(node, (ast.Import, ast.ImportFrom)))
+    assert 'fixie_batch' in imports
+    out = subprocess.check_output([sys.executable, '-c',
+                                   RUNNER_IMPORTS.format(imports=imports)],
+                                  universal_newlines=True)
+    modules = set(json.loads(out.splitlines()[-1]))
+    assert 'fixie' not in modules
+    assert 'xonsh' not in modules
+    assert 'jinja2' not in modules
@@ -0,0 +1,90 @@
+"""Tests managing the simulation outputs"""
+import os
+import gzip
+import json
+
+from fixie import ENV
+
+from fixie_batch.simulations import query
+from fixie_batch.storage import sweep, recompress
+
+
+def _write_job(jobid, user='me', project='', endtime=100.0, size=10,
+               status='completed', holding=None):
+    outfile = os.path.join(ENV['FIXIE_SIMS_DIR'], '{0}.h5'.format(jobid))
+    with open(outfile, 'wb') as f:
+        f.write(b'x' * size)
+    job = {'jobid': jobid, 'user': user, 'project': project, 'endtime': endtime,
+           'outfile': outfile}
+    d = ENV['FIXIE_{0}_JOBS_DIR'.format(status.upper())]
+    with open(os.path.join(d, '{0}.json'.format(jobid)), 'w') as f:
+        json.dump(job, f)
+    if holding is not None:
+        ppf = os.path.join(ENV['FIXIE_PATHS_DIR'],
+                           '{0}-{1}-pending-path.json'.format(user, jobid))
+        with open(ppf, 'w') as f:
+            json.dump({'file': outfile, 'holding': holding}, f)
+    return outfile
+
+
+def _job(jobid):
+    data, status, msg = query(jobs=jobid)
+    return data[0]
+
+
+def test_sweep_holding_time(xdg):
+    expired = _write_job(0, holding=10.0)
+    kept = _write_job(1, holding='inf')
+    removed = sweep(now=200.0)
+    assert {0: 'holding time expired'} == removed
+    assert not os.path.exists(expired)
+    assert os.path.exists(kept)
+    job = _job(0)
+    assert job['outfile'] is None
+    assert expired == job['removed']['file']
+    assert _job(1)['outfile'] == kept
+
+
+def test_sweep_quotas(xdg):
+    _write_job(0, endtime=1.0, size=10)
+    _write_job(1, endtime=2.0, size=10, status='failed')
+    _write_job(2, endtime=3.0, size=10)
+    _write_job(3, user='you', endtime=0.0, size=10)
+    removed = sweep(now=4.0, user_quota=25)
+    assert {0: 'user quota exceeded'} == removed
+    _write_job(4, user='you', project='p', endtime=5.0, size=10)
+    _write_job(5, project='p', endtime=6.0, size=10)
+    removed = sweep(now=7.0, project_quota=15)
+    assert {4: 'project quota exceeded'} == removed
+    assert _job(5)['outfile'] is not None
+
+
+def test_recompress(xdg):
+    outfile = _write_job(0, endtime=1.0, size=1000)
+    _write_job(1, endtime=100.0)
+    assert [0] == recompress(level=1, min_age=50.0, now=100.0)
+    job = _job(0)
+    assert outfile + '.gz' == job['outfile']
+    assert 1000 == job['recompressed']['original_size']
+    with gzip.open(job['outfile']) as f:
+        assert b'x' * 1000 == f.read()
+    # already compressed outputs are left alone
+    assert [] == recompress(level=1, min_age=50.0, now=100.0)
+
+
+def test_recompress_job_changed(xdg, monkeypatch):
+    import fixie_batch.storage
+    outfile = _write_job(0, endtime=1.0, size=1000)
+    gzip_file = fixie_batch.storage.gzip_file
+
+    def sweep_while_compressing(path, level=6, keep=False):
+        # a sweep removes the output while it is being compressed
+        rtn = gzip_file(path, level=level, keep=keep)
+        sweep(now=100.0, user_quota=0)
+        return rtn
+
+    monkeypatch.setattr(fixie_batch.storage, 'gzip_file', sweep_while_compressing)
+    assert [] == recompress(level=1, min_age=50.0, now=100.0)
+    assert _job(0)['outfile'] is None
+    assert not os.path.exists(outfile)
+    assert not os.path.exists(outfile + '.gz')
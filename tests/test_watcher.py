@@ -0,0 +1,68 @@
+"""Tests watching jobs for status changes"""
+import pytest
+from tornado.ioloop import IOLoop
+from fixie import ENV
+
+from fixie_batch.transitions import record_transition, read_transitions
+from fixie_batch.watcher import watch
+
+
+def _record(jobid, status, user='me', project=''):
+    return record_transition(ENV['FIXIE_TRANSITIONS_FILE'], jobid, status,
+                             user=user, project=project, node='node0')
+
+
+def test_read_transitions(xdg):
+    t0 = _record(0, 'queued')
+    t1 = _record(0, 'running')
+    obs, offset = read_transitions(ENV['FIXIE_TRANSITIONS_FILE'])
+    assert [t0, t1] == [t for s, e, t in obs]
+    assert obs[1][0] == obs[0][1]
+    assert offset == obs[1][1]
+    # nothing new after the offset
+    obs, new = read_transitions(ENV['FIXIE_TRANSITIONS_FILE'], offset)
+    assert [] == obs
+    assert new == offset
+
+
+def test_read_transitions_skips_bad_lines(xdg):
+    t0 = _record(0, 'queued')
+    with open(ENV['FIXIE_TRANSITIONS_FILE'], 'a') as f:
+        f.write('{"jobid": 1, "sta{"jobid": 2}\n')
+    t1 = _record(0, 'running')
+    obs, offset = read_transitions(ENV['FIXIE_TRANSITIONS_FILE'])
+    assert [t0, t1] == [t for s, e, t in obs]
+    assert offset == obs[1][1]
+
+
+@pytest.mark.gen_test
+def test_watch_timeout(xdg):
+    data, cursor, status, msg = yield watch(timeout=0.1)
+    assert [] == data
+    assert status
+
+
+@pytest.mark.gen_test
+def test_watch_since(xdg):
+    _record(0, 'queued')
+    _record(1, 'queued', user='you')
+    _record(0, 'completed')
+    data, cursor, status, msg = yield watch(since=0, users='me', timeout=1.0)
+    assert status
+    assert [(0, 'queued'), (0, 'completed')] == [(t['jobid'], t['status'])
+                                                for t in data]
+    data, cursor, status, msg = yield watch(since=0, jobs=[0],
+                                            statuses='completed', timeout=1.0)
+    assert [(0, 'completed')] == [(t['jobid'], t['status']) for t in data]
+    # no more transitions after the cursor
+    data, cursor, status, msg = yield watch(since=cursor, timeout=0.1)
+    assert [] == data
+
+
+@pytest.mark.gen_test
+def test_watch_wakes_up(xdg):
+    IOLoop.current().call_later(0.2, _record, 1, 'failed')
+    IOLoop.current().call_later(0.1, _record, 0, 'running')
+    data, cursor, status, msg = yield watch(jobs=[1], statuses=['completed', 'failed'],
+                                            timeout=5.0)
+    assert [(1, 'failed')] == [(t['jobid'], t['status']) for t in data]
@@ -0,0 +1,106 @@
+"""Tests workers for the shared queue"""
+import os
+import json
+import time
+
+from fixie import ENV
+
+from fixie_batch.simulations import spawn, claim
+from fixie_batch.worker import work
+from fixie_batch.holds import add_hold, held_ids
+
+
+SIMULATION = {
+ 'simulation': {
+  'archetypes': {
+   'spec': [
+    {'lib': 'agents', 'name': 'Sink'},
+    {'lib': 'agents', 'name': 'NullRegion'},
+    {'lib': 'agents', 'name': 'NullInst'},
+   ],
+  },
+  'control': {
+   'duration': 2,
+   'startmonth': 1,
+   'startyear': 2000,
+  },
+  'facility': {
+   'config': {'Sink': {'capacity': '1.00', 'in_commods': {'val': 'commodity'}}},
+   'name': 'Sink',
+  },
+  'recipe': {
+   'basis': 'mass',
+   'name': 'commod_recipe',
+   'nuclide': {'comp': '1', 'id': 'H1'},
+  },
+  'region': {
+   'config': {'NullRegion': None},
+   'institution': {
+    'config': {'NullInst': None},
+    'initialfacilitylist': {'entry': {'number': '1', 'prototype': 'Sink'}},
+    'name': 'SingleInstitution',
+   },
+   'name': 'SingleRegion',
+  },
+ },
+}
+
+
+def test_shared_queue(xdg, verify_user):
+    ENV['FIXIE_SHARED_QUEUE'] = True
+    ENV['FIXIE_NODE'] = 'node0'
+    jobid, status, msg, pid = spawn(SIMULATION, 'me', '42', return_pid=True)
+    assert jobid == 0
+    assert status
+    assert pid is None
+    # job should just be sitting in the queue
+    jobfile = ENV['FIXIE_QUEUED_JOBS_DIR'] + '/0.json'
+    assert os.path.exists(jobfile)
+    # a worker should claim it, and no one else can claim it afterwards
+    claimed = work(njobs=1, once=True)
+    assert [0] == claimed
+    assert not claim(0)
+    # job should be completed after waiting
+    jobfile = ENV['FIXIE_COMPLETED_JOBS_DIR'] + '/0.json'
+    t0 = time.time()
+    while not os.path.exists(jobfile) and time.time() - t0 < 10.0:
+        time.sleep(0.01)
+    with open(jobfile) as f:
+        job = json.load(f)
+    assert 'node0' == job['node']
+    assert 0 == job['returncode']
+
+
+def test_worker_respects_njobs(xdg, verify_user):
+    ENV['FIXIE_SHARED_QUEUE'] = True
+    for i in range(3):
+        spawn(SIMULATION, 'me', '42')
+    claimed = work(njobs=0, once=True)
+    assert [] == claimed
+    assert 3 == len(os.listdir(ENV['FIXIE_QUEUED_JOBS_DIR']))
+
+
+def test_worker_skips_held(xdg, verify_user):
+    ENV['FIXIE_SHARED_QUEUE'] = True
+    ENV['FIXIE_NJOBS'] = 0
+    spawn(SIMULATION, 'me', '42')
+    spawn(SIMULATION, 'me', '42')
+    add_hold(ENV['FIXIE_HELD_JOBS_DIR'], 0, until=time.time() + 1000.0)
+    add_hold(ENV['FIXIE_HELD_JOBS_DIR'], 1, until=time.time() - 1.0)
+    # only the job whose hold has expired is claimed
+    claimed = work(njobs=2, once=True)
+    assert [1] == claimed
+    assert {0} == held_ids(ENV['FIXIE_HELD_JOBS_DIR'])
+
+
+def test_worker_resolves_holds_without_slots(xdg, verify_user):
+    ENV['FIXIE_SHARED_QUEUE'] = True
+    a, status, msg = spawn(SIMULATION, 'me', '42')
+    os.rename(os.path.join(ENV['FIXIE_QUEUED_JOBS_DIR'], '{0}.json'.format(a)),
+              os.path.join(ENV['FIXIE_FAILED_JOBS_DIR'], '{0}.json'.format(a)))
+    b, status, msg = spawn(SIMULATION, 'me', '42', after=[a])
+    assert status, msg
+    # the dependent of the failed job is canceled, though no slot is free
+    assert [] == work(njobs=0, once=True)
+    assert os.path.exists(os.path.join(ENV['FIXIE_CANCELED_JOBS_DIR'],
+                                       '{0}.json'.format(b)))